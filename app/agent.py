@@ -1,15 +1,25 @@
 import asyncio
 import json
+import os
 import traceback
-from typing import Optional
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Optional
 from asyncio import CancelledError
-from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
 
+from .budget import Budget, BudgetExceeded
+from .cassette import record_call
 from .chat import ChatSession, get_total_usage
 from .commands import AgentParseError
+from .kernel import kernel_pool
+from .output import OutputCapture
+from .shell import PERSISTENT_SHELL, ShellSession, ShellTimeout, format_result, run_process
+from .usage import Usage
 from .web_server import WebSession
 from .prompts import getSystemPrompt, getCommands
 
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessage
+
 class Agent:
     def __init__(self, args, context, name: str = "main", role : str = 'agent', prompt: str | list[str] = None, parent: Optional['Agent']=None, web_server: WebSession = None):
         self.args = args
@@ -20,12 +30,53 @@ class Agent:
         self.parent = parent
         self.context = context
         self.supervisor_path = ['human'] if parent is None else parent.supervisor_path + [parent.name]
-        self.chat_session = ChatSession(args.model, functions=self.commands)
+        self.usage = Usage()
+        # usage of this agent and all its sub-agents, which its budget applies to
+        self.subtree_usage = Usage()
+        accounts = [self.usage] + [agent.subtree_usage for agent in self.supervisors()]
+        session_usage = getattr(context, 'usage', None)
+        if session_usage:
+            accounts.append(session_usage)
+        limits = Budget.limits_from_env('AGENT_BUDGET') if parent else {}
+        self.budget = Budget(name, self.subtree_usage, limits, parent.budget if parent else getattr(context, 'budget', None))
+        self.chat_session = ChatSession(args.model, functions=self.commands, stream=bool(getattr(args, 'stream', False)), on_delta=self.send_delta, on_change=self.record, accounts=accounts, budget=self.budget, priority=len(self.supervisor_path) - 1)
+        self.tracer = getattr(context, 'tracer', None)
         self.stopped = False
+        # stopped or cancelled before completing its task: resumed with the runner
+        self.interrupted = False
+        self.shell: Optional[ShellSession] = None
+        self.outputs = 0
         if prompt is None:
             prompt = getSystemPrompt(name, self.supervisor_path, role)
         self.prompt = prompt
 
+    @property
+    def cwd(self) -> str:
+        '''Working directory of the runner this agent belongs to.'''
+        return self.context.path
+
+    def supervisors(self):
+        '''This agent and its supervisors up to the main agent.'''
+        agent = self
+        while agent is not None:
+            yield agent
+            agent = agent.parent
+
+    def session_usage(self) -> dict:
+        '''Usage of the runner this agent belongs to, shown in the web client.'''
+        usage = getattr(self.context, 'usage', None)
+        return usage.snapshot() if usage else get_total_usage()
+
+    def span(self, name: str, category: str, **args):
+        '''A timing span of this agent in the runner's trace.'''
+        return self.tracer.span(name, category, agent=self.name, **args) if self.tracer else nullcontext()
+
+    def record(self, kind: str, data: dict):
+        '''Add an entry about this agent to the runner's journal.'''
+        journal = getattr(self.context, 'journal', None)
+        if journal:
+            journal.record(kind, agent=self.name, **data)
+
     async def init(self):
         if isinstance(self.prompt, list):
             for p in self.prompt:
@@ -35,6 +86,18 @@ class Agent:
         if self.web_server:
             await self.web_server.set_agent_properties(self.name, self.role, self.chat_session.model, list(self.commands.keys()), self.parent.name if self.parent else None)
 
+    async def restore(self):
+        '''Show an agent rebuilt from the journal in the web client.'''
+        if self.web_server:
+            await self.web_server.set_agent_properties(self.name, self.role, self.chat_session.model, list(self.commands.keys()), self.parent.name if self.parent else None)
+            await self.web_server.load_messages(self.name, [Agent.parse_message(m) for m in self.chat_session.messages])
+
+    def result(self):
+        '''Arguments of the agent's last function call (normally COMPLETE).'''
+        last_msg = self.chat_session.messages[-1] if self.chat_session.messages else {}
+        last_msg_parsed = last_msg.get("function_call")
+        return last_msg_parsed and last_msg_parsed['arguments']
+
     @staticmethod
     def parse_message(message):
         function_call = message.get("function_call")
@@ -100,10 +163,10 @@ class Agent:
         return message
     """
 
-    async def send_new_message(self, message: ChatCompletionMessage, status='running'):
+    async def send_new_message(self, message: 'ChatCompletionMessage', status='running'):
         try:
             if self.web_server:
-                await self.web_server.add_message(self.name, Agent.parse_message(message), usage=get_total_usage())
+                await self.web_server.add_message(self.name, Agent.parse_message(message), usage=self.session_usage())
         except KeyboardInterrupt:
             raise
         except CancelledError:
@@ -112,19 +175,77 @@ class Agent:
             print(f"[ERROR] Couldn't send update to web server")
             traceback.print_exc()
 
+    async def send_delta(self, delta: dict):
+        try:
+            if self.web_server:
+                await self.web_server.add_message_delta(self.name, delta)
+        except CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Couldn't send delta to web server: {e}")
+
+    async def send_budget(self):
+        try:
+            if self.web_server:
+                await self.web_server.set_budget(self.name, self.budget.remaining())
+        except CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Couldn't send budget to web server: {e}")
+
+    async def send_trace(self):
+        try:
+            if self.web_server and self.tracer:
+                await self.web_server.set_trace(self.name, self.tracer.summary(self.name))
+        except CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Couldn't send trace to web server: {e}")
+
+    async def complete_over_budget(self, reason: str):
+        '''End the agent as if it completed with failure, so that its supervisor gets a result.'''
+        print(f"[BUDGET] Agent {self.name} stopped: {reason}")
+        last = next((m['content'] for m in reversed(self.chat_session.messages) if m.get('role') == 'assistant' and m.get('content')), None)
+        content = f"Stopped before completing the task: {reason}."
+        if last:
+            content += f"\nLast message: {last[:1000]}"
+        message = {
+            'role': 'assistant',
+            'content': None,
+            'function_call': {'name': 'COMPLETE', 'arguments': json.dumps({'status': 'failure', 'content': content})}
+        }
+        self.chat_session.append(message)
+        await self.send_new_message(message)
+        self.stopped = True
+
     async def stop(self):
         print(f"Stopping agent {self.name}")
         self.stopped = True
+        self.interrupted = True
+        await self.cancel_sub_agents()
+
+    async def cancel_sub_agents(self):
+        tasks = getattr(self.context, 'tasks', None)
+        if tasks:
+            await tasks.cancel(self)
 
     async def run(self):
+        with self.span(self.name, 'agent', role=self.role, model=self.chat_session.model):
+            await self.run_turns()
+        await self.send_trace()
+
+    async def run_turns(self):
         print(f"Agent {self.name} ({self.chat_session.model}) created. Functions: {self.commands.keys()}")
+        self.record('state', {'state': 'running'})
         if self.web_server:
-            await self.web_server.set_state(self.name, 'running', usage=get_total_usage())
+            await self.web_server.set_state(self.name, 'running', usage=self.session_usage())
+        await self.send_budget()
         while not self.stopped:
             try:
                 print(f"Agent {self.name} running...")
                 response = await self.chat_session.chat()
                 await self.send_new_message(response)
+                await self.send_budget()
                 try:
                     function_call = response.get("function_call")
                     if function_call:
@@ -146,33 +267,47 @@ class Agent:
                     print(f"[ERROR] Couldn't handle agent's message: {response}")
                     traceback.print_exc()
                     await self.add_message(f"ERROR\n{type(e).__name__}: {e}", "system")
+            except BudgetExceeded as e:
+                await self.complete_over_budget(str(e))
             except CancelledError:
+                self.interrupted = True
                 break
             except KeyboardInterrupt:
                 print("\nExiting.")
+                self.interrupted = True
                 break
         #await self.send_update()
+        await self.cancel_sub_agents()
+        await kernel_pool.release(self)
+        if self.shell:
+            await self.shell.close()
+        self.record('state', {'state': 'stopped' if self.interrupted else 'completed'})
         if self.web_server:
-            await self.web_server.set_state(self.name, 'completed', usage=get_total_usage())
+            await self.web_server.set_state(self.name, 'completed', usage=self.session_usage())
         print(f"Agent {self.name} ended")
 
     async def add_message(self, message: str, role: str = "user", name: Optional[str] = None):
         await self.send_new_message(self.chat_session.add_message(message, role, name))
 
     async def get_human_input(self, message, reply_type="reply"):
-        user_input = await self.web_server.get_input(self.name, message)
+        user_input = await record_call('input', {'message': message}, lambda: self.web_server.get_input(self.name, message), message)
         print(f"{message}: {user_input}")
         await self.add_message(json.dumps({ reply_type: user_input }))
 
     async def handle_agent_command(self, command_name: str, args):
         command = self.commands[command_name.upper()]
         # print(f"Handling command {command} with args {args}")
-        result = await command["callback"](self, args)
+        with self.span(command['name'], 'command'):
+            result = await command["callback"](self, args)
         print(f"Command {command['name']} returned: {result}")
+        await self.send_trace()
         if result is not None:
             await self.add_message(result, "function", name=command_name)
 
-    async def handle_agent_assign(self, sub_agent_id, task, messages: list[str]=[], role='worker'):
+    async def handle_agent_assign(self, sub_agent_id, task, messages: list[str]=[], role='worker', wait: bool = True, after: list[str] = []):
+        tasks = getattr(self.context, 'tasks', None)
+        if tasks:
+            tasks.check(after)
         sub_agent_id = self.context.new_agent_id(sub_agent_id)
         print(f"[ASSIGN] {sub_agent_id} {task}")
         sub_agent = Agent(self.args, self.context, name=sub_agent_id, role=role, parent=self, web_server=self.web_server)
@@ -182,31 +317,57 @@ class Agent:
             await sub_agent.add_message(json.dumps({"main_goal": task}))
         for m in messages:
             await sub_agent.add_message(m)
-        await sub_agent.run()
-        last_msg = sub_agent.chat_session.messages[-1]
-        last_msg_parsed = last_msg.get("function_call")
-        print(f"[ASSIGN] {sub_agent_id} completed: {last_msg_parsed}")
+        if not tasks:
+            await sub_agent.run()
+            result = sub_agent.result()
+        else:
+            tasks.start(sub_agent, after)
+            if not wait:
+                print(f"[ASSIGN] {sub_agent_id} started in the background")
+                return json.dumps({'agent_id': sub_agent_id, 'status': 'waiting' if after else 'running'})
+            result = (await tasks.wait(self, [sub_agent_id]))[sub_agent_id]
+        print(f"[ASSIGN] {sub_agent_id} completed: {result}")
         if self.web_server:
             await self.web_server.set_state(self.name, 'running')
-        return last_msg_parsed and last_msg_parsed['arguments']
+        return result
+
+    def output_captures(self, kind: str) -> tuple[OutputCapture, OutputCapture]:
+        '''Bounded stdout and stderr captures for a command, spilling to the runner directory and streamed to the web client.'''
+        self.outputs += 1
+        base = os.path.join(self.cwd, '.output', f'{self.name}-{kind}-{self.outputs}')
+        def live(stream):
+            async def on_chunk(text):
+                await self.send_output(stream, text)
+            return on_chunk
+        return OutputCapture(f'{base}.stdout', live('stdout')), OutputCapture(f'{base}.stderr', live('stderr'))
+
+    async def send_output(self, stream: str, text: str):
+        try:
+            if self.web_server:
+                await self.web_server.add_output(self.name, stream, text)
+        except CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Couldn't send output to web server: {e}")
 
-    async def handle_agent_process(self, command):
+    async def handle_agent_process(self, command, cwd: str):
+        stdout, stderr = self.output_captures('run')
         try:
-            process = await asyncio.create_subprocess_shell(
-                command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            stdout = stdout.decode()
-            stderr = stderr.decode()
-            return_code = process.returncode
+            with self.span('subprocess', 'shell', command=command[:200], persistent=PERSISTENT_SHELL):
+                if PERSISTENT_SHELL:
+                    if self.shell is None:
+                        self.shell = ShellSession(cwd)
+                    return_code, stdout, stderr = await self.shell.run(command, stdout, stderr)
+                else:
+                    return_code, stdout, stderr = await run_process(command, cwd, stdout=stdout, stderr=stderr)
             if return_code == 0:
                 print(f"[OUTPUT] {stdout}")
-                return f"stdout: {stdout}"
             else:
                 print(f"[ERROR] Command returned exit code {return_code}\n{stderr}")
-                return f"stderr: {stderr}"
+            return format_result(return_code, stdout, stderr)
+        except ShellTimeout as e:
+            print(f"[ERROR] {e}")
+            return f"error: {e}\nstdout: {stdout.text()}\nstderr: {stderr.text()}"
         except Exception as e:
             print(f"[ERROR] Failed to run the command: {e}")
             return f"error: {e}"
@@ -2,61 +2,170 @@ import asyncio
 from datetime import datetime
 import json
 import os
-import traceback
+import time
 import uuid
-from asyncio import CancelledError, Queue
 
 from .agent import Agent
-from .chat import get_total_usage, get_model_list
+from .budget import Budget
+from .cassette import CASSETTE_RECORD, Cassette, current_cassette
+from .chat import get_model_list, refresh_model_list, set_completion_cache
+from .journal import Journal
+from .kernel import kernel_pool
+from .recall import RecallIndex
+from .resources import ResourceRegistry, current_resources
+from .scheduler import SessionScheduler
+from .task_graph import TaskGraph
+from .tracing import TRACE_DIR, Tracer
+from .usage import usage_ledger
 from .web_server import WebServer, WebSession
 
-async def agent_worker(task_queue: Queue):
-    while True:
-        try :
-            task = await task_queue.get()
-            if task is None:
-                break
-            await asyncio.gather(task)
-        except KeyboardInterrupt:
-            break
-        except CancelledError:
-            break
-        except Exception as e:
-            print(f'Error in worker: {e}')
-            traceback.print_exc()
-            break
-
-task_queue = Queue()
+scheduler = SessionScheduler(int(os.getenv('MAX_SESSIONS', 4)))
+
+JOURNAL_DIR = '.journal'
 
 class AgentRunner:
-    def __init__(self, args, session: WebSession = None):
+    def __init__(self, args, session: WebSession = None, name: str | None = None, resume: bool = False, cassette: Cassette | None = None):
         self.args = args
         time = datetime.now().strftime("%Y%m%d-%H%M%S")
-        self.name = f"{time}-{uuid.uuid4().hex[:4]}" if 'name' not in args else args['name']
+        self.name = name or (f"{time}-{uuid.uuid4().hex[:4]}" if 'name' not in args else args['name'])
         self.path = os.path.join(os.getcwd(), self.name)
-        os.mkdir(self.path)
+        os.makedirs(self.path, exist_ok=resume)
+        self.resumed = resume
+        # filled from the journal when resuming
+        self.states: dict[str, str] = {}
+        self.parent_turns: dict[str, int] = {}
+        self.journal = Journal(AgentRunner.journal_path(self.name))
+        if not resume:
+            self.journal.record('runner', name=self.name, path=self.path, model=args.model)
         self.session = session
+        self.usage = usage_ledger.session(self.name)
+        self.budget = Budget(self.name, self.usage, Budget.limits_from_env('BUDGET'))
+        self.tracer = Tracer(self.name)
+        # shared by the agents, so they don't fetch again what another one did
+        self.recall_index = RecallIndex()
+        self.tasks = TaskGraph()
+        # processes and requests, reclaimed when the runner stops
+        self.resources = ResourceRegistry(self.name)
+        if cassette is None and (getattr(args, 'record', None) or CASSETTE_RECORD):
+            cassette = Cassette(Cassette.path_for(self.name))
+            cassette.start(name=self.name, model=args.model)
+        self.cassette = cassette
         self.agents: dict[str, Agent] = {}
         self.main_agent = Agent(args, self, web_server=session)
         self.add_agent(self.main_agent)
         print(f"Created agent runner {self.name} in path {self.path}")
-    
+
+    @staticmethod
+    def journal_path(name: str) -> str:
+        return os.path.join(os.getcwd(), JOURNAL_DIR, f'{name}.jsonl')
+
+    @staticmethod
+    def last_journal() -> str | None:
+        '''Name of the runner with the most recently modified journal.'''
+        directory = os.path.join(os.getcwd(), JOURNAL_DIR)
+        if not os.path.isdir(directory):
+            return None
+        journals = [f for f in os.listdir(directory) if f.endswith('.jsonl')]
+        if not journals:
+            return None
+        last = max(journals, key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+        return last[:-len('.jsonl')]
+
+    @staticmethod
+    async def resume(args, name: str, session: WebSession = None) -> 'AgentRunner':
+        '''Rebuild a runner, its agents and their chat histories from its journal, without calling the API.'''
+        if name == 'last':
+            name = AgentRunner.last_journal()
+            if name is None:
+                raise FileNotFoundError('No journal to resume')
+        records = await asyncio.to_thread(Journal.read, AgentRunner.journal_path(name))
+        context = AgentRunner(args, session, name=name, resume=True)
+        for record in records:
+            kind = record['type']
+            agent = context.agents.get(record.get('agent'))
+            if kind == 'agent' and agent is None:
+                parent = context.agents[record['parent']]
+                agent = Agent(args, context, name=record['agent'], role=record['role'], parent=parent, web_server=session)
+                context.agents[agent.name] = agent
+                context.parent_turns[agent.name] = len(parent.chat_session.messages)
+            if agent is None:
+                continue
+            if kind == 'agent':
+                agent.chat_session.model = record.get('model', agent.chat_session.model)
+            elif kind == 'message':
+                agent.chat_session.messages.append(record['message'])
+            elif kind == 'compact':
+                agent.chat_session.messages[:] = record['messages']
+            elif kind == 'state':
+                context.states[agent.name] = record['state']
+        print(f"Resumed agent runner {name} from {len(records)} journal records")
+        return context
+
     async def run(self, main_goal: str | None = None):
-        init_path = os.getcwd()
-        os.chdir(self.path)
+        token = current_cassette.set(self.cassette)
+        resources_token = current_resources.set(self.resources)
         try:
+            if self.resumed:
+                for agent in self.agents.values():
+                    await agent.restore()
+                async with self.tasks.slot(self.main_agent):
+                    await self.resume_agent(self.main_agent)
+                return
             await self.main_agent.init()
             if main_goal is None:
                 await self.main_agent.get_human_input("Main goal", "main_goal")
             else:
+                if self.cassette:
+                    # replayed as the answer to the main goal prompt
+                    self.cassette.record('input', {'message': 'Main goal'}, main_goal, 'Main goal')
                 await self.main_agent.add_message(json.dumps({ "main_goal": main_goal }))
-            await self.main_agent.run()
+            async with self.tasks.slot(self.main_agent):
+                await self.main_agent.run()
         finally:
-            os.chdir(init_path)
+            current_cassette.reset(token)
+            current_resources.reset(resources_token)
+            await self.resources.close()
+            await self.journal.close()
+            if self.cassette:
+                await self.cassette.close()
+                print(f"Cassette {self.cassette.path}: {self.cassette.stats()}")
+            if self.tasks.counters['started']:
+                print(f"Sub-agents: {self.tasks.stats()}")
+            if len(self.recall_index):
+                print(f"Recall index: {self.recall_index.stats()}")
+            if TRACE_DIR:
+                await asyncio.to_thread(self.tracer.export, os.path.join(TRACE_DIR, f'{self.name}.json'))
             # delete the directory if it's empty
             if not os.listdir(self.path):
                 os.rmdir(self.path)
 
+    async def resume_agent(self, agent: Agent):
+        '''Continue a resumed agent where the journal left it, resuming the sub-agent it was waiting for first.'''
+        messages = agent.chat_session.messages
+        if agent is self.main_agent and not any(m.get('role') == 'user' for m in messages):
+            if not messages:
+                await agent.init()
+            await agent.get_human_input("Main goal", "main_goal")
+        call = messages[-1].get('function_call') if messages else None
+        # the ones 'stopped' were interrupted, by the user or the server going down, and go on
+        if self.states.get(agent.name) == 'completed' or (call and call['name'].upper() == 'COMPLETE' and agent is not self.main_agent):
+            return
+        # a sub-agent created after the pending call was assigned by it
+        child = next((a for a in reversed(self.agents.values())
+                      if a.parent is agent and self.parent_turns.get(a.name) == len(messages)), None) if call else None
+        # the ones assigned in the background go on meanwhile, and can be waited for again
+        for other in [a for a in self.agents.values() if a.parent is agent and a is not child and a.name not in self.tasks.tasks]:
+            self.tasks.start(other, run=lambda other=other: self.resume_agent(other))
+        if call:
+            if call['name'].upper() == 'ASSIGN' and child:
+                self.tasks.start(child, run=lambda: self.resume_agent(child))
+                result = (await self.tasks.wait(agent, [child.name]))[child.name]
+                await agent.add_message(result, 'function', name=call['name'])
+            else:
+                await agent.add_message(f"The server restarted while running {call['name']}, its result was lost. "
+                                        "Check whether it took effect before retrying it.", 'system')
+        await agent.run()
+
     def new_agent_id(self, proposed_name: str):
         if proposed_name in self.agents:
             i = 1
@@ -67,41 +176,91 @@ class AgentRunner:
     
     def add_agent(self, agent: Agent):
         self.agents[agent.name] = agent
+        # the main agent of a resumed runner is in the journal already, new sub-agents aren't
+        if not (self.resumed and agent.parent is None):
+            self.journal.record('agent', agent=agent.name, role=agent.role, model=agent.chat_session.model,
+                                parent=agent.parent.name if agent.parent else None)
 
-    async def stop(self):
+    async def stop(self) -> dict:
+        '''Stop the agents, cancel their requests and kill their processes. Returns what was reclaimed.'''
         for agent in self.agents.values():
             await agent.stop()
+        for agent in self.agents.values():
+            await kernel_pool.release(agent)
+            if agent.shell:
+                await agent.shell.close()
+        return await self.resources.reclaim()
 
-    async def save_state(path: str):
-        '''Save the state of the agent to a json file.'''
+    async def save_state(self):
+        '''Write the pending journal records to disk.'''
+        await self.journal.flush()
 
 
 async def add_agent(args, session: WebSession):
-    session.task = asyncio.create_task(execute_chat(args, session))
-    await task_queue.put(session.task)
+    session.task = asyncio.create_task(scheduler.run(session, lambda: execute_chat(args, session)))
     
 
 async def execute_chat(args, session: WebSession):
     await session.reset(args.model)
 
-    context = AgentRunner(args, session)
+    resume = getattr(args, 'resume', None)
+    if resume:
+        # only the first session resumes, restarting it from the client starts a new runner
+        args.resume = None
+        context = await AgentRunner.resume(args, resume, session)
+    else:
+        context = AgentRunner(args, session)
     await session.set_agent(context)
-    await session.set_property('models', await get_model_list())
-    await session.set_property('usage', get_total_usage())
+    models = get_model_list()
+    await session.set_property('models', models or [args.model])
+    if not models:
+        asyncio.create_task(send_model_list(session, args.model))
+    await session.set_property('usage', context.usage.snapshot())
     await session.send_init_state()
     await context.run()
     print("Completed")
 
+async def send_model_list(session: WebSession, default_model: str):
+    '''Send the model list once it is first fetched.'''
+    await refresh_model_list()
+    await session.set_property('models', get_model_list() or [default_model])
+
+async def replay(args) -> AgentRunner:
+    '''Re-run a recorded session offline, without a web client.'''
+    cassette = Cassette(Cassette.path_for(args.replay), replay=True)
+    args.model = cassette.header.get('model', args.model)
+    context = AgentRunner(args, cassette=cassette)
+    start = time.perf_counter()
+    await context.run()
+    print(f"Replayed {args.replay} in {time.perf_counter() - start:.2f}s: {context.main_agent.result()}")
+    return context
+
 async def main(args):
+    if args.replay:
+        await replay(args)
+        return
+    if args.max_sessions:
+        scheduler.max_sessions = args.max_sessions
+    if args.cache:
+        set_completion_cache(args.cache)
+    # start the Python kernels and fetch the model list in the background
+    kernel_pool.refill()
+    refresh_model_list()
     web_server = WebServer(args, add_agent)
-    await asyncio.gather(
-        web_server.run(),
-        asyncio.create_task(agent_worker(task_queue))
-    )
+    try:
+        await web_server.run()
+    finally:
+        await kernel_pool.close()
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Start the Argent server.")
     parser.add_argument("-m", "--model", default="gpt-4o", help="Specify the default model to use.")
+    parser.add_argument("--stream", action="store_true", help="Stream completions to the web client as they are generated.")
+    parser.add_argument("-c", "--cache", default=None, help="Cache completions in this directory (default: $COMPLETION_CACHE_DIR, disabled if unset).")
+    parser.add_argument("-s", "--max-sessions", type=int, default=None, help="Maximum number of sessions running concurrently (default: $MAX_SESSIONS or 4).")
+    parser.add_argument("-r", "--resume", default=None, metavar="NAME", help="Resume the runner NAME (or 'last') from its journal in the first session.")
+    parser.add_argument("--record", action="store_true", help="Record the external I/O of each runner to a cassette in $CASSETTE_DIR (default: .cassettes).")
+    parser.add_argument("--replay", default=None, metavar="NAME", help="Replay the cassette of the runner NAME (or a cassette file) offline, then exit.")
     args = parser.parse_args()
     asyncio.run(main(args))
@@ -0,0 +1,62 @@
+import os
+import time
+from typing import Optional
+
+from .usage import Usage
+
+# Limits and the usage counter each one applies to
+LIMITS = {
+    'tokens': 'total_tokens',
+    'dollars': 'total_dollars',
+    'turns': 'turns',
+    'seconds': None,
+}
+
+class BudgetExceeded(Exception):
+    pass
+
+class Budget:
+    '''Limits on the usage of a session or of an agent and its sub-agents.
+
+    A budget also answers for the budgets it is nested in: a sub-agent can't spend more
+    than what is left to its supervisors.
+    '''
+
+    def __init__(self, name: str, usage: Usage, limits: Optional[dict] = None, parent: Optional['Budget'] = None):
+        self.name = name
+        self.usage = usage
+        self.limits = {key: value for key, value in (limits or {}).items() if value}
+        self.parent = parent
+        self.start = time.monotonic()
+
+    @staticmethod
+    def limits_from_env(prefix: str) -> dict:
+        '''Limits from {prefix}_TOKENS, {prefix}_DOLLARS, {prefix}_TURNS and {prefix}_SECONDS.'''
+        return {key: float(os.environ[f'{prefix}_{key.upper()}']) for key in LIMITS if os.getenv(f'{prefix}_{key.upper()}')}
+
+    def used(self, key: str) -> float:
+        counter = LIMITS[key]
+        return self.usage[counter] if counter else time.monotonic() - self.start
+
+    def chain(self):
+        budget = self
+        while budget is not None:
+            yield budget
+            budget = budget.parent
+
+    def check(self, prompt_tokens: int = 0):
+        '''Raise BudgetExceeded if this budget or one it is nested in is spent, counting the tokens of the next prompt.'''
+        for budget in self.chain():
+            for key, limit in budget.limits.items():
+                used = budget.used(key) + (prompt_tokens if key == 'tokens' else 0)
+                if used >= limit:
+                    raise BudgetExceeded(f"the {key} budget of {budget.name} is exhausted ({used:g} of {limit:g})")
+
+    def remaining(self) -> dict:
+        '''What is left of each limit, the tightest along the chain.'''
+        remaining = {}
+        for budget in self.chain():
+            for key, limit in budget.limits.items():
+                left = max(limit - budget.used(key), 0)
+                remaining[key] = min(remaining.get(key, left), left)
+        return remaining
@@ -0,0 +1,170 @@
+import contextvars
+import functools
+import hashlib
+import importlib
+import json
+import os
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from .journal import Journal
+from .tracing import current_span
+
+T = TypeVar('T')
+
+CASSETTE_DIR = os.getenv('CASSETTE_DIR', '.cassettes')
+# Record a cassette for every runner
+CASSETTE_RECORD = os.getenv('CASSETTE_RECORD', '') not in ('', '0', 'false')
+# Replaying fails on the first request that wasn't recorded, rather than taking the next recorded one
+CASSETTE_STRICT = os.getenv('CASSETTE_STRICT', '') not in ('', '0', 'false')
+
+class CassetteMiss(Exception):
+    pass
+
+class Cassette:
+    '''External I/O of a runner, recorded to replay the session offline.
+
+    Completions, images, searches, fetched pages, human input and the results of RUN and
+    PYTHON are written as they happen, one JSONL record each. When replaying, a request
+    gets the response recorded for the same request; failing that (e.g. after a prompt
+    change), the next unused response of the same kind for the same agent, which is
+    counted as a mismatch. Responses for identical requests are replayed in their
+    recorded order. A call that failed is recorded with its error, raised again on replay.
+    '''
+
+    def __init__(self, path: str, replay: bool = False, strict: bool = CASSETTE_STRICT):
+        self.path = path
+        self.replaying = replay
+        self.strict = strict
+        self.counters = {'recorded': 0, 'replayed': 0, 'mismatched': 0, 'missing': 0}
+        self.journal: Optional[Journal] = None
+        self.by_key: dict[tuple[str, str], deque[dict]] = {}
+        self.by_agent: dict[tuple[str, str], deque[dict]] = {}
+        self.header: dict = {}
+        if replay:
+            for record in Journal.read(path):
+                if record['type'] == 'runner':
+                    self.header = record
+                    continue
+                record['used'] = False
+                self.by_key.setdefault((record['type'], record['key']), deque()).append(record)
+                self.by_agent.setdefault((record['type'], record['agent']), deque()).append(record)
+        else:
+            self.journal = Journal(path)
+
+    @staticmethod
+    def path_for(name: str) -> str:
+        '''Cassette of the runner `name`, or `name` itself if it is a file.'''
+        if os.path.isfile(name):
+            return name
+        return os.path.join(os.getcwd(), CASSETTE_DIR, f'{name}.jsonl')
+
+    @staticmethod
+    def key(request) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def agent() -> str:
+        span = current_span.get()
+        return span.agent if span else ''
+
+    def start(self, **data):
+        if self.journal:
+            self.journal.record('runner', **data)
+
+    def record(self, kind: str, request, response=None, label: Optional[str] = None, error: Optional[Exception] = None):
+        if self.journal is None:
+            return
+        self.counters['recorded'] += 1
+        if error is not None:
+            cls = type(error)
+            self.journal.record(kind, key=Cassette.key(request), agent=Cassette.agent(), label=label,
+                                error={'module': cls.__module__, 'type': cls.__qualname__, 'message': str(error)})
+        else:
+            self.journal.record(kind, key=Cassette.key(request), agent=Cassette.agent(), label=label, response=response)
+
+    @staticmethod
+    def _error(error: dict) -> Exception:
+        '''An exception equivalent to a recorded one: same class and message.'''
+        try:
+            cls = functools.reduce(getattr, error['type'].split('.'), importlib.import_module(error['module']))
+        except (ImportError, AttributeError):
+            cls = None
+        if not (isinstance(cls, type) and issubclass(cls, Exception)):
+            return RuntimeError(f"{error['type']}: {error['message']}")
+        try:
+            return cls(error['message'])
+        except Exception:
+            # its constructor wants more than a message (e.g. the response of a failed request)
+            exc = cls.__new__(cls)
+            Exception.__init__(exc, error['message'])
+            return exc
+
+    @staticmethod
+    def _take(records: Optional[deque]) -> Optional[dict]:
+        while records:
+            record = records.popleft()
+            if not record['used']:
+                record['used'] = True
+                return record
+        return None
+
+    def replay(self, kind: str, request, label: Optional[str] = None) -> Any:
+        '''The recorded response to a request, raising CassetteMiss if there is none, or its recorded error.'''
+        agent = Cassette.agent()
+        record = Cassette._take(self.by_key.get((kind, Cassette.key(request))))
+        if record is None:
+            if self.strict:
+                self.counters['missing'] += 1
+                raise CassetteMiss(f"no recorded {kind} for {label or request!r}")
+            record = Cassette._take(self.by_agent.get((kind, agent)))
+            if record is None:
+                self.counters['missing'] += 1
+                raise CassetteMiss(f"no recorded {kind} left for agent {agent or 'main'}")
+            self.counters['mismatched'] += 1
+            print(f"[CASSETTE] {kind} of {agent or 'main'} differs from the recording: {label!r} replayed as {record.get('label')!r}")
+        self.counters['replayed'] += 1
+        if 'error' in record:
+            raise Cassette._error(record['error'])
+        return record['response']
+
+    async def close(self):
+        if self.journal:
+            await self.journal.close()
+
+    def stats(self) -> dict:
+        return {**self.counters, 'mode': 'replay' if self.replaying else 'record',
+                'unused': sum(not r['used'] for records in self.by_agent.values() for r in records)}
+
+# Cassette of the runner of the running task
+current_cassette: contextvars.ContextVar[Optional[Cassette]] = contextvars.ContextVar('current_cassette', default=None)
+# Set while a recorded call runs: the calls it makes are part of its response
+_recording: contextvars.ContextVar[bool] = contextvars.ContextVar('_recording', default=False)
+
+async def record_call(kind: str, request, call: Callable[[], Awaitable[T]], label: Optional[str] = None) -> T:
+    '''Run `call`, or replay its result, through the current cassette if any. `request` identifies the call.'''
+    cassette = current_cassette.get()
+    if cassette is None or _recording.get():
+        return await call()
+    if cassette.replaying:
+        return cassette.replay(kind, request, label)
+    token = _recording.set(True)
+    try:
+        response = await call()
+    except Exception as e:
+        cassette.record(kind, request, label=label, error=e)
+        raise
+    finally:
+        _recording.reset(token)
+    cassette.record(kind, request, response, label)
+    return response
+
+def recorded(kind: str):
+    '''Record or replay an async function through the current cassette, identified by its arguments.'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            label = ' '.join(str(a) for a in (*args, *kwargs.values()))[:200]
+            return await record_call(kind, {'args': args, 'kwargs': kwargs}, lambda: fn(*args, **kwargs), label)
+        return wrapper
+    return decorator
@@ -1,56 +1,92 @@
-from typing import Optional
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterable, Optional
+import asyncio
 import os
+import time
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
-import openai
 
-aclient = AsyncOpenAI()
-from openai import AsyncOpenAI
-from openai.types import CompletionUsage, ImagesResponse
-from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall, ChatCompletion
+from .budget import Budget
+from .cassette import current_cassette, recorded
+from .completion_cache import CompletionCache
+from .context_window import ContextWindow
+from .rate_limit import openai_scheduler
+from .resources import tracked
+from .tracing import span
+from .usage import Usage, usage_ledger
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, AsyncStream
+    from openai.types import CompletionUsage, ImagesResponse
+    from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
-aclient = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 load_dotenv()
-# TODO: The 'openai.organization' option isn't read in the client API. You will need to pass it when you instantiate the client, e.g. 'OpenAI(organization=os.getenv("OPENAI_ORG_ID"))'
-# openai.organization = os.getenv("OPENAI_ORG_ID")
 
-def get_price(model: str, usage: dict) -> float:
-    PRICE_PER_MTOKEN_PROMPT = .03 if model.startswith('gpt-4') else 2.
-    PRICE_PER_MTOKEN_COMPLETION = .06 if model.startswith('gpt-4') else 2.
-    return (usage['prompt_tokens'] * PRICE_PER_MTOKEN_PROMPT + usage['completion_tokens'] * PRICE_PER_MTOKEN_COMPLETION) / 1000000.
+MAX_COMPLETION_TOKENS = 1000
+# The model list is refreshed in the background when older than this
+MODELS_TTL = float(os.getenv('MODELS_TTL', 3600))
+
+_client: Optional['AsyncOpenAI'] = None
+
+def get_client() -> 'AsyncOpenAI':
+    '''The OpenAI client, created on first use: importing openai takes a while.'''
+    global _client
+    if _client is None:
+        from openai import AsyncOpenAI
+        # retries are left to openai_scheduler
+        _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
 
-total_usage = {}
-models = None
+def set_client(client: Optional['AsyncOpenAI']):
+    '''Use another client, e.g. one pointed at a local server; None recreates the default one on next use.'''
+    global _client
+    _client = client
+
+models: list[str] = []
+models_updated = 0.
+_models_task: Optional[asyncio.Task] = None
+completion_cache: Optional[CompletionCache] = CompletionCache.from_env()
+
+def set_completion_cache(path: Optional[str], max_mb: int = 256):
+    global completion_cache
+    completion_cache = CompletionCache(path, max_mb * 1024 * 1024) if path else None
 
 def get_total_usage():
-    tot_usage = {
-        'prompt_tokens': 0,
-        'completion_tokens': 0,
-        'total_tokens': 0,
-        'total_dollars': 0,
-    }
-    for usage in total_usage.values():
-        for key, value in usage.items():
-            tot_usage[key] += value
-    return tot_usage
-
-async def get_model_list():
-    global models
-    if models is None:
-        m = await aclient.models.list()
+    return usage_ledger.total.snapshot()
+
+async def fetch_model_list():
+    global models, models_updated
+    try:
+        # the client is created in a thread, so that importing openai doesn't block the loop
+        client = await asyncio.to_thread(get_client)
+        m = await client.models.list()
         models = sorted([model.id for model in m.data if model.id.startswith('gpt')], reverse=True)
+        models_updated = time.monotonic()
+    except Exception as e:
+        print(f"[WARN] Couldn't fetch the model list: {e}")
+
+def refresh_model_list() -> asyncio.Task:
+    '''Fetch the model list in the background, unless it is already being fetched.'''
+    global _models_task
+    if _models_task is None or _models_task.done():
+        _models_task = asyncio.create_task(fetch_model_list())
+    return _models_task
+
+def get_model_list() -> list[str]:
+    '''The cached model list, empty until first fetched. Refreshes it in the background when stale.'''
+    if not models or time.monotonic() - models_updated > MODELS_TTL:
+        refresh_model_list()
     return models
 
+@recorded('image')
 async def generate_image(prompt: str):
     print('Generate image:', prompt)
-    response: ImagesResponse = await aclient.images.generate(prompt=prompt,
+    response: 'ImagesResponse' = await get_client().images.generate(prompt=prompt,
         n=1,
         size="1024x1024")
     print(response)
     return response.data[0].url
 
 class ChatSession:
-    def __init__(self, model: str='gpt-4o', system_prompt: Optional[str | list[str]]=None, functions: dict={}):
+    def __init__(self, model: str='gpt-4o', system_prompt: Optional[str | list[str]]=None, functions: dict={}, stream: bool=False, on_delta: Optional[Callable[[dict], Awaitable]]=None, on_change: Optional[Callable[[str, dict], None]]=None, accounts: Iterable[Usage]=(), budget: Optional[Budget]=None, priority: int=0):
         self.model = model
         self.messages: list[dict] = []
         self.functions = [{
@@ -63,6 +99,15 @@ class ChatSession:
             'completion_tokens': 0,
             'total_tokens': 0
         }
+        self.stream = stream
+        self.on_delta = on_delta
+        self.on_change = on_change
+        # usage counters this session is charged to, besides its model's
+        self.accounts = list(accounts)
+        self.budget = budget
+        # requests with a lower priority number are sent first when rate limited
+        self.priority = priority
+        self.context_window = ContextWindow(model, max_tokens=MAX_COMPLETION_TOKENS)
         if system_prompt:
             if isinstance(system_prompt, list):
                 for prompt in system_prompt:
@@ -70,64 +115,175 @@ class ChatSession:
             else:
                 self.messages.append({"role": "system", "content": system_prompt})
 
+    def add_usage(self, usage: 'CompletionUsage', latency: Optional[float] = None):
+        print(usage)
+        self.charge(usage.prompt_tokens, usage.completion_tokens, latency)
+        print('Total:', usage_ledger.total.snapshot())
+
+    def charge(self, prompt_tokens: int, completion_tokens: int, latency: Optional[float] = None):
+        self.usage['prompt_tokens'] += prompt_tokens
+        self.usage['completion_tokens'] += completion_tokens
+        self.usage['total_tokens'] += prompt_tokens + completion_tokens
+        usage_ledger.record(self.model, prompt_tokens, completion_tokens, self.accounts, latency)
+
+    def compact(self) -> Optional[dict]:
+        stats = self.context_window.fit(self.messages)
+        if stats:
+            usage_ledger.count(self.model, 'context_tokens_saved', stats['saved'], self.accounts)
+            self.changed('compact', {'messages': self.messages, 'stats': stats})
+        return stats
+
+    def changed(self, kind: str, data: dict):
+        if self.on_change:
+            self.on_change(kind, data)
+
+    def append(self, message: dict):
+        self.messages.append(message)
+        self.changed('message', {'message': message})
+
+    async def complete(self) -> dict:
+        kwargs = {'functions': self.functions} if self.functions else {}
+        start = time.monotonic()
+        response: 'ChatCompletion' = await get_client().chat.completions.create(model=self.model,
+            messages=self.messages,
+            max_tokens=MAX_COMPLETION_TOKENS,
+            **kwargs)
+        print('Chat: completion END', response)
+        self.add_usage(response.usage, time.monotonic() - start)
+
+        rmsg = response.choices[0].message
+        dmsg = {
+            'role': rmsg.role,
+            'content': rmsg.content,
+        }
+        if rmsg.function_call:
+            print('Function call:', rmsg.function_call)
+            dmsg['function_call'] = {
+                'name': rmsg.function_call.name,
+                'arguments': rmsg.function_call.arguments
+            }
+        return dmsg
+
+    async def complete_stream(self) -> dict:
+        '''Same as complete, forwarding content and function call deltas to on_delta as they arrive.'''
+        kwargs = {'functions': self.functions} if self.functions else {}
+        start = time.monotonic()
+        response: 'AsyncStream[ChatCompletionChunk]' = await get_client().chat.completions.create(model=self.model,
+            messages=self.messages,
+            max_tokens=MAX_COMPLETION_TOKENS,
+            stream=True,
+            stream_options={'include_usage': True},
+            **kwargs)
+        role = 'assistant'
+        content = []
+        function_name = None
+        function_args = []
+        # closed even if a chunk fails or the reply is cancelled, releasing the connection
+        async with response:
+            async for chunk in response:
+                if chunk.usage:
+                    # the usage comes with the last chunk
+                    self.add_usage(chunk.usage, time.monotonic() - start)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.role:
+                    role = delta.role
+                update = {}
+                if delta.content:
+                    content.append(delta.content)
+                    update['content'] = delta.content
+                if delta.function_call:
+                    function_call = {}
+                    if delta.function_call.name:
+                        function_name = (function_name or '') + delta.function_call.name
+                        function_call['name'] = delta.function_call.name
+                    if delta.function_call.arguments:
+                        function_args.append(delta.function_call.arguments)
+                        function_call['arguments'] = delta.function_call.arguments
+                    if function_call:
+                        update['function_call'] = function_call
+                if update and self.on_delta:
+                    await self.on_delta(update)
+
+        dmsg = {
+            'role': role,
+            'content': ''.join(content) if content else None,
+        }
+        if function_name:
+            print('Function call:', function_name)
+            dmsg['function_call'] = {
+                'name': function_name,
+                'arguments': ''.join(function_args)
+            }
+        return dmsg
+
     async def chat(self, message: Optional[str] = None, role: str = "user"):
         print('Chat:', message)
         if message:
             self.add_message(message, role)
-        retry = 3
-        while retry:
-            try:
-                if self.functions:
-                    response: ChatCompletion = await aclient.chat.completions.create(model=self.model,
-                        messages=self.messages,
-                        functions=self.functions,
-                        max_tokens=1000)
-                else:
-                    response: ChatCompletion = await aclient.chat.completions.create(model=self.model,
-                        messages=self.messages,
-                        max_tokens=1000)
-                print('Chat: await aclient.chat.completions END', response)
-
-                usage: CompletionUsage = response.usage
-                print(usage)
-                mtot = total_usage.setdefault(self.model, {})
-                for key in self.usage.keys():
-                    #print(key, val)
-                    #self.usage[key] += usage[key]
-                    val = getattr(usage, key)
-                    self.usage[key] += val
-                    mtot[key] = mtot.get(key, 0) + val
-                    #mtot['total_tokens'] = mtot.get('total_tokens', 0) + usage['total_tokens']
-                    #mtot[key] = mtot.get(key, 0) + usage[key]
-                mtot['total_dollars'] = get_price(self.model, mtot)
-                print('Total:', total_usage)
-
-                rmsg = response.choices[0].message
-                dmsg = {
-                    'role': rmsg.role,
-                    'content': rmsg.content,
-                    #'function': rmsg.tool_calls
-                }
-                if rmsg.function_call:
-                    print('Function call:', rmsg.function_call)
-                    dmsg['function_call'] = {
-                        'name': rmsg.function_call.name,
-                        'arguments': rmsg.function_call.arguments
-                    }
-                self.messages.append(dmsg)
+        self.compact()
+        prompt_tokens = self.context_window.total(self.messages)
+        if self.budget:
+            self.budget.check(prompt_tokens)
+        usage_ledger.count(self.model, 'turns', 1, self.accounts)
+        cassette = current_cassette.get()
+        if cassette:
+            request = {'model': self.model, 'messages': self.messages, 'functions': self.functions}
+            label = str(self.messages[-1].get('content'))[:200] if self.messages else None
+        if cassette and cassette.replaying:
+            response = cassette.replay('completion', request, label)
+            self.charge(*response['usage'])
+            dmsg = response['message']
+        else:
+            used = (self.usage['prompt_tokens'], self.usage['completion_tokens'])
+            dmsg = await self.respond(prompt_tokens)
+            if cassette:
+                usage = [self.usage['prompt_tokens'] - used[0], self.usage['completion_tokens'] - used[1]]
+                cassette.record('completion', request, {'message': dmsg, 'usage': usage}, label)
+        self.append(dmsg)
+        return dmsg
+
+    async def respond(self, prompt_tokens: int) -> dict:
+        '''The next assistant message, from the completion cache or the API.'''
+        cache = completion_cache
+        key = cache.key(self.model, self.messages, self.functions) if cache else None
+        if cache:
+            dmsg = await cache.get(key)
+            if dmsg is not None:
+                print('Chat: cache hit', key)
+                usage_ledger.count(self.model, 'cache_hits', 1, self.accounts)
                 return dmsg
-            except openai.OpenAIError as e:
-                print("Error: OpenAI API Error", e)
-                retry -= 1
-                if retry == 0:
-                    raise e
+            usage_ledger.count(self.model, 'cache_misses', 1, self.accounts)
+        async def on_retry():
+            if self.stream and self.on_delta:
+                await self.on_delta({'reset': True})
+        async def request():
+            import openai
+            with span('completion', 'openai', model=self.model, prompt_tokens=prompt_tokens, stream=self.stream), tracked('completion', self.model):
+                try:
+                    return await (self.complete_stream() if self.stream else self.complete())
+                except openai.OpenAIError as e:
+                    print("Error: OpenAI API Error", e)
+                    usage_ledger.record_error(self.model, e, self.accounts)
+                    raise
+        estimate = prompt_tokens + MAX_COMPLETION_TOKENS
+        used = self.usage['total_tokens']
+        try:
+            dmsg = await openai_scheduler.submit(request, estimate, self.priority, on_retry)
+        finally:
+            # what the request used, nothing if it failed
+            openai_scheduler.refund(estimate - (self.usage['total_tokens'] - used))
+        if cache:
+            await cache.put(key, dmsg)
+        return dmsg
 
     def add_message(self, message: str, role: str = "user", name: Optional[str] = None) -> dict:
         if name:
             msg = {"role": role, "content": message, "name": name}
         else:
             msg = {"role": role, "content": message}
-        self.messages.append(msg)
+        self.append(msg)
         return msg
 
     def last_message(self):
@@ -1,21 +1,48 @@
 
 import asyncio
 import json
-import subprocess
+import os
 
+from .cassette import record_call
 from .search import search, get_wikipedia_data
 from .scrape import scrapeText
 from .chat import generate_image
+from .kernel import kernel_pool
+from .retrieval import chunk_ranker, split_chunks
+from .shell import PERSISTENT_SHELL
+from .tracing import span
+from .usage import usage_ledger
+
+# How GET handles content over the retrieval budget: 'rank' keeps its most relevant parts,
+# 'map-reduce' has every part read by its own search agent and their findings merged
+GET_MODE = os.getenv('GET_MODE', 'rank')
+# Search agents reading parts at the same time, and parts read at most (the most relevant ones)
+GET_MAP_CONCURRENCY = int(os.getenv('GET_MAP_CONCURRENCY', 4))
+GET_MAP_MAX_PARTS = int(os.getenv('GET_MAP_MAX_PARTS', 16))
 
 class AgentParseError(Exception):
     pass
 
+def count_saved(agent, stats: dict):
+    '''Charge the prompt tokens kept out of the search agent's context to the agent asking.'''
+    saved = stats['tokens_in'] - stats['tokens_out']
+    if stats['chunks']:
+        print(f"[RETRIEVAL] kept {stats['selected']} of {stats['chunks']} chunks, {stats['tokens_out']} of {stats['tokens_in']} tokens")
+    if saved:
+        usage_ledger.count(agent.chat_session.model, 'retrieval_tokens_saved', saved, agent.chat_session.accounts)
+
 async def search_callback(agent, args):
     print(f"QUERY: {args}")
     source = args.get('source')
     query = args['query']
     results = await search(query=query, source=source)
     print(f"RESULTS: {results}")
+    index = recall_index(agent)
+    if index is not None and isinstance(results, list):
+        await index.add_items(f'{source}:{query}', results)
+    if isinstance(results, list):
+        results, stats = await chunk_ranker.select_items(results, query, agent.chat_session.context_window.count_text)
+        count_saved(agent, stats)
     return json.dumps(results, indent=2)
     # agent_id = f'search_agent_{query}'
     # result = await agent.handle_agent_assign(agent_id, args.get('request'), [json.dumps(results, indent=4)], role='search')
@@ -26,18 +53,113 @@ async def get_callback(agent, args):
     print(f"GET: {args}")
     source = args.get('source')
     url = args['id']
-    if source == 'web':
+    key = url if source == 'web' else f'wikipedia:{url}'
+    index = recall_index(agent)
+    results = index.document(key) if index is not None else None
+    if results is not None:
+        print(f"[RECALL] {key} was fetched already")
+        results = f"(Fetched earlier, rebuilt from the recall index: the page's layout and blank lines are lost.)\n{results}"
+    elif source == 'web':
         results = await scrapeText(url)
     else: #elif source == 'wikipedia':
         results = await get_wikipedia_data(url)
     
     print(f"RESULTS: {results}")
+    if index is not None and isinstance(results, str):
+        await index.add(key, results)
     if results is None:
         return 'No results found.'
-    result = await agent.handle_agent_assign('search_agent', args.get('request'), [results], role='search')
+    if not isinstance(results, str):
+        results = json.dumps(results, indent=2)
+    request = args.get('request') or ''
+    count = agent.chat_session.context_window.count_text
+    if GET_MODE == 'map-reduce' and count(results) > chunk_ranker.budget:
+        result = await map_reduce(agent, request, results)
+    else:
+        results, stats = await chunk_ranker.select(results, request, count)
+        count_saved(agent, stats)
+        result = await agent.handle_agent_assign('search_agent', request, [results], role='search')
     print(f"RESULT: {result}")
     return result
 
+def recall_index(agent):
+    '''Index of what the agents of the runner fetched, if the agent runs in one.'''
+    return getattr(getattr(agent, 'context', None), 'recall_index', None)
+
+async def recall_callback(agent, args):
+    print(f"RECALL: {args}")
+    index = recall_index(agent)
+    results = await index.search(args['query'], int(args.get('count') or 5)) if index is not None else []
+    if not results:
+        return 'Nothing fetched so far matches this query, use SEARCH or GET.'
+    return '\n\n'.join(f"[{i + 1}] {r['source']} (score {r['score']})\n{r['text']}" for i, r in enumerate(results))
+
+def completed_content(result) -> str:
+    '''The content of a sub-agent's COMPLETE call.'''
+    try:
+        return str(json.loads(result)['content'])
+    except (TypeError, ValueError, KeyError):
+        return str(result)
+
+def group_pieces(pieces: list[str], count, budget: int) -> list[str]:
+    '''Consecutive pieces joined into groups of up to `budget` tokens, without splitting any.'''
+    groups, current, used = [], [], 0
+    for piece in pieces:
+        size = count(piece)
+        if current and used + size > budget:
+            groups.append('\n\n'.join(current))
+            current, used = [], 0
+        current.append(piece)
+        used += size
+    if current:
+        groups.append('\n\n'.join(current))
+    return groups
+
+async def map_reduce(agent, request: str, text: str) -> str:
+    '''Have each part of a long text read by a search agent, a few at a time, then merge their findings.
+
+    Findings too long to be merged at once are merged in groups first, until they fit. If
+    they still don't, the most relevant ones are kept.
+    '''
+    count = agent.chat_session.context_window.count_text
+    budget = chunk_ranker.budget
+    parts = split_chunks(text, budget)
+    if len(parts) > GET_MAP_MAX_PARTS:
+        # BM25 over every part takes a while on a large page: not on the event loop
+        ranked = await asyncio.to_thread(chunk_ranker.rank, parts, request)
+        kept = set(ranked[:GET_MAP_MAX_PARTS])
+        skipped = sum(count(part) for i, part in enumerate(parts) if i not in kept)
+        count_saved(agent, {'tokens_in': skipped, 'tokens_out': 0, 'chunks': len(parts), 'selected': len(kept)})
+        parts = [part for i, part in enumerate(parts) if i in kept]
+    semaphore = asyncio.Semaphore(GET_MAP_CONCURRENCY)
+    async def assign(name: str, task: str, content: str) -> str:
+        async with semaphore:
+            finding = completed_content(await agent.handle_agent_assign(name, task, [content], role='search'))
+        if count(finding) > budget:
+            finding, stats = await chunk_ranker.select(finding, request, count)
+            count_saved(agent, stats)
+        return finding
+    print(f"[MAP] {len(parts)} parts")
+    findings = await asyncio.gather(*(
+        assign('map_agent', f"{request}\nThis is part {i + 1} of {len(parts)} of the document. Report what it contains "
+               "that is relevant, or that it contains nothing relevant.", part)
+        for i, part in enumerate(parts)))
+    while True:
+        pieces = [f"Part {i + 1}:\n{finding}" for i, finding in enumerate(findings)]
+        groups = group_pieces(pieces, count, budget)
+        # stop when merging in groups no longer shrinks the findings
+        if len(groups) <= 1 or len(groups) >= len(findings):
+            break
+        print(f"[REDUCE] {len(findings)} findings in {len(groups)} groups")
+        findings = await asyncio.gather(*(
+            assign('reduce_agent', f"{request}\nMerge these findings from parts of a document, keeping everything relevant.", group)
+            for group in groups))
+    if len(groups) > 1:
+        pieces, stats = await chunk_ranker.select_items(pieces, request, count)
+        count_saved(agent, stats)
+    return await agent.handle_agent_assign('reduce_agent', f"{request}\nThe document was read in {len(parts)} parts. "
+                                           "Answer from the findings of each part.", ['\n\n'.join(pieces)], role='search')
+
 async def draw_callback(agent, args):
     print(f"DRAW: {args}")
     prompt = args['description']
@@ -49,7 +171,7 @@ async def write_callback(agent, args):
     file_name = args['filename']
     content = args.get('content', '')
     try:
-        with open(file_name, 'w') as file:
+        with open(os.path.join(agent.cwd, file_name), 'w') as file:
             file.write(content)
         print(f"[SUCCESS] Successfully wrote to {file_name}")
         return f"Wrote {len(content)} bytes to {file_name}"
@@ -64,11 +186,35 @@ async def request_callback(agent, args):
     await agent.get_human_input(request)
 
 async def assign_callback(agent, args):
-    return await agent.handle_agent_assign(args['agent_id'], args['content'])
+    after = args.get('after') or []
+    if isinstance(after, str):
+        after = [name.strip() for name in after.split(',') if name.strip()]
+    return await agent.handle_agent_assign(args['agent_id'], args['content'], wait=not args.get('background'), after=after)
+
+async def wait_callback(agent, args):
+    print(f"WAIT: {args}")
+    tasks = getattr(agent.context, 'tasks', None)
+    if tasks is None:
+        return 'Sub-agents run one at a time here, ASSIGN returns their result.'
+    names = args.get('agent_ids') or tasks.uncollected(agent)
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    if not names:
+        return 'All the results of sub-agents were given already.'
+    timeout = args.get('timeout')
+    results = await tasks.wait(agent, names, float(timeout) if timeout else None)
+    for name, result in results.items():
+        try:
+            results[name] = json.loads(result)
+        except (TypeError, ValueError):
+            pass
+    return json.dumps(results, indent=2)
 
 async def run_callback(agent, args):
     print(f"RUN: {args}")
-    return await agent.handle_agent_process(args['content'] if type(args) is dict else args)
+    command = args['content'] if type(args) is dict else args
+    # the runner directory differs between a recording and its replay
+    return await record_call('run', {'command': command}, lambda: agent.handle_agent_process(command, agent.cwd), command)
 
 async def python_callback(agent, args):
     content = args['content']
@@ -77,27 +223,15 @@ async def python_callback(agent, args):
         print("No Python code provided.")
         return
 
-    process = await asyncio.create_subprocess_exec(
-        "ipython",
-        "--no-banner",
-        "--no-confirm-exit",
-        "--no-term-title",
-        "--quiet",
-        "--colors=NoColor",
-        "--InteractiveShell.xmode=Plain",
-        "-c",
-        content,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = await process.communicate()
-    return_code = process.returncode
+    stdout, stderr = agent.output_captures('python')
+    async def execute():
+        with span('python', 'kernel', lines=content.count('\n') + 1):
+            return await kernel_pool.execute(agent, content, agent.cwd, stdout, stderr)
+    return_code, stdout, stderr = await record_call('python', {'code': content}, execute, content)
     if return_code == 0:
-        #print(f"Python code output:\n{stdout.decode('utf-8')}")
-        return stdout.decode('utf-8')
+        return stdout
     else:
-        #print(f"Error ({return_code}): {stderr.decode('utf-8') or stdout.decode('utf-8')}")
-        return stderr.decode('utf-8') or stdout.decode('utf-8')
+        return stderr or stdout
 
 
 async def complete_callback(agent, args):
@@ -177,13 +311,41 @@ commands = [
                 "content": {
                     "type": "string",
                     "description": "A complete description of the task to assign to the agent. Note that the agent won't have access to any other information or context about the task."
+                },
+                "background": {
+                    "type": "boolean",
+                    "description": "Return the agent's id immediately instead of waiting for its result, to run other tasks meanwhile. Get the result with WAIT."
+                },
+                "after": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Ids of agents assigned before, whose results this task needs: the agent starts once they complete, with their results."
                 }
             },
             "required": ["agent_id", "content"],
         },
-        "description": "Assign a task to another independent agent. Provide an id and a detailed description of the task including all required context for the agent, because the agent won't have access to any other information.",
+        "description": "Assign a task to another independent agent. Provide an id and a detailed description of the task including all required context for the agent, because the agent won't have access to any other information. Assign independent tasks in the background to run them at the same time.",
         "callback": assign_callback,
     },
+    {
+        "name": "WAIT",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "agent_ids": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Ids of the agents assigned in the background to wait for (default: all the ones whose result wasn't given yet)"
+                },
+                "timeout": {
+                    "type": "number",
+                    "description": "Seconds to wait at most, agents still running after it are reported as such"
+                }
+            },
+        },
+        "description": "Wait for agents assigned in the background to complete, and get their results.",
+        "callback": wait_callback,
+    },
     {
         "name": "RUN",
         "parameters": {
@@ -196,7 +358,7 @@ commands = [
             },
             "required": ["content"],
         },
-        "description": "Run one or more shell command and get the output. Note that the shell is reset between each invocation.",
+        "description": "Run one or more shell command and get the output. " + ("The shell is kept between invocations (working directory, variables)." if PERSISTENT_SHELL else "Note that the shell is reset between each invocation."),
         "callback": run_callback,
     },
     {
@@ -211,7 +373,7 @@ commands = [
             },
             "required": ["content"],
         },
-        "description": "Run code or commands in an IPython shell (python 3.11). Use it to perform calculations, text manipulation, or other operations. The shell is reset between each invocation.",
+        "description": "Run code or commands in an IPython shell (python 3.11). Use it to perform calculations, text manipulation, or other operations. " + ("Variables and imports are kept between invocations." if kernel_pool.stateful else "The shell is reset between each invocation."),
         "callback": python_callback,
     },
     {
@@ -238,6 +400,25 @@ commands = [
         "example": "QUERY google\nParis",
         "callback": search_callback,
     },
+    {
+        "name": "RECALL",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "What to look for",
+                },
+                "count": {
+                    "type": "integer",
+                    "description": "The number of passages to return (default 5)",
+                }
+            },
+            "required": ["query"],
+        },
+        "description": "Search the pages, wikipedia articles and search results already fetched by any agent of this session, and get the most relevant passages with their source. It is instant and doesn't go online: use it before SEARCH or GET.",
+        "callback": recall_callback,
+    },
     {
         "name": "GET",
         "parameters": {
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Optional
+
+class CompletionCache:
+    '''Content-addressed on-disk cache of chat completions, with a size cap and LRU eviction.
+
+    Entries are stored as one JSON file per key. Recency is tracked in memory and
+    persisted through the files' modification time, so the LRU order survives restarts.
+    '''
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def from_env() -> Optional['CompletionCache']:
+        path = os.getenv('COMPLETION_CACHE_DIR')
+        if not path:
+            return None
+        return CompletionCache(path, int(os.getenv('COMPLETION_CACHE_MB', 256)) * 1024 * 1024)
+
+    @staticmethod
+    def key(model: str, messages: list[dict], functions: list[dict]) -> str:
+        data = json.dumps({'model': model, 'messages': messages, 'functions': functions}, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f'{key}.json')
+
+    def _load(self):
+        files = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith('.json'):
+                    st = os.stat(os.path.join(root, name))
+                    files.append((st.st_mtime, name[:-5], st.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+    def _read(self, key: str) -> Optional[dict]:
+        file = self._file(key)
+        try:
+            with open(file, 'r') as f:
+                data = json.load(f)
+            os.utime(file)
+            return data
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _write(self, key: str, data: str):
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # a name of its own: another process may be writing the same entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(tmp, file)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _remove(self, keys: list[str]):
+        for key in keys:
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+
+    async def get(self, key: str) -> Optional[dict]:
+        data = None
+        if key in self.entries:
+            data = await asyncio.to_thread(self._read, key)
+            if data is None:
+                self.size -= self.entries.pop(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, value: dict):
+        data = json.dumps(value)
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError as e:
+            print(f"[WARN] Could not write to the completion cache: {e}")
+            return
+        size = len(data.encode())
+        self.size -= self.entries.pop(key, 0)
+        self.entries[key] = size
+        self.size += size
+        evicted = []
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            old_key, size = self.entries.popitem(last=False)
+            self.size -= size
+            evicted.append(old_key)
+        if evicted:
+            self.evictions += len(evicted)
+            await asyncio.to_thread(self._remove, evicted)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
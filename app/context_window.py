@@ -0,0 +1,192 @@
+import os
+from typing import Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Context size of known models, matched by prefix (longest first)
+MODEL_CONTEXT = {
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo-16k': 16385,
+    'gpt-3.5-turbo': 16385,
+}
+DEFAULT_CONTEXT = 8192
+
+# Upper bound on prompt tokens sent per request, regardless of the model's context size
+MAX_PROMPT_TOKENS = int(os.getenv('MAX_PROMPT_TOKENS', 32000))
+
+MESSAGE_OVERHEAD = 4
+
+def get_context_size(model: str) -> int:
+    for prefix in sorted(MODEL_CONTEXT, key=len, reverse=True):
+        if model.startswith(prefix):
+            return MODEL_CONTEXT[prefix]
+    return DEFAULT_CONTEXT
+
+def get_encoder(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+class ContextWindow:
+    '''Keep a chat history within a per-model token budget.
+
+    Token counts are cached per message. When the history grows over budget, older
+    messages are compacted: long contents are truncated first, then whole turns are
+    replaced by a short note. Leading system prompts, the first user message (the goal)
+    and the latest function call/result pair are always kept.
+    '''
+
+    def __init__(self, model: str, max_tokens: int = 1000, budget: Optional[int] = None, truncate_tokens: int = 256, target: float = .75):
+        self.model = model
+        self.encoder = get_encoder(model)
+        self.budget = budget or min(get_context_size(model) - max_tokens, MAX_PROMPT_TOKENS)
+        self.truncate_tokens = truncate_tokens
+        self.target = target
+        self.compactions: list[dict] = []
+        self._tokens: dict[int, tuple[dict, int]] = {}
+
+    @property
+    def tokens_saved(self) -> int:
+        return sum(c['saved'] for c in self.compactions)
+
+    def count_text(self, text) -> int:
+        if not text:
+            return 0
+        if not isinstance(text, str):
+            text = str(text)
+        if self.encoder:
+            return len(self.encoder.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+    def count(self, message: dict) -> int:
+        cached = self._tokens.get(id(message))
+        if cached and cached[0] is message:
+            return cached[1]
+        tokens = MESSAGE_OVERHEAD + self.count_text(message.get('content')) + self.count_text(message.get('name'))
+        function_call = message.get('function_call')
+        if function_call:
+            tokens += self.count_text(function_call.get('name')) + self.count_text(function_call.get('arguments'))
+        self._tokens[id(message)] = (message, tokens)
+        return tokens
+
+    def total(self, messages: list[dict]) -> int:
+        return sum(self.count(m) for m in messages)
+
+    def protected(self, messages: list[dict]) -> set[int]:
+        '''Indices of the messages that are never compacted.'''
+        keep = set()
+        i = 0
+        while i < len(messages) and messages[i]['role'] == 'system':
+            keep.add(i)
+            i += 1
+        for j in range(i, len(messages)):
+            if messages[j]['role'] == 'user':
+                keep.add(j)
+                break
+        # latest function call and the messages answering it
+        for j in range(len(messages) - 1, -1, -1):
+            if messages[j].get('function_call'):
+                keep.update(range(j, len(messages)))
+                break
+        else:
+            keep.add(len(messages) - 1)
+        return keep
+
+    def truncate(self, message: dict) -> dict:
+        content = message.get('content')
+        if not isinstance(content, str) or self.count_text(content) <= self.truncate_tokens:
+            return message
+        # keep the head and tail of the content, using the token estimate to pick the cut
+        chars = self.truncate_tokens * 2
+        if self.encoder:
+            tokens = self.encoder.encode(content, disallowed_special=())
+            half = self.truncate_tokens // 2
+            head, tail = self.encoder.decode(tokens[:half]), self.encoder.decode(tokens[-half:])
+            removed = len(tokens) - 2 * half
+        else:
+            head, tail = content[:chars], content[-chars:]
+            removed = self.count_text(content[chars:-chars])
+        if removed <= 0:
+            return message
+        msg = dict(message)
+        msg['content'] = f"{head}\n[... {removed} tokens truncated ...]\n{tail}"
+        return msg
+
+    def fit(self, messages: list[dict]) -> Optional[dict]:
+        '''Compact `messages` in place if they exceed the budget. Returns the compaction stats, if any.'''
+        before = self.total(messages)
+        if before <= self.budget:
+            return None
+        target = int(self.budget * self.target)
+        keep = self.protected(messages)
+        current = before
+        truncated = 0
+
+        # 1. truncate long contents, oldest first
+        for i, message in enumerate(messages):
+            if current <= target:
+                break
+            if i in keep:
+                continue
+            short = self.truncate(message)
+            if short is not message:
+                current += self.count(short) - self.count(message)
+                messages[i] = short
+                truncated += 1
+
+        # 2. drop whole turns (a message and the function results answering it), oldest first
+        dropped = []
+        if current > target:
+            i = 0
+            while i < len(messages) and current > target:
+                if i in keep:
+                    i += 1
+                    continue
+                j = i + 1
+                while j < len(messages) and j not in keep and messages[j]['role'] == 'function':
+                    j += 1
+                dropped.append((i, j))
+                current -= sum(self.count(m) for m in messages[i:j])
+                i = j
+        if dropped:
+            removed = [m for i, j in dropped for m in messages[i:j]]
+            calls = {}
+            for m in removed:
+                if m.get('function_call'):
+                    name = m['function_call'].get('name')
+                    calls[name] = calls.get(name, 0) + 1
+            summary = ', '.join(f"{name} x{n}" for name, n in calls.items())
+            note = {'role': 'system', 'content': f"[{len(removed)} earlier messages removed to fit the context window{': ' + summary if summary else ''}]"}
+            first = dropped[0][0]
+            drop = {k for i, j in dropped for k in range(i, j)}
+            compacted = []
+            for k, m in enumerate(messages):
+                if k == first:
+                    compacted.append(note)
+                if k not in drop:
+                    compacted.append(m)
+            messages[:] = compacted
+            current += self.count(note)
+        self._tokens = {id(m): (m, self.count(m)) for m in messages}
+
+        stats = {
+            'before': before,
+            'after': current,
+            'saved': before - current,
+            'truncated': truncated,
+            'dropped': sum(j - i for i, j in dropped),
+        }
+        self.compactions.append(stats)
+        print(f"[CONTEXT] compacted {self.model} history: {before} -> {current} tokens ({truncated} truncated, {stats['dropped']} dropped)")
+        return stats
@@ -0,0 +1,101 @@
+import asyncio
+import os
+from typing import Optional
+import aiohttp
+
+class ClientManager:
+    '''Process-wide aiohttp client with keep-alive connection pooling and DNS caching.'''
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 8, dns_ttl: int = 300, keepalive: float = 30.,
+                 connect_timeout: float = 10., read_timeout: float = 30., total_timeout: float = 60.):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.counters = {
+            'requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0,
+            'errors': 0,
+        }
+
+    @staticmethod
+    def from_env() -> 'ClientManager':
+        return ClientManager(
+            limit=int(os.getenv('HTTP_POOL_LIMIT', 100)),
+            limit_per_host=int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 8)),
+            connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', 10)),
+            read_timeout=float(os.getenv('HTTP_READ_TIMEOUT', 30)),
+            total_timeout=float(os.getenv('HTTP_TOTAL_TIMEOUT', 60)))
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        def count(key):
+            async def handler(session, ctx, params):
+                self.counters[key] += 1
+            return handler
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(count('requests'))
+        trace.on_request_exception.append(count('errors'))
+        trace.on_connection_create_end.append(count('connections_created'))
+        trace.on_connection_reuseconn.append(count('connections_reused'))
+        trace.on_dns_cache_hit.append(count('dns_cache_hits'))
+        trace.on_dns_cache_miss.append(count('dns_cache_misses'))
+        return trace
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._loop is not loop:
+            # left by a previous event loop (tests, asyncio.run called again)
+            await self._discard(self._session, self._loop)
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, trace_configs=[self._trace_config()])
+            self._loop = loop
+        return self._session
+
+    @staticmethod
+    async def _discard(session: aiohttp.ClientSession, loop: Optional[asyncio.AbstractEventLoop]):
+        '''Close a session of another event loop: on that loop if it still runs, here otherwise.'''
+        try:
+            if loop is not None and loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), loop))
+            else:
+                await session.close()
+        except RuntimeError as e:
+            # its connections went down with their loop
+            print(f"[WARN] Couldn't close the HTTP session of a previous event loop: {e}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def session(self) -> aiohttp.ClientSession:
+        '''The shared session, created on first use when the manager wasn't started explicitly.'''
+        return await self.start()
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats['limit'] = self.limit
+        stats['limit_per_host'] = self.limit_per_host
+        stats['connections_in_use'] = stats['connections_idle'] = 0
+        connector = self._session.connector if self._session else None
+        if connector is not None:
+            # aiohttp doesn't expose pool occupancy publicly: None if its internals changed
+            try:
+                stats['connections_in_use'] = len(connector._acquired)
+                stats['connections_idle'] = sum(len(c) for c in connector._conns.values())
+            except (AttributeError, TypeError):
+                stats['connections_in_use'] = stats['connections_idle'] = None
+        return stats
+
+http_client = ClientManager.from_env()
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+class Journal:
+    '''Append-only JSONL journal of a runner.
+
+    Records are queued without blocking and written in batches by a background task,
+    which fsyncs the file in a worker thread.
+    '''
+
+    def __init__(self, path: str, flush_interval: float = .2):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending: list[str] = []
+        self.records = 0
+        self.batches = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def record(self, type: str, **data):
+        line = json.dumps({'type': type, 't': time.time(), **data}, default=str)
+        with self._lock:
+            self.pending.append(line)
+        self.records += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (e.g. at interpreter exit): write synchronously
+            self._write()
+            return
+        if self._writer is None or self._writer.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._writer = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def _write(self):
+        # taking the pending records under the write lock keeps batches in order
+        with self._write_lock:
+            with self._lock:
+                lines, self.pending = self.pending, []
+            if not lines:
+                return
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.batches += 1
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # let records accumulate into one batch
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.to_thread(self._write)
+
+    async def flush(self):
+        '''Write all pending records now.'''
+        await asyncio.to_thread(self._write)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+        await self.flush()
+
+    @staticmethod
+    def read(path: str) -> list[dict]:
+        records = []
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # torn write at the end of the file
+                    print(f"[WARN] Skipping invalid journal line in {path}")
+        return records
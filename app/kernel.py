@@ -0,0 +1,246 @@
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from typing import Optional
+
+from .output import OutputCapture
+from .process import StreamClosed, get_rss, kill_process_group, read_until
+from .resources import RUNNER_ENV, current_resources, process_env, track_process
+
+DRIVER = os.path.join(os.path.dirname(__file__), 'kernel_driver.py')
+
+class KernelError(Exception):
+    pass
+
+class Kernel:
+    '''A long-lived Python process running cells in a persistent namespace.'''
+
+    def __init__(self, preload: Optional[str] = None, memory_limit: int = 0):
+        self.preload = preload
+        self.memory_limit = memory_limit
+        self.marker = f'__kernel_{uuid.uuid4().hex}__'.encode()
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.cwd: Optional[str] = None
+        self.runner = ''
+        self.startup_time = 0.
+        self.executions = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        start = time.monotonic()
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-u', DRIVER, self.marker.decode(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # pooled kernels belong to no runner until leased
+            env=process_env(),
+            start_new_session=True)
+        await self._wait_done(None)
+        if self.preload:
+            await self.execute(f'import {self.preload}', None)
+        self.startup_time = time.monotonic() - start
+
+    async def _wait_done(self, timeout: Optional[float], stdout: Optional[OutputCapture] = None, stderr: Optional[OutputCapture] = None) -> tuple[int, str, str]:
+        stdout = stdout or OutputCapture()
+        stderr = stderr or OutputCapture()
+        try:
+            (_, status), _ = await asyncio.wait_for(asyncio.gather(
+                read_until(self.process.stdout, self.marker, stdout.write),
+                read_until(self.process.stderr, self.marker, stderr.write)), timeout)
+        except StreamClosed:
+            await self.kill()
+            raise KernelError('the kernel died')
+        except asyncio.TimeoutError:
+            await self.kill()
+            raise KernelError(f'execution timed out after {timeout}s')
+        finally:
+            await stdout.flush()
+            await stderr.flush()
+        return int(status or 0), stdout.text(), stderr.text()
+
+    async def _watch_memory(self):
+        while self.alive:
+            rss = get_rss(self.process.pid)
+            if rss and rss > self.memory_limit:
+                print(f"[KERNEL] {self.process.pid} uses {rss >> 20} MiB, over the {self.memory_limit >> 20} MiB limit")
+                kill_process_group(self.process)
+                return
+            await asyncio.sleep(.5)
+
+    async def execute(self, code: str, timeout: Optional[float], stdout: Optional[OutputCapture] = None, stderr: Optional[OutputCapture] = None) -> tuple[int, str, str]:
+        '''Run a cell. Returns (status, stdout, stderr), raises KernelError if the kernel died or timed out.'''
+        if not self.alive:
+            raise KernelError('the kernel is not running')
+        async with self.lock:
+            data = code.encode()
+            self.process.stdin.write(f'{len(data)}\n'.encode() + data)
+            await self.process.stdin.drain()
+            watcher = asyncio.create_task(self._watch_memory()) if self.memory_limit else None
+            try:
+                result = await self._wait_done(timeout, stdout, stderr)
+            except KernelError as e:
+                if watcher and watcher.done():
+                    raise KernelError('memory limit exceeded')
+                raise e
+            finally:
+                if watcher:
+                    watcher.cancel()
+            self.executions += 1
+            return result
+
+    async def chdir(self, path: str):
+        if path != self.cwd:
+            await self.execute(f'import os as __os; __os.chdir({path!r}); del __os', 10)
+            self.cwd = path
+
+    async def set_runner(self, runner: str):
+        '''Mark the processes the code of a runner starts as its own, for them to be reclaimed with it.'''
+        if runner != self.runner:
+            await self.execute(f'import os as __os; __os.environ[{RUNNER_ENV!r}] = {runner!r}; del __os', 10)
+            self.runner = runner
+
+    async def kill(self):
+        if self.process is not None:
+            kill_process_group(self.process)
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+
+
+class KernelPool:
+    '''Pre-started kernels, leased to agents.
+
+    In stateful mode, each agent keeps its kernel (and variables) across PYTHON calls
+    until it completes. In stateless mode, every call runs in a fresh warm kernel that
+    is discarded afterwards.
+    '''
+
+    def __init__(self, size: int = 2, stateful: bool = True, timeout: float = 120., memory_limit: int = 0, preload: Optional[str] = None):
+        self.size = size
+        self.stateful = stateful
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.preload = preload
+        self.idle: list[Kernel] = []
+        self.leased: dict[object, Kernel] = {}
+        self.starting = 0
+        self.startup_times: list[float] = []
+        self.counters = {'executions': 0, 'leases': 0, 'restarts': 0, 'timeouts': 0, 'cold_starts': 0}
+        self._fill_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def from_env() -> 'KernelPool':
+        return KernelPool(
+            size=int(os.getenv('PYTHON_KERNEL_POOL', 2)),
+            stateful=os.getenv('PYTHON_KERNEL_MODE', 'stateful') != 'stateless',
+            timeout=float(os.getenv('PYTHON_TIMEOUT', 120)),
+            memory_limit=int(os.getenv('PYTHON_MEMORY_MB', 2048)) * 1024 * 1024,
+            preload=os.getenv('PYTHON_PRELOAD') or None)
+
+    async def _new_kernel(self) -> Kernel:
+        kernel = Kernel(self.preload, self.memory_limit)
+        try:
+            await kernel.start()
+        except BaseException:
+            await kernel.kill()
+            raise
+        self.startup_times.append(kernel.startup_time)
+        del self.startup_times[:-100]
+        return kernel
+
+    async def _fill(self):
+        while len(self.idle) + self.starting < self.size:
+            self.starting += 1
+            try:
+                self.idle.append(await self._new_kernel())
+            except Exception as e:
+                print(f"[KERNEL] Failed to start a kernel: {e}")
+                return
+            finally:
+                self.starting -= 1
+
+    def refill(self):
+        if self._fill_task is None or self._fill_task.done():
+            self._fill_task = asyncio.create_task(self._fill())
+
+    async def start(self):
+        '''Pre-start the pool's kernels.'''
+        await self._fill()
+
+    async def _take(self) -> Kernel:
+        while self.idle:
+            kernel = self.idle.pop()
+            if kernel.alive:
+                self.refill()
+                return kernel
+        self.counters['cold_starts'] += 1
+        self.refill()
+        return await self._new_kernel()
+
+    async def lease(self, owner) -> Kernel:
+        kernel = self.leased.get(owner)
+        if kernel is None or not kernel.alive:
+            if kernel is not None:
+                self.counters['restarts'] += 1
+            kernel = self.leased[owner] = await self._take()
+            self.counters['leases'] += 1
+        return kernel
+
+    async def release(self, owner):
+        kernel = self.leased.pop(owner, None)
+        if kernel is not None:
+            await kernel.kill()
+
+    async def execute(self, owner, code: str, cwd: str, stdout: Optional[OutputCapture] = None, stderr: Optional[OutputCapture] = None) -> tuple[int, str, str]:
+        '''Run `code` for `owner` in `cwd`. Returns (status, stdout, stderr) like a subprocess would.'''
+        self.counters['executions'] += 1
+        kernel = await (self.lease(owner) if self.stateful else self._take())
+        try:
+            resources = current_resources.get()
+            if resources:
+                track_process(kernel.process, 'kernel')
+                await kernel.set_runner(resources.name)
+            await kernel.chdir(cwd)
+            return await kernel.execute(code, self.timeout, stdout, stderr)
+        except KernelError as e:
+            if 'timed out' in str(e):
+                self.counters['timeouts'] += 1
+            else:
+                self.counters['restarts'] += 1
+            self.leased.pop(owner, None)
+            state = ' All variables were lost.' if self.stateful else ''
+            return 1, stdout.text() if stdout else '', f'KernelError: {e}. The kernel was restarted.{state}'
+        finally:
+            if not self.stateful:
+                await kernel.kill()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'mode': 'stateful' if self.stateful else 'stateless',
+            'idle': len(self.idle),
+            'leased': len(self.leased),
+            'startup_avg': statistics.mean(self.startup_times) if self.startup_times else 0.,
+            'startup_p50': statistics.median(self.startup_times) if self.startup_times else 0.,
+            'startup_max': max(self.startup_times, default=0.),
+        }
+
+    async def close(self):
+        kernels = self.idle + list(self.leased.values())
+        self.idle, self.leased = [], {}
+        if self._fill_task:
+            self._fill_task.cancel()
+            await asyncio.gather(self._fill_task, return_exceptions=True)
+        await asyncio.gather(*[k.kill() for k in kernels + self.idle])
+        self.idle = []
+
+kernel_pool = KernelPool.from_env()
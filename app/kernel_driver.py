@@ -0,0 +1,51 @@
+'''Persistent Python kernel, run as a subprocess by app.kernel.
+
+Reads cells from stdin as "<length>\\n<code>", runs them in a shared namespace
+(through IPython when available) with output going to the real stdout/stderr, then
+writes the marker given as first argument on stderr, and the marker followed by
+the cell status (0 or 1) on stdout.
+'''
+import os
+import sys
+import traceback
+
+def main(marker: str):
+    control = sys.stdin.buffer
+    sys.stdin = open(os.devnull)
+    try:
+        from IPython.core.interactiveshell import InteractiveShell
+        shell = InteractiveShell.instance(colors='NoColor', xmode='Plain')
+    except ImportError:
+        shell = None
+    namespace = {'__name__': '__main__'}
+
+    def done(status: int):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stderr.write(f'\n{marker}\n')
+        sys.stderr.flush()
+        sys.stdout.write(f'\n{marker} {status}\n')
+        sys.stdout.flush()
+
+    done(0)
+    while True:
+        header = control.readline()
+        if not header:
+            break
+        code = control.read(int(header)).decode()
+        status = 0
+        if shell is not None:
+            result = shell.run_cell(code, store_history=False)
+            status = 0 if result.success else 1
+        else:
+            try:
+                exec(compile(code, '<cell>', 'exec'), namespace)
+            except SystemExit as e:
+                status = 0 if e.code in (None, 0) else 1
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+        done(status)
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,97 @@
+import codecs
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+# Output up to this size is returned verbatim, larger output is summarized
+OUTPUT_LIMIT = int(os.getenv('OUTPUT_LIMIT', 16 * 1024))
+OUTPUT_HEAD = int(os.getenv('OUTPUT_HEAD', 4 * 1024))
+OUTPUT_TAIL = int(os.getenv('OUTPUT_TAIL', 4 * 1024))
+LIVE_INTERVAL = .2
+
+class OutputCapture:
+    '''Bounded capture of a process output stream.
+
+    Output is kept in memory up to `limit` bytes. Past that, everything is written
+    to `spill_path` and only the head and a ring buffer of the tail stay in memory.
+    Decoded chunks are forwarded to `on_chunk` at most every LIVE_INTERVAL seconds.
+    '''
+
+    def __init__(self, spill_path: Optional[str] = None, on_chunk: Optional[Callable[[str], Awaitable]] = None,
+                 limit: int = OUTPUT_LIMIT, head: int = OUTPUT_HEAD, tail: int = OUTPUT_TAIL):
+        self.spill_path = spill_path
+        self.on_chunk = on_chunk
+        self.limit = limit
+        self.head_size = head
+        self.tail_size = tail
+        self.buffer = bytearray()
+        self.head = b''
+        self.tail: deque[bytes] = deque()
+        self.tail_len = 0
+        self.size = 0
+        self.spill = None
+        self.spilled = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.live: list[str] = []
+        self.last_live = 0.
+
+    async def write(self, data: bytes):
+        if not data:
+            return
+        self.size += len(data)
+        if not self.spilled:
+            self.buffer += data
+            if len(self.buffer) > self.limit:
+                self._start_spill()
+        else:
+            self._add_tail(data)
+            if self.spill:
+                self.spill.write(data)
+        if self.on_chunk:
+            self.live.append(self.decoder.decode(data))
+            if time.monotonic() - self.last_live >= LIVE_INTERVAL:
+                await self.flush()
+
+    def _start_spill(self):
+        self.spilled = True
+        self.head = bytes(self.buffer[:self.head_size])
+        self._add_tail(bytes(self.buffer[self.head_size:]))
+        if self.spill_path:
+            try:
+                os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+                self.spill = open(self.spill_path, 'wb')
+                self.spill.write(self.buffer)
+            except OSError as e:
+                print(f"[WARN] Couldn't spill output to {self.spill_path}: {e}")
+                self.spill = None
+        self.buffer = bytearray()
+
+    def _add_tail(self, data: bytes):
+        self.tail.append(data)
+        self.tail_len += len(data)
+        while self.tail and self.tail_len - len(self.tail[0]) >= self.tail_size:
+            self.tail_len -= len(self.tail.popleft())
+
+    async def flush(self):
+        '''Forward pending live output.'''
+        self.last_live = time.monotonic()
+        text = ''.join(self.live)
+        self.live = []
+        if text and self.on_chunk:
+            await self.on_chunk(text)
+
+    def close(self):
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+
+    def text(self) -> str:
+        '''The captured output, or its head and tail with the location of the full output if it was too large.'''
+        self.close()
+        if not self.spilled:
+            return self.buffer.decode(errors='replace')
+        tail = b''.join(self.tail)[-self.tail_size:]
+        omitted = self.size - len(self.head) - len(tail)
+        where = f"full output ({self.size} bytes) saved to {self.spill_path}" if self.spill_path else f"{self.size} bytes in total"
+        return f"{self.head.decode(errors='replace')}\n[... {omitted} bytes omitted, {where} ...]\n{tail.decode(errors='replace')}"
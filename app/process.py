@@ -0,0 +1,70 @@
+import asyncio
+import os
+import signal
+from typing import Awaitable, Callable, Optional
+
+CHUNK_SIZE = 64 * 1024
+
+class StreamClosed(Exception):
+    '''The stream ended before the expected marker was read.'''
+    def __init__(self, data: bytes):
+        super().__init__('stream closed')
+        self.data = data
+
+async def read_until(stream: asyncio.StreamReader, marker: bytes, sink: Optional[Callable[[bytes], Awaitable]] = None) -> tuple[bytes, bytes]:
+    '''Read `stream` until `marker` followed by a newline.
+
+    Data before the marker (without the newline written right before it) is passed to `sink`
+    as it arrives, or returned if there is no sink. Returns the data and the rest of the marker line.
+    '''
+    collected = bytearray()
+    async def emit(data):
+        if data:
+            if sink:
+                await sink(bytes(data))
+            else:
+                collected.extend(data)
+    buffer = bytearray()
+    while True:
+        index = buffer.find(marker)
+        if index >= 0:
+            end = buffer.find(b'\n', index)
+            if end >= 0:
+                await emit(buffer[:index - 1 if buffer[index - 1:index] == b'\n' else index])
+                return bytes(collected), bytes(buffer[index + len(marker):end]).strip()
+        elif len(buffer) > len(marker):
+            # keep enough to find a marker split across reads, and the newline before it
+            await emit(buffer[:-len(marker)])
+            del buffer[:-len(marker)]
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
+            await emit(buffer)
+            raise StreamClosed(bytes(collected))
+        buffer += chunk
+
+async def read_to_end(stream: asyncio.StreamReader, sink: Callable[[bytes], Awaitable]):
+    while chunk := await stream.read(CHUNK_SIZE):
+        await sink(chunk)
+
+def kill_process_group(process: asyncio.subprocess.Process, sig: int = signal.SIGKILL):
+    '''Kill a process started with start_new_session=True, and everything it spawned.'''
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        try:
+            process.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+def get_rss(pid: int) -> Optional[int]:
+    '''Resident memory of a process in bytes, if it can be read.'''
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
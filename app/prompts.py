@@ -67,11 +67,11 @@ AGENT_TYPES={
     },
     'searcher': {
         'prompt': [purpose_searcher],
-        'commands': ['SEARCH', 'GET', 'COMPLETE']
+        'commands': ['RECALL', 'SEARCH', 'GET', 'COMPLETE']
     },
     'engineer': {
         'prompt': [purpose_engineer],
-        'commands': ['WRITE', 'RUN', 'PYTHON', 'ASSIGN', 'REQUEST', 'COMPLETE']
+        'commands': ['WRITE', 'RUN', 'PYTHON', 'ASSIGN', 'WAIT', 'REQUEST', 'COMPLETE']
     },
 }
 
@@ -0,0 +1,247 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import os
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+@functools.cache
+def retryable() -> tuple[type[Exception], ...]:
+    '''Errors worth retrying: rate limits, timeouts, connection errors and server errors.'''
+    # openai is imported when the first request fails rather than at startup
+    import openai
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+class TokenBucket:
+    '''Allows `rate` units per minute, in bursts of up to a minute's worth.'''
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = rate
+        self.level = rate
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate / 60.)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        '''Seconds until `amount` is available, 0 if it is now.'''
+        if not self.rate:
+            return 0.
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0. if self.level >= amount else (amount - self.level) * 60. / self.rate
+
+    def take(self, amount: float):
+        if self.rate:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        if self.rate:
+            self.level = min(self.capacity, self.level + amount)
+
+def retry_after(error: Exception) -> Optional[float]:
+    '''Delay asked for by the server, in seconds.'''
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000.
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+class RequestScheduler:
+    '''Process-wide admission of OpenAI requests.
+
+    Requests wait for room in the request and token buckets, highest priority first
+    (lowest number: the main agents go before their sub-agents). Failed requests are
+    retried with exponential backoff and jitter, or after the delay the server asked for,
+    which also holds back all other requests. After `breaker_threshold` consecutive failures,
+    the breaker opens and requests are held for `breaker_cooldown` seconds, then a single
+    one is let through to probe the API.
+    '''
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, max_retries: int = 5, base_delay: float = 1., max_delay: float = 60.,
+                 breaker_threshold: int = 5, breaker_cooldown: float = 30.):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.failures = 0
+        self.open_until = 0.
+        self.probing = False
+        self.paused_until = 0.
+        self.waiters: list[tuple[int, int, float, asyncio.Future]] = []
+        self.order = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.counters = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'errors': 0, 'breaker_opened': 0, 'wait_time': 0.}
+
+    @staticmethod
+    def from_env() -> 'RequestScheduler':
+        return RequestScheduler(
+            rpm=float(os.getenv('OPENAI_RPM', 500)),
+            tpm=float(os.getenv('OPENAI_TPM', 200000)),
+            max_retries=int(os.getenv('OPENAI_MAX_RETRIES', 5)),
+            breaker_threshold=int(os.getenv('OPENAI_BREAKER_THRESHOLD', 5)),
+            breaker_cooldown=float(os.getenv('OPENAI_BREAKER_COOLDOWN', 30)))
+
+    @property
+    def breaker(self) -> str:
+        if self.failures < self.breaker_threshold:
+            return 'closed'
+        return 'open' if time.monotonic() < self.open_until else 'half-open'
+
+    def _wait_time(self, tokens: float) -> float:
+        now = time.monotonic()
+        breaker = self.breaker
+        if breaker == 'open':
+            return self.open_until - now
+        if breaker == 'half-open' and self.probing:
+            # wait for the probe to succeed or fail
+            return 1.
+        return max(self.paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens), 0.)
+
+    async def _dispatch(self):
+        while self.waiters:
+            priority, order, tokens, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            wait = self._wait_time(tokens)
+            if wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.waiters)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            if self.breaker == 'half-open':
+                self.probing = True
+            future.set_result(None)
+
+    async def _admit(self, tokens: float, priority: int):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), tokens, future))
+        if self._dispatcher is None or self._dispatcher.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        else:
+            self._wakeup.set()
+        start = time.monotonic()
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # admitted, but cancelled before it could go: let another request probe
+                self._abandon()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            self.counters['wait_time'] += time.monotonic() - start
+
+    def _success(self):
+        self.failures = 0
+        self.probing = False
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _abandon(self):
+        # the request ended without telling whether the API is back: let another one probe it
+        self.probing = False
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _failure(self):
+        self.failures += 1
+        if self.probing or self.failures == self.breaker_threshold:
+            self.counters['breaker_opened'] += 1
+            self.open_until = time.monotonic() + self.breaker_cooldown
+            print(f"[RATE LIMIT] {self.failures} failures in a row, holding requests for {self.breaker_cooldown}s")
+        self.probing = False
+        if self._wakeup:
+            self._wakeup.set()
+
+    def backoff(self, attempt: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(.5, 1.)
+
+    async def submit(self, call: Callable[[], Awaitable[T]], tokens: float = 0, priority: int = 0,
+                     on_retry: Optional[Callable[[], Awaitable]] = None) -> T:
+        '''Run `call` once admitted, retrying it on transient errors. `tokens` is the estimated cost of the request,
+        taken from the token bucket once whatever the number of attempts.'''
+        attempt = 0
+        while True:
+            # the estimate is taken once: a failed attempt didn't use it
+            await self._admit(tokens if not attempt else 0, priority)
+            self.counters['requests'] += 1
+            try:
+                result = await call()
+            except Exception as e:
+                if not isinstance(e, retryable()):
+                    # not the API's availability: don't count it against the breaker
+                    self._abandon()
+                    self.counters['errors'] += 1
+                    raise
+                self._failure()
+                delay = retry_after(e)
+                if getattr(e, 'status_code', None) == 429:
+                    self.counters['rate_limited'] += 1
+                    # everyone waits, not only this request
+                    self.paused_until = max(self.paused_until, time.monotonic() + (delay or self.backoff(attempt)))
+                if attempt >= self.max_retries:
+                    self.counters['errors'] += 1
+                    raise
+                delay = delay if delay is not None else self.backoff(attempt)
+                print(f"[RATE LIMIT] {type(e).__name__}, retrying in {delay:.1f}s")
+                attempt += 1
+                self.counters['retries'] += 1
+                if on_retry:
+                    await on_retry()
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # cancelled while in flight
+                self._abandon()
+                raise
+            self._success()
+            return result
+
+    def refund(self, tokens: float):
+        '''Give back tokens estimated for a request that used fewer.'''
+        if tokens > 0:
+            self.tokens.refund(tokens)
+            if self._wakeup:
+                self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'waiting': len(self.waiters),
+            'breaker': self.breaker,
+            'request_budget': self.requests.level,
+            'token_budget': self.tokens.level,
+        }
+
+openai_scheduler = RequestScheduler.from_env()
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import threading
+import zlib
+from typing import Optional
+
+from .retrieval import split_chunks, tokenize
+
+# Size of the hashed term vectors: collisions are rare well below it
+RECALL_DIMENSIONS = int(os.getenv('RECALL_DIMENSIONS', 2 ** 18))
+RECALL_CHUNK_TOKENS = int(os.getenv('RECALL_CHUNK_TOKENS', 200))
+# Chunks indexed per runner, content fetched past it isn't indexed
+RECALL_MAX_CHUNKS = int(os.getenv('RECALL_MAX_CHUNKS', 20000))
+
+def hash_terms(text: str, dimensions: int) -> list[int]:
+    '''Buckets of the words and word pairs of a text.'''
+    words = tokenize(text)
+    terms = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+    # crc32 rather than hash(), which changes between processes
+    return [zlib.crc32(term.encode()) % dimensions for term in terms]
+
+class RecallIndex:
+    '''Everything the agents of a runner fetched, searchable without going online.
+
+    Pages, wikipedia extracts and search results are split into chunks, each stored as a
+    sparse hashed term vector: its buckets and their (log, L2 normalized) weights, in flat
+    NumPy arrays shared by all chunks. A query is scored against every chunk at once, its
+    terms weighted by how rare they are in the index.
+    '''
+
+    def __init__(self, dimensions: int = RECALL_DIMENSIONS, chunk_tokens: int = RECALL_CHUNK_TOKENS, max_chunks: int = RECALL_MAX_CHUNKS):
+        self.dimensions = dimensions
+        self.chunk_tokens = chunk_tokens
+        self.max_chunks = max_chunks
+        self.lock = threading.Lock()
+        # chunk text and the source it came from
+        self.texts: list[str] = []
+        self.sources: list[str] = []
+        # chunks of each indexed source, in order
+        self.documents: dict[str, list[int]] = {}
+        # sources indexed in part, the index being full: searchable, but not served as documents
+        self.truncated: set[str] = set()
+        self._buckets: list = []
+        self._weights: list = []
+        # flat arrays of all chunks, built on the first query after an addition
+        self._packed: Optional[tuple] = None
+        self._document_frequency = None
+        self.counters = {'documents': 0, 'chunks': 0, 'dropped': 0, 'queries': 0, 'hits': 0}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def _add(self, source: str, pieces: list[str]) -> int:
+        import numpy as np
+        with self.lock:
+            if source in self.documents or source in self.truncated:
+                return 0
+            if self._document_frequency is None:
+                self._document_frequency = np.zeros(self.dimensions, dtype=np.int32)
+            chunks = []
+            dropped = 0
+            for text in pieces:
+                if len(self.texts) >= self.max_chunks:
+                    dropped += 1
+                    continue
+                buckets, counts = np.unique(np.array(hash_terms(text, self.dimensions), dtype=np.uint32), return_counts=True)
+                if not len(buckets):
+                    continue
+                weights = (1 + np.log(counts)).astype(np.float32)
+                weights /= np.linalg.norm(weights)
+                self._document_frequency[buckets] += 1
+                self._buckets.append(buckets)
+                self._weights.append(weights)
+                chunks.append(len(self.texts))
+                self.texts.append(text)
+                self.sources.append(source)
+            if dropped:
+                self.truncated.add(source)
+            else:
+                self.documents[source] = chunks
+            self._packed = None
+            self.counters['dropped'] += dropped
+            self.counters['documents'] += 1
+            self.counters['chunks'] += len(chunks)
+            return len(chunks)
+
+    async def add(self, source: str, text: str) -> int:
+        '''Index a page once per source, returning the number of chunks added.'''
+        if not text or source in self.documents or source in self.truncated:
+            return 0
+        # hashing a long page takes a while
+        return await asyncio.to_thread(self._add, source, split_chunks(text, self.chunk_tokens))
+
+    async def add_items(self, source: str, items: list) -> int:
+        '''Index search results, one chunk each, under their link if they have one.'''
+        documents = []
+        for i, item in enumerate(items):
+            if isinstance(item, dict):
+                link = item.get('link') or item.get('url')
+                text = '\n'.join(str(value) for value in item.values() if isinstance(value, (str, int, float)))
+            else:
+                link, text = None, str(item)
+            # kept apart from the page itself, which GET indexes under its url
+            documents.append((f'result:{link}' if link else f'{source}#{i}', text))
+        return await asyncio.to_thread(lambda: sum(self._add(key, [text]) for key, text in documents))
+
+    def document(self, source: str) -> Optional[str]:
+        '''The indexed text of a source, if it was fetched already and fully indexed.
+
+        It is rebuilt from the chunks: blank lines and the spacing of the page are lost.
+        '''
+        chunks = self.documents.get(source)
+        return '\n'.join(self.texts[i] for i in chunks) if chunks else None
+
+    def _pack(self):
+        import numpy as np
+        if self._packed is None:
+            lengths = np.array([len(b) for b in self._buckets], dtype=np.int64)
+            offsets = np.zeros(len(lengths), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=offsets[1:])
+            self._packed = (np.concatenate(self._buckets), np.concatenate(self._weights), offsets)
+        return self._packed
+
+    def _search(self, query: str, k: int) -> list[dict]:
+        import numpy as np
+        with self.lock:
+            if not self.texts:
+                return []
+            buckets, counts = np.unique(np.array(hash_terms(query, self.dimensions), dtype=np.uint32), return_counts=True)
+            if not len(buckets):
+                return []
+            n = len(self.texts)
+            frequency = self._document_frequency[buckets]
+            idf = np.log(1 + (n - frequency + .5) / (frequency + .5))
+            vector = np.zeros(self.dimensions, dtype=np.float32)
+            vector[buckets] = (1 + np.log(counts)) * idf
+            all_buckets, all_weights, offsets = self._pack()
+            scores = np.add.reduceat(vector[all_buckets] * all_weights, offsets)
+            k = min(k, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [{'source': self.sources[i], 'score': round(float(scores[i]), 3), 'text': self.texts[i]}
+                    for i in top if scores[i] > 0]
+
+    async def search(self, query: str, k: int = 5) -> list[dict]:
+        '''The `k` chunks most similar to the query, best first.'''
+        results = await asyncio.to_thread(self._search, query, k)
+        self.counters['queries'] += 1
+        self.counters['hits'] += bool(results)
+        return results
+
+    def stats(self) -> dict:
+        size = sum(b.nbytes + w.nbytes for b, w in zip(self._buckets, self._weights))
+        return {**self.counters, 'vector_bytes': size,
+                'hit_rate': self.counters['hits'] / self.counters['queries'] if self.counters['queries'] else 0.}
@@ -0,0 +1,243 @@
+import asyncio
+import contextvars
+import itertools
+import os
+import signal
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+from .process import kill_process_group
+
+# Seconds between scans for leaked processes (0 to only reap when a runner ends)
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', 60))
+# Seconds stopped processes get to exit after SIGTERM, before SIGKILL
+KILL_GRACE = float(os.getenv('KILL_GRACE', 2))
+# Set in the environment of every child process, inherited by whatever it spawns
+SERVER_ENV = 'ARGENT_SERVER'
+RUNNER_ENV = 'ARGENT_RUNNER'
+
+def process_env(runner: Optional[str] = None) -> dict[str, str]:
+    '''Environment of a child process, marked with this server and the runner it belongs to.'''
+    return {**os.environ, SERVER_ENV: str(os.getpid()), RUNNER_ENV: runner or ''}
+
+def marked_processes() -> list[tuple[int, int, str]]:
+    '''Processes started by a server (pid, server pid, runner), found in /proc.'''
+    found = []
+    try:
+        pids = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return found
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/environ', 'rb') as f:
+                environ = f.read().split(b'\0')
+        except OSError:
+            continue
+        values = dict(item.split(b'=', 1) for item in environ if b'=' in item)
+        server = values.get(SERVER_ENV.encode())
+        if server and server.isdigit():
+            found.append((pid, int(server), values.get(RUNNER_ENV.encode(), b'').decode(errors='replace')))
+    return found
+
+def process_group(pid: int) -> Optional[int]:
+    try:
+        return os.getpgid(pid)
+    except OSError:
+        return None
+
+def signal_pids(pids: list[int], sig: int = signal.SIGKILL) -> int:
+    '''Send a signal to processes, returning how many got it.'''
+    sent = 0
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+            sent += 1
+        except (ProcessLookupError, PermissionError):
+            pass
+    return sent
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # exited, waiting for its parent to collect it
+            return f.read().rpartition(')')[2].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+async def pids_exited(pids: list[int], interval: float = .05):
+    '''Wait for processes that aren't our children to exit.'''
+    while any(pid_alive(pid) for pid in pids):
+        await asyncio.sleep(interval)
+
+class ResourceRegistry:
+    '''Processes and requests of a runner, reclaimed when it stops.
+
+    RUN shells and commands, and the python kernels leased by its agents, are killed with
+    their process group (SIGTERM, then SIGKILL after KILL_GRACE seconds). Completions and
+    fetches still in flight are cancelled. Processes that left their group (daemons, `setsid`)
+    are found by the mark they inherit in their environment.
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.processes: dict[int, tuple[str, asyncio.subprocess.Process]] = {}
+        self.requests: dict[int, tuple[str, str, asyncio.Task]] = {}
+        self._ids = itertools.count()
+        self.reclaimed: Counter = Counter()
+        reaper.live.add(name)
+
+    def env(self) -> dict[str, str]:
+        return process_env(self.name)
+
+    def add_process(self, process: asyncio.subprocess.Process, kind: str):
+        # forget the ones that exited
+        self.processes = {pid: entry for pid, entry in self.processes.items() if entry[1].returncode is None}
+        self.processes[process.pid] = (kind, process)
+
+    @contextmanager
+    def request(self, kind: str, label: str = ''):
+        '''Register the request the current task is waiting for.'''
+        task = asyncio.current_task()
+        if task is None:
+            yield
+            return
+        id = next(self._ids)
+        self.requests[id] = (kind, label, task)
+        try:
+            yield
+        finally:
+            del self.requests[id]
+
+    async def reclaim(self) -> dict:
+        '''Cancel the pending requests and kill the processes of the runner, returning what was reclaimed.'''
+        report: Counter = Counter()
+        current = asyncio.current_task()
+        for kind, label, task in list(self.requests.values()):
+            if task is not current and not task.done():
+                task.cancel()
+                report[f'{kind}_cancelled'] += 1
+        processes = [(kind, p) for kind, p in self.processes.values() if p.returncode is None]
+        self.processes = {}
+        # whatever they spawned outside their process group: it may keep their pipes open
+        groups = {p.pid for _, p in processes}
+        # scanning /proc takes a while with many processes
+        escaped = await asyncio.to_thread(lambda: [pid for pid in reaper.leaked(self.name) if process_group(pid) not in groups])
+        for kind, process in processes:
+            kill_process_group(process, signal.SIGTERM)
+            report[f'{kind}_killed'] += 1
+        report['leaked_killed'] += signal_pids(escaped, signal.SIGTERM)
+        if processes or escaped:
+            waits = [asyncio.create_task(p.wait()) for _, p in processes] + [asyncio.create_task(pids_exited(escaped))]
+            _, running = await asyncio.wait(waits, timeout=KILL_GRACE)
+            for kind, process in processes:
+                if process.returncode is None:
+                    kill_process_group(process)
+            signal_pids([pid for pid in escaped if pid_alive(pid)])
+            if running:
+                await asyncio.wait(running, timeout=KILL_GRACE)
+                for task in running:
+                    task.cancel()
+        report['killed_after_grace'] += await asyncio.to_thread(reaper.reap, self.name)
+        report = Counter({key: count for key, count in report.items() if count})
+        self.reclaimed.update(report)
+        if report:
+            print(f"[RESOURCES] {self.name} reclaimed: {dict(report)}")
+        return dict(report)
+
+    async def close(self):
+        try:
+            await self.reclaim()
+        finally:
+            # the reaper kills whatever is left if this was cancelled
+            reaper.live.discard(self.name)
+
+    def stats(self) -> dict:
+        return {
+            'processes': sum(1 for _, p in self.processes.values() if p.returncode is None),
+            'requests': Counter(kind for kind, _, _ in self.requests.values()),
+            'reclaimed': dict(self.reclaimed),
+        }
+
+class Reaper:
+    '''Kills the processes left behind by runners that ended, or by a server that died.'''
+
+    def __init__(self, interval: float = REAPER_INTERVAL):
+        self.interval = interval
+        # runners of this server still running
+        self.live: set[str] = set()
+        self.counters = {'scans': 0, 'killed': 0, 'last_scan_ms': 0.}
+        self._loop: Optional[asyncio.Task] = None
+
+    def leaked(self, runner: Optional[str] = None) -> list[int]:
+        '''Processes of `runner`, or of any runner that ended or server that died.'''
+        server = os.getpid()
+        leaked = []
+        for pid, owner, name in marked_processes():
+            if pid == server:
+                continue
+            if runner is not None:
+                if owner == server and name == runner:
+                    leaked.append(pid)
+            elif owner != server:
+                if not pid_alive(owner):
+                    leaked.append(pid)
+            # kernels waiting in the pool belong to no runner
+            elif name and name not in self.live:
+                leaked.append(pid)
+        return leaked
+
+    def reap(self, runner: Optional[str] = None) -> int:
+        start = time.perf_counter()
+        killed = signal_pids(self.leaked(runner))
+        self.counters['scans'] += 1
+        self.counters['killed'] += killed
+        self.counters['last_scan_ms'] = (time.perf_counter() - start) * 1000
+        if killed and runner is None:
+            print(f"[RESOURCES] reaped {killed} leaked processes")
+        return killed
+
+    async def _run(self):
+        while True:
+            await asyncio.to_thread(self.reap)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and (self._loop is None or self._loop.done()):
+            self._loop = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._loop:
+            self._loop.cancel()
+            await asyncio.gather(self._loop, return_exceptions=True)
+            self._loop = None
+
+    def stats(self) -> dict:
+        return {**self.counters, 'live_runners': len(self.live), 'interval': self.interval}
+
+reaper = Reaper()
+
+# Registry of the runner of the running task
+current_resources: contextvars.ContextVar[Optional[ResourceRegistry]] = contextvars.ContextVar('current_resources', default=None)
+
+def child_env() -> dict[str, str]:
+    '''Environment for a child process of the current runner.'''
+    resources = current_resources.get()
+    return resources.env() if resources else process_env()
+
+def track_process(process: asyncio.subprocess.Process, kind: str):
+    resources = current_resources.get()
+    if resources:
+        resources.add_process(process, kind)
+
+def tracked(kind: str, label: str = ''):
+    '''Register a request of the current runner for the duration of the block.'''
+    resources = current_resources.get()
+    return resources.request(kind, label) if resources else nullcontext()
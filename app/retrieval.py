@@ -0,0 +1,164 @@
+import asyncio
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Callable, Optional
+
+WORD = re.compile(r'\w+')
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+STOPWORDS = frozenset('''a an and are as at be by for from has have in is it its of on or that the this to was were will with
+what which who whom how when where why do does did not no can could should would about into than then there their'''.split())
+# Characters per token, to size chunks without encoding them
+CHARS_PER_TOKEN = 4
+
+def tokenize(text: str) -> list[str]:
+    return [w for w in WORD.findall(text.lower()) if w not in STOPWORDS]
+
+def split_chunks(text: str, chunk_tokens: int) -> list[str]:
+    '''Consecutive paragraphs grouped into chunks of about `chunk_tokens`, long paragraphs being split on sentences.'''
+    size = chunk_tokens * CHARS_PER_TOKEN
+    pieces = []
+    for paragraph in text.split('\n'):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= size:
+            pieces.append(paragraph)
+            continue
+        sentence = ''
+        for part in SENTENCE_END.split(paragraph):
+            while len(part) > size:
+                # no sentence boundary: cut on whitespace
+                cut = part.rfind(' ', 0, size)
+                cut = cut if cut > 0 else size
+                if sentence:
+                    pieces.append(sentence)
+                    sentence = ''
+                pieces.append(part[:cut])
+                part = part[cut:].lstrip()
+            if sentence and len(sentence) + len(part) + 1 > size:
+                pieces.append(sentence)
+                sentence = ''
+            sentence = f'{sentence} {part}' if sentence else part
+        if sentence:
+            pieces.append(sentence)
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > size:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n{piece}' if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def bm25(documents: list[list[str]], query: list[str], k1: float = 1.5, b: float = .75) -> list[float]:
+    '''Okapi BM25 score of each tokenized document for the query.'''
+    if not documents or not query:
+        return [0.] * len(documents)
+    average = sum(len(d) for d in documents) / len(documents) or 1.
+    frequencies = [Counter(d) for d in documents]
+    terms = set(query)
+    df = {t: sum(1 for f in frequencies if t in f) for t in terms}
+    idf = {t: math.log(1 + (len(documents) - n + .5) / (n + .5)) for t, n in df.items()}
+    scores = []
+    for document, frequency in zip(documents, frequencies):
+        norm = k1 * (1 - b + b * len(document) / average)
+        scores.append(sum(idf[t] * frequency[t] * (k1 + 1) / (frequency[t] + norm) for t in terms if t in frequency))
+    return scores
+
+class ChunkRanker:
+    '''Keeps the parts of fetched content most relevant to a request, within a token budget.
+
+    Content over the budget is split into chunks of about `chunk_tokens`, ranked by BM25
+    against the request, and the best chunks are kept, in their original order, with a
+    marker where content was left out. The first chunk breaks ties, as pages tend to
+    start with a summary.
+    '''
+
+    def __init__(self, budget: int = 3000, chunk_tokens: int = 200):
+        self.budget = budget
+        self.chunk_tokens = chunk_tokens
+        self.counters = {'requests': 0, 'ranked': 0, 'chunks': 0, 'selected': 0, 'tokens_in': 0, 'tokens_out': 0}
+
+    @staticmethod
+    def from_env() -> 'ChunkRanker':
+        return ChunkRanker(
+            budget=int(os.getenv('RETRIEVAL_TOKEN_BUDGET', 3000)),
+            chunk_tokens=int(os.getenv('RETRIEVAL_CHUNK_TOKENS', 200)))
+
+    def rank(self, chunks: list[str], query: str) -> list[int]:
+        '''Indices of the chunks, most relevant first.'''
+        scores = bm25([tokenize(c) for c in chunks], tokenize(query or ''))
+        return sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+
+    def _keep(self, pieces: list[str], query: str, count: Callable[[str], int], budget: int) -> list[int]:
+        '''Indices of the best pieces fitting in the budget, in their original order.'''
+        kept, used = [], 0
+        for i in self.rank(pieces, query):
+            size = count(pieces[i])
+            if used + size <= budget:
+                kept.append(i)
+                used += size
+        return sorted(kept)
+
+    def _select(self, text: str, query: str, count: Callable[[str], int], budget: int) -> tuple[str, dict]:
+        tokens = count(text)
+        stats = {'tokens_in': tokens, 'tokens_out': tokens, 'chunks': 0, 'selected': 0}
+        if tokens <= budget:
+            return text, stats
+        chunks = split_chunks(text, self.chunk_tokens)
+        kept = self._keep(chunks, query, count, budget)
+        parts = []
+        for n, i in enumerate(kept):
+            if i != (kept[n - 1] + 1 if n else 0):
+                parts.append('[...]')
+            parts.append(chunks[i])
+        if not kept or kept[-1] != len(chunks) - 1:
+            parts.append('[...]')
+        result = '\n'.join(parts)
+        stats.update(tokens_out=count(result), chunks=len(chunks), selected=len(kept))
+        return result, stats
+
+    def _select_items(self, items: list, query: str, count: Callable[[str], int], budget: int) -> tuple[list, dict]:
+        pieces = [json.dumps(item) for item in items]
+        tokens = sum(count(p) for p in pieces)
+        stats = {'tokens_in': tokens, 'tokens_out': tokens, 'chunks': 0, 'selected': 0}
+        if tokens <= budget:
+            return items, stats
+        kept = self._keep(pieces, query, count, budget)
+        stats.update(tokens_out=sum(count(pieces[i]) for i in kept), chunks=len(items), selected=len(kept))
+        return [items[i] for i in kept], stats
+
+    def _count(self, stats: dict):
+        self.counters['requests'] += 1
+        self.counters['ranked'] += stats['chunks'] > 0
+        for key in ('chunks', 'selected', 'tokens_in', 'tokens_out'):
+            self.counters[key] += stats[key]
+
+    async def select(self, text: str, query: str, count: Callable[[str], int], budget: Optional[int] = None) -> tuple[str, dict]:
+        '''The most relevant parts of `text` for `query`, within `budget` tokens as counted by `count`, and stats.'''
+        # tokenizing a long page takes a while
+        result, stats = await asyncio.to_thread(self._select, text, query, count, budget or self.budget)
+        self._count(stats)
+        return result, stats
+
+    async def select_items(self, items: list, query: str, count: Callable[[str], int], budget: Optional[int] = None) -> tuple[list, dict]:
+        '''Same as select, for a list of results ranked as a whole each.'''
+        result, stats = await asyncio.to_thread(self._select_items, items, query, count, budget or self.budget)
+        self._count(stats)
+        return result, stats
+
+    def stats(self) -> dict:
+        saved = self.counters['tokens_in'] - self.counters['tokens_out']
+        return {
+            **self.counters,
+            'budget': self.budget,
+            'tokens_saved': saved,
+            'tokens_saved_per_request': saved / self.counters['requests'] if self.counters['requests'] else 0.,
+        }
+
+chunk_ranker = ChunkRanker.from_env()
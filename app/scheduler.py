@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import time
+import traceback
+from collections import deque
+from typing import Awaitable, Callable
+
+class SessionScheduler:
+    '''Run up to `max_sessions` sessions concurrently, admitting waiting sessions in FIFO order.'''
+
+    def __init__(self, max_sessions: int = 4):
+        self.max_sessions = max(1, max_sessions)
+        self.sessions: dict[int, object] = {}
+        self.running: dict[int, dict] = {}
+        self.waiting: deque[tuple[int, asyncio.Future]] = deque()
+        self.metrics: dict[int, dict] = {}
+        self.completed = 0
+        self.total_wait = 0.
+        self._ids = itertools.count()
+
+    def queue_depth(self, key: int) -> int:
+        '''Position of the session in the admission queue (0 when running).'''
+        for i, (k, _) in enumerate(self.waiting):
+            if k == key:
+                return i + 1
+        return 0
+
+    def session_stats(self, key: int) -> dict:
+        m = self.metrics[key]
+        wait_time = m['wait_time'] if m['started'] is not None else time.monotonic() - m['enqueued']
+        return {
+            'queue_depth': self.queue_depth(key),
+            'wait_time': round(wait_time, 3),
+            'running': len(self.running),
+            'waiting': len(self.waiting),
+            'max_sessions': self.max_sessions,
+        }
+
+    def stats(self) -> dict:
+        return {
+            'running': len(self.running),
+            'waiting': len(self.waiting),
+            'max_sessions': self.max_sessions,
+            'completed': self.completed,
+            'avg_wait_time': self.total_wait / self.completed if self.completed else 0.,
+            'sessions': {key: self.session_stats(key) for key in self.metrics},
+        }
+
+    async def notify(self):
+        '''Send the current queue position and wait time to every known session.'''
+        for key, session in list(self.sessions.items()):
+            if session is None or key not in self.metrics:
+                continue
+            try:
+                await session.send_to_client({'queue': self.session_stats(key)})
+            except Exception:
+                traceback.print_exc()
+
+    async def acquire(self, key: int):
+        self.metrics[key] = {'enqueued': time.monotonic(), 'started': None, 'wait_time': 0.}
+        if len(self.running) < self.max_sessions and not self.waiting:
+            self._start(key)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((key, future))
+        print(f"Session {key} waiting for a slot ({len(self.waiting)} waiting, {len(self.running)} running)")
+        await self.notify()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if key in self.running:
+                # admitted right before being cancelled: hand the slot over
+                self.release(key)
+            else:
+                self.waiting = deque(item for item in self.waiting if item[0] != key)
+                self.metrics.pop(key, None)
+            raise
+
+    def _start(self, key: int):
+        m = self.metrics[key]
+        m['started'] = time.monotonic()
+        m['wait_time'] = m['started'] - m['enqueued']
+        self.running[key] = m
+
+    def release(self, key: int):
+        m = self.running.pop(key, None)
+        if m is not None:
+            self.completed += 1
+            self.total_wait += m['wait_time']
+        self.metrics.pop(key, None)
+        while self.waiting and len(self.running) < self.max_sessions:
+            next_key, future = self.waiting.popleft()
+            if future.done():
+                continue
+            self._start(next_key)
+            future.set_result(None)
+
+    async def run(self, session, coro_factory: Callable[[], Awaitable]):
+        '''Wait for a free slot, then run the coroutine created by `coro_factory`.'''
+        key = next(self._ids)
+        self.sessions[key] = session
+        try:
+            await self.acquire(key)
+            try:
+                await self.notify()
+                return await coro_factory()
+            finally:
+                self.release(key)
+                await self.notify()
+        finally:
+            self.sessions.pop(key, None)
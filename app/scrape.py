@@ -1,48 +1,132 @@
 import asyncio
-import aiohttp
-from urllib.parse import urlencode
-from bs4 import BeautifulSoup
+import importlib.util
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlencode, urljoin
+
+from .cassette import recorded
+from .http_client import http_client
+from .resources import tracked
+from .tracing import span
 
 UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5.1 Safari/605.1.15"
 
-async def get(url, params={}):
+# Downloads are truncated past this size
+MAX_DOWNLOAD_BYTES = int(os.getenv('SCRAPE_MAX_BYTES', 2 * 1024 * 1024))
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+TEXT_TYPES = ('text/plain',)
+
+def parse_bs4(html: str, parser: str) -> tuple[Optional[str], str]:
+    # imported on first use, it is slow to import and only needed by GET
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, parser)
+    amphtml = soup.find('link', {'rel': 'amphtml'})
+    article = soup.find('article')
+    return amphtml.get('href') if amphtml else None, (article or soup).text
+
+def parse_html_parser(html: str) -> tuple[Optional[str], str]:
+    return parse_bs4(html, 'html.parser')
+
+def parse_lxml(html: str) -> tuple[Optional[str], str]:
+    return parse_bs4(html, 'lxml')
+
+def parse_selectolax(html: str) -> tuple[Optional[str], str]:
+    from selectolax.parser import HTMLParser
+    tree = HTMLParser(html)
+    amphtml = tree.css_first('link[rel="amphtml"]')
+    node = tree.css_first('article') or tree.root
+    return amphtml.attributes.get('href') if amphtml else None, node.text(deep=True) if node else ''
+
+def available_backends() -> dict:
+    '''Parser backends usable in this environment, fastest first.'''
+    backends = {}
+    # look the parsers up without importing them
+    if importlib.util.find_spec('selectolax'):
+        backends['selectolax'] = parse_selectolax
+    if importlib.util.find_spec('lxml'):
+        backends['lxml'] = parse_lxml
+    backends['html.parser'] = parse_html_parser
+    return backends
+
+BACKENDS = available_backends()
+BACKEND = os.getenv('SCRAPE_PARSER') or next(iter(BACKENDS))
+if BACKEND not in BACKENDS:
+    print(f"[WARN] Parser backend {BACKEND} unavailable, using html.parser")
+    BACKEND = 'html.parser'
+
+_executor: Optional[Executor] = None
+
+def get_executor() -> Executor:
+    '''Pool parsing runs in, so large documents never block the event loop (SCRAPE_EXECUTOR=thread|process).'''
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv('SCRAPE_WORKERS', 2))
+        if os.getenv('SCRAPE_EXECUTOR', 'thread') == 'process':
+            _executor = ProcessPoolExecutor(workers)
+        else:
+            _executor = ThreadPoolExecutor(workers, thread_name_prefix='scrape')
+    return _executor
+
+async def fetch(url, params={}) -> Optional[tuple[str, str]]:
+    '''Download a page, returning its content type and (size-capped) text, or None if it isn't text.'''
     # Use UA
     headers = {'User-Agent': UA}
-    async with aiohttp.ClientSession(headers=headers) as session:
-        url = f'{url}?{urlencode(params)}' if params else url
-        print(url)
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.text()
-            else:
+    session = await http_client.session()
+    url = f'{url}?{urlencode(params)}' if params else url
+    print(url)
+    with span('fetch', 'http', url=url), tracked('fetch', url):
+        async with session.get(url, headers=headers) as response:
+            if response.status != 200:
                 print("Error:", response.status)#, await response.text())
                 return None
+            if response.content_type not in HTML_TYPES + TEXT_TYPES:
+                print(f"Error: unsupported content type {response.content_type}")
+                return None
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) >= MAX_DOWNLOAD_BYTES:
+                    print(f"[WARN] {url} truncated to {MAX_DOWNLOAD_BYTES} bytes")
+                    del data[MAX_DOWNLOAD_BYTES:]
+                    break
+            return response.content_type, bytes(data).decode(response.charset or 'utf-8', errors='replace')
 
-async def parseHtml(html: str|bytes):
-    soup = BeautifulSoup(html, 'html.parser')
-    amphtml = soup.find('link', {'rel': 'amphtml'})
-    if amphtml:
-        return await parseHtml(await get(amphtml['href']))
-    article = soup.find('article')
-    if article:
-        return article
-    return soup
+async def get(url, params={}) -> Optional[str]:
+    content = await fetch(url, params)
+    return content[1] if content else None
+
+async def parseHtml(html: str|bytes, url: str = '', follow_amp: bool = True) -> str:
+    '''Extract the text of the main article of a page. Parsing runs in the parser pool.'''
+    loop = asyncio.get_running_loop()
+    amphtml, text = await loop.run_in_executor(get_executor(), BACKENDS[BACKEND], html)
+    if amphtml and follow_amp:
+        amp_url = urljoin(url, amphtml)
+        content = await fetch(amp_url)
+        if content and content[0] in HTML_TYPES:
+            return await parseHtml(content[1], amp_url, follow_amp=False)
+    return text
 
-async def scrape(url: str|bytes):
-    content = await get(url)
-    return await parseHtml(content) if content else None
+async def scrape(url: str|bytes) -> Optional[str]:
+    content = await fetch(url)
+    if content is None:
+        return None
+    content_type, text = content
+    return await parseHtml(text, url) if content_type in HTML_TYPES else text
 
 def cleanText(text: str|bytes):
     return '\n'.join([p.strip() for p in text.strip().split('\n\n') if p.strip()])
 
+@recorded('page')
 async def scrapeText(url: str|bytes):
     content = await scrape(url)
     #print(content)
-    return cleanText(content.text) if content else None
+    return cleanText(content) if content else None
 
 async def main(url: str|bytes):
     content = await scrapeText(url)
     print(content)
+    await http_client.close()
 
 if __name__ == '__main__':
     import argparse
@@ -1,13 +1,16 @@
 import os
 import pprint
-import aiohttp
 import asyncio
 from urllib.parse import urlencode
 from dotenv import load_dotenv
 load_dotenv()
-from bs4 import BeautifulSoup
 
+from .cassette import recorded
+from .http_client import http_client
+from .resources import tracked
+from .search_cache import cached
 from .scrape import scrapeText
+from .tracing import span
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_SEARCH_ID = os.getenv("GOOGLE_SEARCH_ID")
@@ -15,9 +18,10 @@ SERPAPI_KEY = os.getenv("SERPAPI_KEY")
 
 
 async def get(url, params={}, headers = {'Accept': 'application/json'}):
-    async with aiohttp.ClientSession() as session:
-        url = f'{url}?{urlencode(params)}' if params else url
-        print(url)
+    session = await http_client.session()
+    url = f'{url}?{urlencode(params)}' if params else url
+    print(url)
+    with span('fetch', 'http', url=url), tracked('fetch', url):
         async with session.get(url, headers=headers) as response:
             if response.status == 200:
                 return await response.json()
@@ -35,6 +39,7 @@ def filer_organic_result(result):
 def filter_knowledge_graph(result):
     pass
 
+@cached('serp')
 async def get_serp_data(query):
     json_data = await get('https://serpapi.com/search.json', {
         'engine': 'google',
@@ -50,6 +55,7 @@ async def get_serp_data(query):
     return json_data
     
 
+@cached('knowledge-graph')
 async def get_kg_data(query):
     json_data = await get('https://kgsearch.googleapis.com/v1/entities:search', {
         'query': query,
@@ -61,6 +67,7 @@ async def get_kg_data(query):
     return items
 
 
+@cached('google')
 async def get_search_data(query):
     json_data = await get('https://customsearch.googleapis.com/customsearch/v1', {
         'q': query,
@@ -76,6 +83,7 @@ async def get_search_data(query):
     pprint.pprint(items, width=200)
     return items
 
+@cached('wikipedia-search')
 async def get_wikipedia_search_results(query):
     json_data = await get('https://en.wikipedia.org/w/api.php', {
         'action': 'query',
@@ -85,6 +93,7 @@ async def get_wikipedia_search_results(query):
         'srlimit': 12,
     })
     items = json_data['query']['search']
+    from bs4 import BeautifulSoup
     items = [{
         'title': item['title'],
         'snippet': BeautifulSoup(item['snippet'], 'html.parser').text,
@@ -93,6 +102,8 @@ async def get_wikipedia_search_results(query):
     return items
 
 #Wikipedia getting just the intro of the article
+@recorded('wikipedia')
+@cached('wikipedia')
 async def get_wikipedia_data(title):
     url = 'https://en.wikipedia.org/w/api.php'
     params = {
@@ -116,12 +127,14 @@ async def get_wikipedia_data(title):
     return await get_wikipedia_search_results(title)
 
 
+@cached('web')
 async def get_scrape_data(url):
     r = await scrapeText(url)
     print(r)
     return r
 
 
+@recorded('search')
 async def search(query, source='google'):
     if source is None:
         source = 'google'
@@ -142,10 +155,14 @@ async def search(query, source='google'):
         return await get_search_data(f"{query} {source}")
 
 
+async def main(args):
+    await search(args.query, source=args.source)
+    await http_client.close()
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Search the web using Google.")
     parser.add_argument("query", help="The query to search for.")
     parser.add_argument("-s", "--source", default="google", help="The source to search from (default: google).")
     args = parser.parse_args()
-    asyncio.run(search(args.query, source=args.source))
+    asyncio.run(main(args))
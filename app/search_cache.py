@@ -0,0 +1,177 @@
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+# Time to live of cached results, in seconds
+DEFAULT_TTL = {
+    'google': 24 * 3600,
+    'serp': 24 * 3600,
+    'knowledge-graph': 7 * 24 * 3600,
+    'wikipedia': 7 * 24 * 3600,
+    'wikipedia-search': 24 * 3600,
+    'web': 3600,
+}
+FALLBACK_TTL = 3600
+
+def parse_ttl(spec: Optional[str]) -> dict[str, float]:
+    '''Parse per-source TTL overrides like "google=3600,wikipedia=86400".'''
+    ttl = dict(DEFAULT_TTL)
+    if spec:
+        for item in spec.split(','):
+            source, _, seconds = item.partition('=')
+            if seconds:
+                ttl[source.strip()] = float(seconds)
+    return ttl
+
+# Sources queried with free text, where case and spacing don't matter; the others (URLs,
+# article titles) are keyed by their exact query
+FREE_TEXT = {'google', 'serp', 'knowledge-graph', 'wikipedia-search'}
+
+def normalize(source: str, query: str) -> str:
+    if source in FREE_TEXT:
+        return ' '.join(str(query).lower().split())
+    return str(query)
+
+class SearchCache:
+    '''Two-tier TTL cache of search results: an in-memory LRU in front of an optional SQLite store.
+
+    Concurrent requests for the same (source, query) share a single in-flight fetch, which
+    is only cancelled once all of them were.
+    '''
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 512, ttl: Optional[dict[str, float]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl or dict(DEFAULT_TTL)
+        self.memory: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self.inflight: dict[tuple[str, str], asyncio.Task] = {}
+        # callers waiting for each fetch
+        self.waiting: dict[asyncio.Task, int] = {}
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'shared': 0}
+        # opened on first use rather than on import
+        self.path = path
+        self.db: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> 'SearchCache':
+        path = os.getenv('SEARCH_CACHE_DB', os.path.expanduser('~/.cache/gpt-agent/search.sqlite'))
+        return SearchCache(path or None, int(os.getenv('SEARCH_CACHE_SIZE', 512)), parse_ttl(os.getenv('SEARCH_CACHE_TTL')))
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        '''The database, opened on first use. Called with the lock held.'''
+        if self.db is None and self.path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute('CREATE TABLE IF NOT EXISTS results (source TEXT, query TEXT, expires REAL, value TEXT, PRIMARY KEY (source, query))')
+                db.execute('DELETE FROM results WHERE expires < ?', (time.time(),))
+                db.commit()
+                self.db = db
+            except (OSError, sqlite3.Error) as e:
+                print(f"[WARN] Search cache database unavailable, using memory only: {e}")
+                self.path = None
+        return self.db
+
+    def _db_get(self, key: tuple[str, str]) -> Optional[tuple[float, Any]]:
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute('SELECT expires, value FROM results WHERE source = ? AND query = ?', key).fetchone()
+        if row is None or row[0] < time.time():
+            return None
+        return row[0], json.loads(row[1])
+
+    def _db_put(self, key: tuple[str, str], expires: float, value: str):
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (*key, expires, value))
+            db.commit()
+
+    def _remember(self, key: tuple[str, str], entry: tuple[float, Any]):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    async def lookup(self, key: tuple[str, str]) -> tuple[bool, Any]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            if entry[0] >= time.time():
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return True, entry[1]
+            del self.memory[key]
+        if self.path:
+            entry = await asyncio.to_thread(self._db_get, key)
+            if entry is not None:
+                self._remember(key, entry)
+                self.counters['disk_hits'] += 1
+                return True, entry[1]
+        return False, None
+
+    async def store(self, key: tuple[str, str], value: Any):
+        expires = time.time() + self.ttl.get(key[0], FALLBACK_TTL)
+        self._remember(key, (expires, value))
+        if self.path:
+            await asyncio.to_thread(self._db_put, key, expires, json.dumps(value))
+
+    async def _fetch(self, key: tuple[str, str], fetch: Callable[[], Awaitable]):
+        value = await fetch()
+        if value is not None:
+            await self.store(key, value)
+        return value
+
+    def _done(self, key: tuple[str, str], task: asyncio.Task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        self.waiting.pop(task, None)
+
+    async def get_or_fetch(self, source: str, query: str, fetch: Callable[[], Awaitable]):
+        key = (source, normalize(source, query))
+        while True:
+            found, value = await self.lookup(key)
+            if found:
+                return value
+            task = self.inflight.get(key)
+            if task is not None:
+                self.counters['shared'] += 1
+            else:
+                self.counters['misses'] += 1
+                # its own task: cancelling the caller that started it doesn't fail the others
+                task = self.inflight[key] = asyncio.create_task(self._fetch(key, fetch))
+                task.add_done_callback(functools.partial(self._done, key))
+            self.waiting[task] = self.waiting.get(task, 0) + 1
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # the fetch was cancelled rather than this caller (its runner stopped): fetch again
+            finally:
+                self.waiting[task] = self.waiting.get(task, 1) - 1
+                if not self.waiting[task] and not task.done():
+                    # nobody waits for it anymore
+                    task.cancel()
+
+    def stats(self) -> dict:
+        return {**self.counters, 'entries': len(self.memory), 'inflight': len(self.inflight)}
+
+search_cache = SearchCache.from_env()
+
+def cached(source: str):
+    '''Cache the results of an async `fn(query)` under `source`.'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(query):
+            return await search_cache.get_or_fetch(source, query, lambda: fn(query))
+        return wrapper
+    return decorator
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import shutil
+import uuid
+from typing import Optional
+
+from .output import OutputCapture
+from .process import StreamClosed, kill_process_group, read_to_end, read_until
+from .resources import child_env, track_process
+
+# Keep one shell per agent, so that cd, exports and variables persist between RUN calls
+PERSISTENT_SHELL = os.getenv('RUN_PERSISTENT_SHELL', '') not in ('', '0', 'false')
+RUN_TIMEOUT = float(os.getenv('RUN_TIMEOUT', 300))
+
+class ShellTimeout(Exception):
+    pass
+
+def format_result(return_code: int, stdout: str, stderr: str) -> str:
+    if return_code == 0:
+        return f"stdout: {stdout}"
+    result = f"exit code: {return_code}\nstderr: {stderr}"
+    if stdout:
+        result += f"\nstdout: {stdout}"
+    return result
+
+def quote(command: str) -> str:
+    return "'" + command.replace("'", "'\\''") + "'"
+
+async def run_process(command: str, cwd: str, timeout: Optional[float] = RUN_TIMEOUT,
+                      stdout: Optional[OutputCapture] = None, stderr: Optional[OutputCapture] = None) -> tuple[int, str, str]:
+    '''Run a command in a fresh shell, streaming its output into bounded captures.
+    Its whole process group is killed on timeout or cancellation.'''
+    stdout = stdout or OutputCapture()
+    stderr = stderr or OutputCapture()
+    process = await asyncio.create_subprocess_shell(
+        command,
+        cwd=cwd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=child_env(),
+        start_new_session=True)
+    track_process(process, 'run')
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            read_to_end(process.stdout, stdout.write),
+            read_to_end(process.stderr, stderr.write),
+            process.wait()), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(process)
+        await process.wait()
+        raise ShellTimeout(f"command timed out after {timeout}s and was killed")
+    except asyncio.CancelledError:
+        kill_process_group(process)
+        raise
+    finally:
+        await stdout.flush()
+        await stderr.flush()
+    return process.returncode, stdout.text(), stderr.text()
+
+class ShellSession:
+    '''A long-lived shell running commands one after the other, keeping its state between them.'''
+
+    def __init__(self, cwd: str, timeout: Optional[float] = RUN_TIMEOUT):
+        self.cwd = cwd
+        self.timeout = timeout
+        self.marker = f'__shell_{uuid.uuid4().hex}__'
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        shell = shutil.which('bash')
+        args = [shell, '--noprofile', '--norc'] if shell else ['/bin/sh']
+        self.process = await asyncio.create_subprocess_exec(
+            *args,
+            cwd=self.cwd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=child_env(),
+            start_new_session=True)
+        track_process(self.process, 'shell')
+
+    async def run(self, command: str, stdout: Optional[OutputCapture] = None, stderr: Optional[OutputCapture] = None) -> tuple[int, str, str]:
+        '''Run a command. Returns (exit code, stdout, stderr), raises ShellTimeout past the deadline.'''
+        stdout = stdout or OutputCapture()
+        stderr = stderr or OutputCapture()
+        async with self.lock:
+            restarted = False
+            if not self.alive:
+                restarted = self.process is not None
+                await self.start()
+            # eval reports syntax errors instead of waiting for the rest of the input,
+            # and the exit code is written next to the marker rather than guessed from the output
+            script = (f"eval {quote(command)} </dev/null\n"
+                      f"printf '\\n%s %d\\n' '{self.marker}' $?\n"
+                      f"printf '\\n%s\\n' '{self.marker}' >&2\n")
+            try:
+                self.process.stdin.write(script.encode())
+                await self.process.stdin.drain()
+                (_, status), _ = await asyncio.wait_for(asyncio.gather(
+                    read_until(self.process.stdout, self.marker.encode(), stdout.write),
+                    read_until(self.process.stderr, self.marker.encode(), stderr.write)), self.timeout)
+            except asyncio.TimeoutError:
+                await self.close()
+                raise ShellTimeout(f"command timed out after {self.timeout}s and was killed, the shell was restarted")
+            except asyncio.CancelledError:
+                await self.close()
+                raise
+            except (StreamClosed, ConnectionResetError, BrokenPipeError):
+                # the command exited the shell
+                await self.process.wait()
+                return self.process.returncode, stdout.text(), stderr.text() + '\nThe shell exited and will be restarted.'
+            finally:
+                await stdout.flush()
+                await stderr.flush()
+            note = 'Note: the shell was restarted, its previous state was lost.\n' if restarted else ''
+            return int(status), stdout.text(), note + stderr.text()
+
+    async def close(self):
+        if self.process is not None and self.process.returncode is None:
+            kill_process_group(self.process)
+            await self.process.wait()
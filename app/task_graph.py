@@ -0,0 +1,134 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+
+if TYPE_CHECKING:
+    from .agent import Agent
+
+# Agents of a runner taking turns at the same time
+MAX_AGENTS = int(os.getenv('MAX_AGENTS', 8))
+
+class TaskGraph:
+    '''Sub-agents of a runner, each run as its own task once the agents it depends on completed.
+
+    At most `max_agents` agents take turns at once. An agent waiting for others (in ASSIGN or
+    WAIT) hands its slot over while it waits, so a full tree of waiting supervisors can't
+    starve the agents they wait for. Stopping an agent cancels its sub-agents, which cancel
+    theirs in turn.
+    '''
+
+    def __init__(self, max_agents: int = MAX_AGENTS):
+        self.max_agents = max(1, max_agents)
+        self.slots = asyncio.Semaphore(self.max_agents)
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.agents: dict[str, 'Agent'] = {}
+        self.children: dict[str, list[str]] = {}
+        # agents holding a slot
+        self.holding: set[str] = set()
+        self.cancelled: set[str] = set()
+        # agents whose result was given to their supervisor
+        self.collected: set[str] = set()
+        self.counters = {'started': 0, 'completed': 0, 'cancelled': 0, 'peak': 0}
+
+    @asynccontextmanager
+    async def slot(self, agent: 'Agent'):
+        '''Hold one of the runner's slots while the agent takes turns.'''
+        await self.slots.acquire()
+        self.holding.add(agent.name)
+        self.counters['peak'] = max(self.counters['peak'], len(self.holding))
+        try:
+            yield
+        finally:
+            # not held anymore if cancelled while taking it back after a wait
+            if agent.name in self.holding:
+                self.holding.discard(agent.name)
+                self.slots.release()
+
+    @asynccontextmanager
+    async def released(self, agent: 'Agent'):
+        '''Give the agent's slot to others while it waits.'''
+        if agent.name not in self.holding:
+            yield
+            return
+        self.holding.discard(agent.name)
+        self.slots.release()
+        try:
+            yield
+        finally:
+            await self.slots.acquire()
+            self.holding.add(agent.name)
+            self.counters['peak'] = max(self.counters['peak'], len(self.holding))
+
+    def check(self, names: list[str]):
+        missing = [name for name in names if name not in self.tasks]
+        if missing:
+            raise ValueError(f"Unknown agents: {', '.join(missing)}")
+
+    def start(self, agent: 'Agent', after: list[str] = [], run: Optional[Callable[[], Awaitable]] = None) -> asyncio.Task:
+        '''Run a sub-agent once the agents in `after` completed, their results added to its messages.'''
+        self.check(after)
+        task = asyncio.create_task(self._run(agent, after, run or agent.run), name=f'agent-{agent.name}')
+        self.tasks[agent.name] = task
+        self.agents[agent.name] = agent
+        if agent.parent:
+            self.children.setdefault(agent.parent.name, []).append(agent.name)
+        self.counters['started'] += 1
+        return task
+
+    async def _run(self, agent: 'Agent', after: list[str], run: Callable[[], Awaitable]):
+        if after:
+            await asyncio.wait([self.tasks[name] for name in after])
+            for name, result in self.results(after).items():
+                await agent.add_message(f"Result of {name}: {result}")
+        async with self.slot(agent):
+            await run()
+        if agent.name not in self.cancelled:
+            self.counters['completed'] += 1
+
+    def results(self, names: list[str]) -> dict[str, object]:
+        '''Results of the agents, or their state if they have none yet.'''
+        results = {}
+        for name in names:
+            task = self.tasks[name]
+            if not task.done():
+                results[name] = 'running'
+            elif name in self.cancelled or task.cancelled():
+                results[name] = 'cancelled'
+            elif task.exception() is not None:
+                results[name] = f'failed: {task.exception()!r}'
+            else:
+                results[name] = self.agents[name].result()
+        return results
+
+    def pending(self, parent: 'Agent') -> list[str]:
+        return [name for name in self.children.get(parent.name, []) if not self.tasks[name].done()]
+
+    def uncollected(self, parent: 'Agent') -> list[str]:
+        return [name for name in self.children.get(parent.name, []) if name not in self.collected]
+
+    async def wait(self, agent: 'Agent', names: list[str], timeout: Optional[float] = None) -> dict[str, object]:
+        '''Wait for the agents to complete, up to `timeout` seconds, and get their results.'''
+        self.check(names)
+        tasks = [self.tasks[name] for name in names]
+        if tasks:
+            async with self.released(agent):
+                await asyncio.wait(tasks, timeout=timeout)
+        self.collected.update(name for name in names if self.tasks[name].done())
+        return self.results(names)
+
+    async def cancel(self, parent: 'Agent'):
+        '''Cancel the sub-agents of `parent` still running, and wait for them to stop.'''
+        names = self.pending(parent)
+        tasks = [self.tasks[name] for name in names]
+        for task in tasks:
+            task.cancel()
+        self.cancelled.update(names)
+        self.counters['cancelled'] += len(names)
+        if tasks:
+            print(f"[TASKS] {parent.name} stopped, cancelling {len(tasks)} sub-agents")
+            await asyncio.wait(tasks)
+
+    def stats(self) -> dict:
+        return {**self.counters, 'running': len(self.holding), 'max_agents': self.max_agents,
+                'pending': sum(not task.done() for task in self.tasks.values())}
@@ -0,0 +1,106 @@
+import contextvars
+import itertools
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+# Traces of finished runners are written to this directory, if set
+TRACE_DIR = os.getenv('TRACE_DIR')
+# Spans past this many are only counted in the summary
+TRACE_MAX_EVENTS = int(os.getenv('TRACE_MAX_EVENTS', 100000))
+
+class Span:
+    __slots__ = ('tracer', 'id', 'name', 'category', 'agent', 'parent', 'start', 'args')
+
+    def __init__(self, tracer: 'Tracer', id: int, name: str, category: str, agent: str, parent: Optional['Span'], args: dict):
+        self.tracer = tracer
+        self.id = id
+        self.name = name
+        self.category = category
+        self.agent = agent
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.args = args
+
+# The innermost span of the running task, which new spans are nested in
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+
+class Tracer:
+    '''Timing spans of a runner: completions, commands, subprocesses, HTTP fetches and WebSocket sends.
+
+    Each span is tagged with the agent it ran for and its parent span, and counted in a
+    per-agent summary by category. The spans export as Chrome trace events, one thread per
+    agent, to open in chrome://tracing or Perfetto.
+    '''
+
+    def __init__(self, name: str, max_events: int = TRACE_MAX_EVENTS):
+        self.name = name
+        self.max_events = max_events
+        self.origin = time.perf_counter()
+        self.events: list[dict] = []
+        self.dropped = 0
+        self.ids = itertools.count(1)
+        self.threads: dict[str, int] = {}
+        self.summaries: dict[str, dict[str, dict]] = {}
+
+    def thread(self, agent: str) -> int:
+        tid = self.threads.get(agent)
+        if tid is None:
+            tid = self.threads[agent] = len(self.threads) + 1
+        return tid
+
+    @contextmanager
+    def span(self, name: str, category: str, agent: Optional[str] = None, **args):
+        parent = current_span.get()
+        if parent is not None and parent.tracer is not self:
+            parent = None
+        if agent is None:
+            agent = parent.agent if parent else self.name
+        span = Span(self, next(self.ids), name, category, agent, parent, args)
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+            self.add(span, time.perf_counter())
+
+    def add(self, span: Span, end: float):
+        duration = end - span.start
+        summary = self.summaries.setdefault(span.agent, {}).setdefault(span.category, {'count': 0, 'ms': 0.})
+        summary['count'] += 1
+        summary['ms'] += duration * 1000
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        args = {'agent': span.agent, 'id': span.id}
+        if span.parent is not None:
+            args['parent'] = span.parent.id
+            args['parent_agent'] = span.parent.agent
+        args.update(span.args)
+        self.events.append({
+            'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': 1, 'tid': self.thread(span.agent),
+            'ts': (span.start - self.origin) * 1000000, 'dur': duration * 1000000, 'args': args,
+        })
+
+    def summary(self, agent: str) -> dict:
+        '''Count and total milliseconds of the spans of an agent, by category.'''
+        return {category: {'count': s['count'], 'ms': round(s['ms'], 1)} for category, s in self.summaries.get(agent, {}).items()}
+
+    def chrome_trace(self) -> dict:
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': self.name}}]
+        metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': agent}} for agent, tid in self.threads.items()]
+        return {'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms', 'otherData': {'runner': self.name, 'dropped': self.dropped}}
+
+    def export(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+def span(name: str, category: str, **args):
+    '''A span nested in the current one, or nothing if no runner is being traced.'''
+    parent = current_span.get()
+    if parent is None:
+        return nullcontext()
+    return parent.tracer.span(name, category, **args)
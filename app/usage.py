@@ -0,0 +1,186 @@
+import bisect
+import json
+import os
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+# Dollars per million prompt and completion tokens, matched on the longest model prefix
+DEFAULT_PRICES = {
+    'gpt-4o-mini': (.15, .6),
+    'gpt-4o': (2.5, 10.),
+    'gpt-4-turbo': (10., 30.),
+    'gpt-4': (30., 60.),
+    'gpt-3.5-turbo': (.5, 1.5),
+    'o1-mini': (3., 12.),
+    'o1': (15., 60.),
+    '': (2., 2.),
+}
+
+LATENCY_BUCKETS = (.1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+def load_prices(source: Optional[str]) -> dict[str, tuple[float, float]]:
+    '''Default prices, updated from MODEL_PRICES: a JSON file or string mapping model prefixes to [prompt, completion].'''
+    prices = dict(DEFAULT_PRICES)
+    if source:
+        if os.path.exists(source):
+            with open(source, 'r') as f:
+                source = f.read()
+        prices.update({model: tuple(price) for model, price in json.loads(source).items()})
+    return prices
+
+class PriceTable:
+    def __init__(self, prices: dict[str, tuple[float, float]]):
+        self.prices = prices
+        self._cache: dict[str, tuple[float, float]] = {}
+
+    def get(self, model: str) -> tuple[float, float]:
+        price = self._cache.get(model)
+        if price is None:
+            prefix = max((p for p in self.prices if model.startswith(p)), key=len, default='')
+            price = self._cache[model] = self.prices.get(prefix, (0., 0.))
+        return price
+
+    def dollars(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt, completion = self.get(model)
+        return (prompt_tokens * prompt + completion_tokens * completion) / 1000000.
+
+class Usage:
+    '''Running counters. Reading them doesn't sum anything.'''
+
+    KEYS = ('prompt_tokens', 'completion_tokens', 'total_tokens', 'total_dollars', 'requests', 'turns', 'errors',
+            'cache_hits', 'cache_misses', 'context_tokens_saved', 'retrieval_tokens_saved')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(Usage.KEYS, 0)
+
+    def add(self, key: str, value: float = 1):
+        self.counters[key] += value
+
+    def __getitem__(self, key: str) -> float:
+        return self.counters[key]
+
+    def snapshot(self) -> dict:
+        return dict(self.counters)
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class UsageLedger:
+    '''Token, dollar, latency and error accounting, per model and per session.
+
+    Each completion updates the model's counters, the process totals and the counters of
+    the accounts it is charged to (the agent and its session), so that all of them can be
+    read at any time without adding anything up.
+    '''
+
+    def __init__(self, prices: PriceTable, max_sessions: int = 1000):
+        self.prices = prices
+        self.max_sessions = max_sessions
+        self.total = Usage()
+        self.models: dict[str, Usage] = {}
+        self.sessions: OrderedDict[str, Usage] = OrderedDict()
+        self.latency: dict[str, Histogram] = {}
+        self.errors: dict[tuple[str, str], int] = {}
+
+    @staticmethod
+    def from_env() -> 'UsageLedger':
+        return UsageLedger(PriceTable(load_prices(os.getenv('MODEL_PRICES'))))
+
+    def model(self, model: str) -> Usage:
+        usage = self.models.get(model)
+        if usage is None:
+            usage = self.models[model] = Usage()
+        return usage
+
+    def session(self, name: str) -> Usage:
+        '''Counters of a session, the least recently created ones being forgotten past max_sessions.'''
+        usage = self.sessions.get(name)
+        if usage is None:
+            usage = self.sessions[name] = Usage()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return usage
+
+    def _charge(self, model: str, accounts: Iterable[Usage], key: str, value: float):
+        self.total.add(key, value)
+        self.model(model).add(key, value)
+        for account in accounts:
+            account.add(key, value)
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int, accounts: Iterable[Usage] = (), latency: Optional[float] = None):
+        '''Charge a completion.'''
+        accounts = list(accounts)
+        self._charge(model, accounts, 'prompt_tokens', prompt_tokens)
+        self._charge(model, accounts, 'completion_tokens', completion_tokens)
+        self._charge(model, accounts, 'total_tokens', prompt_tokens + completion_tokens)
+        self._charge(model, accounts, 'total_dollars', self.prices.dollars(model, prompt_tokens, completion_tokens))
+        self._charge(model, accounts, 'requests', 1)
+        if latency is not None:
+            histogram = self.latency.get(model)
+            if histogram is None:
+                histogram = self.latency[model] = Histogram()
+            histogram.observe(latency)
+
+    def record_error(self, model: str, error: Exception, accounts: Iterable[Usage] = ()):
+        self._charge(model, accounts, 'errors', 1)
+        key = (model, type(error).__name__)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def count(self, model: str, key: str, value: float = 1, accounts: Iterable[Usage] = ()):
+        self._charge(model, accounts, key, value)
+
+    def stats(self) -> dict:
+        return {
+            'total': self.total.snapshot(),
+            'models': {model: usage.snapshot() for model, usage in self.models.items()},
+            'sessions': {name: usage.snapshot() for name, usage in self.sessions.items()},
+        }
+
+    def prometheus(self) -> str:
+        '''Metrics in the Prometheus text exposition format.'''
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label = ','.join(f'{k}="{escape(v)}"' for k, v in labels.items())
+                lines.append(f'{name}{{{label}}} {value}' if label else f'{name} {value}')
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        metric('argent_tokens_total', 'counter', 'Tokens used by completions.',
+               [({'model': model, 'type': kind}, usage[f'{kind}_tokens']) for model, usage in self.models.items() for kind in ('prompt', 'completion')])
+        metric('argent_dollars_total', 'counter', 'Estimated cost of completions in dollars.',
+               [({'model': model}, usage['total_dollars']) for model, usage in self.models.items()])
+        metric('argent_requests_total', 'counter', 'Completion requests.',
+               [({'model': model}, usage['requests']) for model, usage in self.models.items()])
+        metric('argent_cache_hits_total', 'counter', 'Completions served from the cache.',
+               [({'model': model}, usage['cache_hits']) for model, usage in self.models.items()])
+        metric('argent_context_tokens_saved_total', 'counter', 'Prompt tokens saved by compacting the context.',
+               [({'model': model}, usage['context_tokens_saved']) for model, usage in self.models.items()])
+        metric('argent_retrieval_tokens_saved_total', 'counter', 'Tokens of fetched content left out of search agent prompts.',
+               [({'model': model}, usage['retrieval_tokens_saved']) for model, usage in self.models.items()])
+        metric('argent_errors_total', 'counter', 'Failed completion requests.',
+               [({'model': model, 'error': error}, count) for (model, error), count in self.errors.items()])
+        lines.append('# HELP argent_request_duration_seconds Completion request latency.')
+        lines.append('# TYPE argent_request_duration_seconds histogram')
+        for model, histogram in self.latency.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'argent_request_duration_seconds_bucket{{model="{escape(model)}",le="{le}"}} {cumulative}')
+            lines.append(f'argent_request_duration_seconds_sum{{model="{escape(model)}"}} {histogram.sum}')
+            lines.append(f'argent_request_duration_seconds_count{{model="{escape(model)}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+usage_ledger = UsageLedger.from_env()
@@ -1,6 +1,10 @@
 import base64
+from collections import deque
+from contextlib import nullcontext
+import contextvars
 import json
 import os
+import uuid
 import aiohttp
 from aiohttp import web
 import asyncio
@@ -9,7 +13,52 @@ from cryptography import fernet
 import aiohttp_session
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
+from .http_client import http_client
+from .kernel import kernel_pool
+from .rate_limit import openai_scheduler
+from .resources import reaper
+from .retrieval import chunk_ranker
+from .search_cache import search_cache
+from .usage import usage_ledger
+
+# Number of state patches kept to bring reconnecting clients up to date
+SYNC_LOG_SIZE = int(os.getenv('WS_SYNC_LOG_SIZE', 1000))
+# Messages queued for a client are sent together every WS_BATCH_INTERVAL seconds
+WS_BATCH_INTERVAL = float(os.getenv('WS_BATCH_INTERVAL', .05))
+# A client further behind than this gets a snapshot instead of the queued messages
+WS_QUEUE_SIZE = int(os.getenv('WS_QUEUE_SIZE', 1000))
+WS_COMPRESS = os.getenv('WS_COMPRESS', '1') not in ('', '0', 'false')
+
+# Placeholder for a snapshot of the state, taken when it is sent
+SNAPSHOT = {}
+
+def coalesce_key(message: dict):
+    '''Messages with the same key replace each other when queued one after the other.'''
+    if message is SNAPSHOT:
+        return 'snapshot'
+    if 'queue' in message:
+        return 'queue'
+    if message.get('state') in ('running', 'completed', 'idle') and message.keys() <= {'state', 'id', 'seq', 'usage'}:
+        return 'state'
+    if message.keys() <= {'usage', 'seq'}:
+        return 'usage'
+    if message.keys() <= {'trace', 'id', 'seq'}:
+        return ('trace', message.get('id'))
+    return None
+
 class WebSession:
+    '''State of a client session, kept in sync with the browser.
+
+    State changes are sent as patches numbered by `seq`. A reconnecting client passes the
+    epoch and the last seq it applied, and only gets the patches it missed, or a full
+    snapshot if they are no longer in the log (or the state was reset since).
+    Transient messages (deltas, live output, queue position) are not numbered.
+
+    Messages are queued and sent by a writer task, so the agents never wait on the socket.
+    Every WS_BATCH_INTERVAL, the queued messages go out as one frame, consecutive state
+    updates being coalesced. A client that falls too far behind gets a snapshot instead.
+    '''
+
     def __init__(self, req: web.Request, ws: web.WebSocketResponse, session: aiohttp_session.Session):
         self.req = req
         self.session = session
@@ -17,10 +66,21 @@ class WebSession:
         self.agent = None
         self.task = None
         self.state = None
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.log: deque[dict] = deque(maxlen=SYNC_LOG_SIZE)
+        self.outbox: deque[dict] = deque()
+        self._wakeup: asyncio.Event | None = None
+        self._writer: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.counters = {'patches': 0, 'replays': 0, 'snapshots': 0, 'messages': 0, 'frames': 0, 'coalesced': 0, 'overflows': 0}
     
     async def reset(self, model):
         await self.stop()
         self.state = {'model': model, 'agents': {}, 'state': 'idle'}
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.log.clear()
     
     async def set_agent(self, agent):
         # agents = self.state['agents']
@@ -30,19 +90,25 @@ class WebSession:
 
     async def stop(self):
         if self.agent:
-            await self.agent.stop()
-            if self.task:
-                self.task.cancel()
-                self.task = None
+            report = await self.agent.stop()
             self.agent = None
+            if report and self.state is not None:
+                # what the runner left running: processes killed, requests cancelled
+                await self.set_property('reclaimed', report)
+        # the task may still be waiting for a slot in the session scheduler
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+            self.task = None
 
     def update(self, req: web.Request, ws: web.WebSocketResponse):
         self.req = req
         self.ws = ws
+        # the new connection catches up through sync()
+        self.outbox.clear()
 
     async def set_property(self, key, value):
         self.state[key] = value
-        await self.send_to_client({key: value})
+        await self.send_patch({key: value})
 
     async def set_agent_properties(self, id, role, model, commands, parent):
         agent = self.state['agents'].get(id)
@@ -53,13 +119,27 @@ class WebSession:
         agent['commands'] = commands
         agent['parent'] = parent
         self.state['agents'][id] = agent
-        await self.send_to_client({'agents': self.state['agents']})
+        await self.send_patch({'agent': {k: v for k, v in agent.items() if k != 'messages'}})
 
     async def set_state(self, id, state, usage: dict | None = None):
         self.state['state'] = state
         if usage is not None:
             self.state['usage'] = usage
-        await self.send_to_client({'state': state, 'id': id})
+        await self.send_patch({'state': state, 'id': id})
+
+    async def set_budget(self, id, remaining: dict):
+        '''Show what is left of the budget of an agent.'''
+        agent = self.state['agents'].setdefault(id, {'id': id, 'messages': []})
+        if remaining == agent.get('budget'):
+            return
+        agent['budget'] = remaining
+        await self.send_patch({'budget': remaining, 'id': id})
+
+    async def set_trace(self, id, summary: dict):
+        '''Show where the time of an agent went, by kind of span.'''
+        agent = self.state['agents'].setdefault(id, {'id': id, 'messages': []})
+        agent['trace'] = summary
+        await self.send_patch({'trace': summary, 'id': id})
 
     async def get_input(self, id, message):
         self.pending_input = asyncio.get_running_loop().create_future()
@@ -67,7 +147,7 @@ class WebSession:
         self.state['state'] = 'request'
         self.state['id'] = id
         self.state['message'] = message
-        await self.send_to_client({
+        await self.send_patch({
             'state': 'request',
             'id': id,
             'message': message
@@ -76,23 +156,102 @@ class WebSession:
         self.state['state'] = old_state
         del self.state['id']
         del self.state['message']
-        await self.send_to_client({
+        await self.send_patch({
             'state': old_state,
             'id': id
         })
         return r
 
     async def send_to_client(self, message):
-        if self.ws is not None:
-            try:
-                await self.ws.send_json(message)
-            except Exception as e:
-                print(f'Error sending to client: {e}')
-        else:
-            print('No websocket connected')
+        '''Queue a message for the client, without waiting for it to be sent.'''
+        if self.ws is None:
+            # patches are caught up on through sync() when the client reconnects
+            return
+        self.counters['messages'] += 1
+        key = coalesce_key(message)
+        if message is SNAPSHOT:
+            # the snapshot includes everything queued before it
+            self.counters['coalesced'] += len(self.outbox)
+            self.outbox.clear()
+        elif key and self.outbox and coalesce_key(self.outbox[-1]) == key:
+            self.counters['coalesced'] += 1
+            self.outbox.pop()
+        self.outbox.append(message)
+        if len(self.outbox) > WS_QUEUE_SIZE:
+            self.counters['overflows'] += 1
+            self.outbox.clear()
+            self.outbox.append(SNAPSHOT)
+        self._wake_writer()
+
+    def _wake_writer(self):
+        loop = asyncio.get_running_loop()
+        if self._writer is None or self._writer.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            # not part of the trace span that happened to queue the first message
+            self._writer = asyncio.create_task(self._run_writer(), context=contextvars.Context())
+        self._wakeup.set()
+
+    async def _run_writer(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await asyncio.sleep(WS_BATCH_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        '''Send the queued messages now, in one frame.'''
+        if not self.outbox:
+            return
+        batch = [self.snapshot() if m is SNAPSHOT else m for m in self.outbox]
+        self.outbox.clear()
+        ws = self.ws
+        if ws is None:
+            return
+        tracer = getattr(self.agent, 'tracer', None)
+        try:
+            with tracer.span('send', 'websocket', agent='websocket', messages=len(batch)) if tracer else nullcontext():
+                await ws.send_json(batch[0] if len(batch) == 1 else batch)
+            self.counters['frames'] += 1
+        except Exception as e:
+            print(f'Error sending to client: {e}')
+
+    async def close(self):
+        '''Send what is still queued and stop the writer.'''
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+        await self.flush()
+
+    def snapshot(self) -> dict:
+        return {**(self.state or {}), 'snapshot': True, 'epoch': self.epoch, 'seq': self.seq}
+
+    async def send_patch(self, patch: dict):
+        '''Send a state change, numbered so that a reconnecting client can catch up on it.'''
+        self.seq += 1
+        patch['seq'] = self.seq
+        self.log.append(patch)
+        self.counters['patches'] += 1
+        await self.send_to_client(patch)
 
     async def send_init_state(self):
-        await self.send_to_client(self.state)
+        if self.state is None:
+            return
+        self.counters['snapshots'] += 1
+        # taken when sent, as patches queued until then are part of it
+        await self.send_to_client(SNAPSHOT)
+
+    async def sync(self, epoch: str | None, seq: int | None):
+        '''Bring a reconnecting client up to date from the last patch it applied.'''
+        first = self.log[0]['seq'] if self.log else self.seq + 1
+        if epoch != self.epoch or seq is None or seq > self.seq or seq + 1 < first:
+            await self.send_init_state()
+            return
+        self.counters['replays'] += 1
+        for patch in list(self.log):
+            if patch['seq'] > seq:
+                await self.send_to_client(patch)
     
     async def add_message(self, id: str, data: dict, usage: dict):
         self.state['usage'] = usage
@@ -100,7 +259,21 @@ class WebSession:
         if agent is None:
             agent = self.state['agents'][id] = {'id': id, 'messages': []}
         agent['messages'].append(data)
-        await self.send_to_client({'state': 'message', 'id': id, 'message': data, 'usage': usage})
+        await self.send_patch({'state': 'message', 'id': id, 'message': data, 'usage': usage})
+
+    async def load_messages(self, id: str, messages: list[dict]):
+        '''Replace the messages of an agent.'''
+        agent = self.state['agents'].setdefault(id, {'id': id, 'messages': []})
+        agent['messages'] = messages
+        await self.send_patch({'agents': {id: {**agent, 'messages': list(messages)}}})
+
+    async def add_message_delta(self, id: str, delta: dict):
+        '''Forward a partial assistant message while it is being generated. The complete message follows through add_message.'''
+        await self.send_to_client({'state': 'delta', 'id': id, 'delta': delta})
+
+    async def add_output(self, id: str, stream: str, text: str):
+        '''Forward live output of a running command. The complete result follows through add_message.'''
+        await self.send_to_client({'state': 'output', 'id': id, 'stream': stream, 'text': text})
 
 class WebServer:
     def __init__(self, args, on_new_session):
@@ -116,11 +289,51 @@ class WebServer:
         aiohttp_session.setup(self.app, jar)
         self.app.add_routes([
             web.get('/', self.index),
-            web.get('/ws', self.websocket_handler)
+            web.get('/ws', self.websocket_handler),
+            web.get('/stats', self.stats_handler),
+            web.get('/metrics', self.metrics_handler),
+            web.get('/trace', self.trace_handler)
         ])
     
     async def run(self):
-        await web._run_app(self.app)
+        await http_client.start()
+        # also kills what a previous server left behind
+        reaper.start()
+        try:
+            await web._run_app(self.app)
+        finally:
+            await asyncio.gather(*[s.close() for s in self.current_sessions.values()])
+            await reaper.close()
+            await http_client.close()
+
+    async def stats_handler(self, request):
+        websocket = {}
+        for s in self.current_sessions.values():
+            for key, value in s.counters.items():
+                websocket[key] = websocket.get(key, 0) + value
+        return web.json_response({
+            'http': http_client.stats(),
+            'search_cache': search_cache.stats(),
+            'python_kernels': kernel_pool.stats(),
+            'websocket': websocket,
+            'usage': usage_ledger.stats(),
+            'openai': openai_scheduler.stats(),
+            'retrieval': chunk_ranker.stats(),
+            'resources': {**reaper.stats(), 'runners': {
+                s.agent.name: s.agent.resources.stats() for s in self.current_sessions.values() if getattr(s.agent, 'resources', None)}},
+        })
+
+    async def metrics_handler(self, request):
+        return web.Response(body=usage_ledger.prometheus().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def trace_handler(self, request):
+        '''Chrome trace of the runner of this client's session.'''
+        session = await aiohttp_session.get_session(request)
+        s = self.current_sessions.get(session.get('id'))
+        tracer = getattr(s.agent, 'tracer', None) if s else None
+        if tracer is None:
+            raise web.HTTPNotFound(text='No runner in this session')
+        return web.json_response(tracer.chrome_trace(), headers={'Content-Disposition': f'attachment; filename="{tracer.name}.trace.json"'})
 
     async def index(self, request):
         session = await aiohttp_session.get_session(request)
@@ -134,7 +347,7 @@ class WebServer:
 
     async def websocket_handler(self, request: web.Request):
         session = await aiohttp_session.get_session(request)
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(compress=WS_COMPRESS)
         await ws.prepare(request)
         print(f'WebSocket connection with {request.remote} ({" ".join(request.headers["User-Agent"].split()[-2:])}) opened')
 
@@ -147,7 +360,8 @@ class WebServer:
             await self.on_new_session(self.args, s)
         else:
             s.update(request, ws)
-            await s.send_init_state()
+            seq = request.query.get('seq')
+            await s.sync(request.query.get('epoch'), int(seq) if seq and seq.isdigit() else None)
 
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
@@ -0,0 +1,136 @@
+'''Measure the agent loop against a local stand-in for the OpenAI API, offline.
+
+Usage: python -m benchmarks.bench_agent [--turns N] [--fanout K] [--sessions S] [--concurrency C]
+                                        [--latency MS] [--stream] [--json OUT]
+
+Scenarios (see benchmarks/mock_openai.py for the scripted replies):
+  turns     one agent taking N turns: time per turn spent outside the API, p50 and p99
+  fanout    one agent assigning K workers in turn: cost of each ASSIGN, p50 and p99
+  sessions  S whole AgentRunner sessions, C at a time: sessions per second and latency
+
+The completion cache and the rate limiter are disabled, and the agents' output is
+discarded, so that the numbers are the loop's own overhead plus the --latency of the mock.
+'''
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from .mock_openai import MockOpenAI
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+def summary(values: list[float]) -> dict:
+    '''Milliseconds.'''
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000 if values else 0.,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values, default=0.) * 1000,
+    }
+
+def intervals(mock: MockOpenAI, goal: str) -> list[float]:
+    '''Time between the successive requests of the agents with this goal.'''
+    times = [t for t, g in mock.requests if g == goal]
+    return [b - a for a, b in zip(times, times[1:])]
+
+class Args(dict):
+    __getattr__ = dict.get
+
+async def run_session(args: Args, goal: str) -> float:
+    from app.agent_runner import AgentRunner
+    start = time.perf_counter()
+    context = AgentRunner(args)
+    await context.run(goal)
+    return time.perf_counter() - start
+
+async def bench_turns(mock: MockOpenAI, args: Args, turns: int) -> dict:
+    goal = f'turns:{turns}'
+    mock.requests.clear()
+    total = await run_session(args, goal)
+    overhead = [t - mock.latency for t in intervals(mock, goal)]
+    return {'turns': turns, 'total_s': total, 'overhead': summary(overhead)}
+
+async def bench_fanout(mock: MockOpenAI, args: Args, workers: int) -> dict:
+    goal = f'fanout:{workers}'
+    mock.requests.clear()
+    total = await run_session(args, goal)
+    # between two requests of the main agent: one worker's whole life, which is a single completion
+    overhead = [t - 2 * mock.latency for t in intervals(mock, goal)]
+    return {'workers': workers, 'total_s': total, 'assign': summary(overhead)}
+
+async def bench_sessions(mock: MockOpenAI, args: Args, sessions: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    async def one(i):
+        async with semaphore:
+            return await run_session(Args(args, name=f'session-{i}'), 'turns:2')
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(one(i) for i in range(sessions)))
+    total = time.perf_counter() - start
+    return {'sessions': sessions, 'concurrency': concurrency, 'total_s': total,
+            'sessions_per_s': sessions / total, 'latency': summary(latencies)}
+
+async def bench(options) -> dict:
+    from app import chat
+    from app.rate_limit import TokenBucket, openai_scheduler
+    from openai import AsyncOpenAI
+    mock = MockOpenAI(options.latency / 1000.)
+    base_url = await mock.start()
+    chat.set_client(AsyncOpenAI(base_url=base_url, api_key='mock', max_retries=0))
+    chat.set_completion_cache(None)
+    openai_scheduler.requests = TokenBucket(0)
+    openai_scheduler.tokens = TokenBucket(0)
+    args = Args(model='gpt-4o-mini', stream=options.stream)
+    results = {'latency_ms': options.latency, 'stream': options.stream}
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='bench-agent-')
+    os.chdir(directory)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if options.turns:
+                results['turns'] = await bench_turns(mock, args, options.turns)
+            if options.fanout:
+                results['fanout'] = await bench_fanout(mock, args, options.fanout)
+            if options.sessions:
+                results['sessions'] = await bench_sessions(mock, args, options.sessions, options.concurrency)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+        chat.set_client(None)
+        await mock.close()
+    results['requests'] = openai_scheduler.counters['requests']
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=50, help='Turns of the single agent (0 to skip)')
+    parser.add_argument('--fanout', type=int, default=20, help='Workers assigned by the main agent (0 to skip)')
+    parser.add_argument('--sessions', type=int, default=50, help='Sessions to run (0 to skip)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Sessions running at once')
+    parser.add_argument('--latency', type=float, default=0., help='Delay of each mock completion, in milliseconds')
+    parser.add_argument('--stream', action='store_true', help='Stream the completions')
+    parser.add_argument('--json', help='Write the results to this file')
+    options = parser.parse_args()
+    result = asyncio.run(bench(options))
+    if 'turns' in result:
+        o = result['turns']['overhead']
+        print(f"turns:    {result['turns']['turns']} turns, overhead per turn {o['p50_ms']:.2f} ms p50, {o['p99_ms']:.2f} ms p99")
+    if 'fanout' in result:
+        o = result['fanout']['assign']
+        print(f"fanout:   {result['fanout']['workers']} workers, cost per ASSIGN {o['p50_ms']:.2f} ms p50, {o['p99_ms']:.2f} ms p99")
+    if 'sessions' in result:
+        s = result['sessions']
+        print(f"sessions: {s['sessions_per_s']:.1f}/s at concurrency {s['concurrency']}, latency {s['latency']['p50_ms']:.1f} ms p50, {s['latency']['p99_ms']:.1f} ms p99")
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(result, f, indent=2)
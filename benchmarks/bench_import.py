@@ -0,0 +1,74 @@
+'''Measure the time it takes to import the server, in fresh interpreters.
+
+Usage: python -m benchmarks.bench_import [MODULE] [-n REPEAT] [--json OUT] [--max-ms MS]
+
+Reports the wall time of `python -c "import MODULE"` and the slowest modules according
+to `python -X importtime`. Exits with status 1 if the median is over --max-ms, or if one
+of the modules that must stay lazy (openai, bs4) was imported.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Only needed once a command or a completion runs
+LAZY_MODULES = ('openai', 'bs4')
+
+def run(module: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f'import {module}'], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+def import_times(module: str) -> dict[str, int]:
+    '''Cumulative import time of every module, in microseconds.'''
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+def bench(module: str, repeat: int) -> dict:
+    baseline = statistics.median(run('sys') for _ in range(repeat))
+    times = [run(module) for _ in range(repeat)]
+    modules = import_times(module)
+    slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:15]
+    return {
+        'module': module,
+        'interpreter_ms': baseline * 1000,
+        'median_ms': statistics.median(times) * 1000,
+        'min_ms': min(times) * 1000,
+        'max_ms': max(times) * 1000,
+        'import_ms': modules.get(module, 0) / 1000,
+        'slowest': {name: us / 1000 for name, us in slowest},
+        'lazy_imported': [name for name in LAZY_MODULES if name in modules],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('module', nargs='?', default='app.agent_runner', help='Module to import')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Number of fresh interpreters')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--max-ms', type=float, help='Fail if the median wall time is over this')
+    args = parser.parse_args()
+    result = bench(args.module, args.repeat)
+    print(f"{result['module']}: {result['median_ms']:.1f} ms median ({result['interpreter_ms']:.1f} ms for the interpreter alone), import {result['import_ms']:.1f} ms")
+    for name, ms in result['slowest'].items():
+        print(f"  {ms:8.1f} ms  {name}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    failed = False
+    if result['lazy_imported']:
+        print(f"Imported at startup: {', '.join(result['lazy_imported'])}")
+        failed = True
+    if args.max_ms and result['median_ms'] > args.max_ms:
+        print(f"Over the {args.max_ms} ms limit")
+        failed = True
+    sys.exit(1 if failed else 0)
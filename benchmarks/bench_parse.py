@@ -0,0 +1,70 @@
+'''Compare the HTML extraction backends of app.scrape over a corpus of saved pages.
+
+Usage: python -m benchmarks.bench_parse [FILE_OR_DIR ...] [-n REPEAT] [--json OUT]
+
+Without a corpus, synthetic pages of increasing size are used.
+'''
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+from app.scrape import BACKENDS, cleanText
+
+def synthetic_corpus() -> dict[str, str]:
+    corpus = {}
+    for paragraphs in (10, 100, 1000, 10000):
+        body = '\n'.join(f'<div class="p"><p>Paragraph {i} with <a href="/link/{i}">a link</a> and <b>some</b> text.</p></div>' for i in range(paragraphs))
+        corpus[f'synthetic-{paragraphs}'] = f'<html><head><title>Test</title><script>var x = 1;</script></head><body><nav>menu</nav><article>{body}</article></body></html>'
+    return corpus
+
+def load_corpus(paths: list[str]) -> dict[str, str]:
+    corpus = {}
+    for path in paths:
+        files = glob.glob(os.path.join(path, '**', '*.htm*'), recursive=True) if os.path.isdir(path) else [path]
+        for file in sorted(files):
+            with open(file, 'r', errors='replace') as f:
+                corpus[os.path.relpath(file)] = f.read()
+    return corpus
+
+def bench(corpus: dict[str, str], repeat: int) -> dict:
+    results = {}
+    for name, parse in BACKENDS.items():
+        pages = {}
+        total_time = 0.
+        for page, html in corpus.items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                _, text = parse(html)
+                cleanText(text)
+                times.append(time.perf_counter() - start)
+            total_time += min(times)
+            pages[page] = {
+                'bytes': len(html),
+                'min_ms': min(times) * 1000,
+                'median_ms': statistics.median(times) * 1000,
+            }
+        total_bytes = sum(len(html) for html in corpus.values())
+        results[name] = {
+            'total_ms': total_time * 1000,
+            'mb_per_s': total_bytes / total_time / 1e6 if total_time else 0.,
+            'pages': pages,
+        }
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='*', help='HTML files or directories of saved pages')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Runs per page (the fastest is kept)')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    results = bench(corpus, args.repeat)
+    for name, result in results.items():
+        print(f"{name:12} {result['total_ms']:10.1f} ms {result['mb_per_s']:8.2f} MB/s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
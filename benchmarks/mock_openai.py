@@ -0,0 +1,140 @@
+'''A local stand-in for the OpenAI API, answering with scripted function calls.
+
+Usage: python -m benchmarks.mock_openai [--port 8000] [--latency MS]
+Then run the server with OPENAI_BASE_URL=http://localhost:8000/v1.
+
+Serves /v1/models and /v1/chat/completions (streamed or not). Replies follow the goal
+given to the agent:
+  turns:N    WRITE a small file N times, then COMPLETE
+  fanout:K   ASSIGN K workers, each with the goal turns:0, then COMPLETE
+  parallel:K ASSIGN K workers in the background, each with the goal turns:1, WAIT for them, then COMPLETE
+  anything   COMPLETE right away, with the goal as content
+'''
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from typing import Callable, Optional
+
+from aiohttp import web
+
+MODELS = ['gpt-4o', 'gpt-4o-mini', 'gpt-4-turbo', 'gpt-3.5-turbo']
+
+def get_goal(messages: list[dict]) -> str:
+    for message in messages:
+        if message.get('role') == 'user':
+            try:
+                return str(json.loads(message['content']).get('main_goal', ''))
+            except (ValueError, AttributeError):
+                return message['content'] or ''
+    return ''
+
+def call(name: str, **arguments) -> dict:
+    return {'role': 'assistant', 'content': None, 'function_call': {'name': name, 'arguments': json.dumps(arguments)}}
+
+def scripted_reply(messages: list[dict]) -> dict:
+    '''The next assistant message of an agent, from its goal and the number of results it got.'''
+    goal = get_goal(messages)
+    done = sum(1 for m in messages if m.get('role') == 'function')
+    kind, _, count = goal.partition(':')
+    if kind == 'turns' and count.isdigit():
+        if done < int(count):
+            return call('WRITE', filename=f'turn{done}.txt', content='x')
+        return call('COMPLETE', status='success', content=f'{count} turns')
+    if kind == 'fanout' and count.isdigit():
+        if done < int(count):
+            return call('ASSIGN', agent_id='worker', content='turns:0')
+        return call('COMPLETE', status='success', content=f'{count} workers')
+    if kind == 'parallel' and count.isdigit():
+        if done < int(count):
+            return call('ASSIGN', agent_id='worker', content='turns:1', background=True)
+        if done == int(count):
+            return call('WAIT')
+        results = json.loads(messages[-1]['content'])
+        return call('COMPLETE', status='success', content=f'{sum(1 for r in results.values() if isinstance(r, dict))} workers')
+    return call('COMPLETE', status='success', content=goal)
+
+def count_tokens(data) -> int:
+    return len(json.dumps(data)) // 4
+
+class MockOpenAI:
+    '''Mock API server, recording the time and goal of each completion request.'''
+
+    def __init__(self, latency: float = 0., script: Callable[[list[dict]], dict] = scripted_reply):
+        self.latency = latency
+        self.script = script
+        self.requests: list[tuple[float, str]] = []
+        self.app = web.Application()
+        self.app.add_routes([
+            web.get('/v1/models', self.models),
+            web.post('/v1/chat/completions', self.completions),
+        ])
+        self.runner: Optional[web.AppRunner] = None
+        self.base_url = ''
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{port}/v1'
+        return self.base_url
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def models(self, request: web.Request):
+        return web.json_response({'object': 'list', 'data': [{'id': m, 'object': 'model', 'created': 0, 'owned_by': 'mock'} for m in MODELS]})
+
+    async def completions(self, request: web.Request):
+        body = await request.json()
+        messages = body['messages']
+        self.requests.append((time.perf_counter(), get_goal(messages)))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message = self.script(messages)
+        usage = {'prompt_tokens': count_tokens(messages), 'completion_tokens': count_tokens(message)}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        finish_reason = 'function_call' if message.get('function_call') else 'stop'
+        base = {'id': f'chatcmpl-{uuid.uuid4().hex[:12]}', 'created': int(time.time()), 'model': body['model']}
+        if not body.get('stream'):
+            return web.json_response({**base, 'object': 'chat.completion', 'usage': usage,
+                                      'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}]})
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        async def send(data):
+            await response.write(f'data: {json.dumps(data)}\n\n'.encode())
+        def chunk(delta, finish_reason=None):
+            return {**base, 'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+        await send(chunk({'role': 'assistant', 'content': message['content']}))
+        if message.get('function_call'):
+            function_call = message['function_call']
+            await send(chunk({'function_call': {'name': function_call['name'], 'arguments': ''}}))
+            arguments = function_call['arguments']
+            for i in range(0, len(arguments), 16):
+                await send(chunk({'function_call': {'arguments': arguments[i:i + 16]}}))
+        await send(chunk({}, finish_reason))
+        if body.get('stream_options', {}).get('include_usage'):
+            await send({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+async def serve(port: int, latency: float):
+    mock = MockOpenAI(latency)
+    print(f'Mock OpenAI API on {await mock.start(port=port)}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await mock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0., help='Delay of each completion, in milliseconds')
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.latency / 1000.))
@@ -0,0 +1,44 @@
+import os
+import tempfile
+from contextlib import asynccontextmanager, contextmanager
+
+from app import chat
+from benchmarks.mock_openai import MockOpenAI, scripted_reply
+
+class Args(dict):
+    '''Command line arguments, as the runner reads them.'''
+    __getattr__ = dict.get
+    __setattr__ = dict.__setitem__
+
+@contextmanager
+def temp_cwd():
+    '''Work in a temporary directory, where runners create their files and journals.'''
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+@asynccontextmanager
+async def mock_api(latency: float = 0., script=scripted_reply):
+    '''Send completions to a local mock server, bypassing the completion cache.'''
+    from openai import AsyncOpenAI
+    server = MockOpenAI(latency=latency, script=script)
+    client = AsyncOpenAI(base_url=await server.start(), api_key='mock', max_retries=0)
+    chat.set_client(client)
+    cache = chat.completion_cache
+    chat.set_completion_cache(None)
+    try:
+        yield server
+    finally:
+        chat.set_client(None)
+        chat.completion_cache = cache
+        await client.close()
+        await server.close()
+
+async def close_runner(context):
+    '''Close what running a runner would have, for one that wasn't run.'''
+    await context.resources.close()
+    await context.journal.close()
@@ -0,0 +1,52 @@
+import json
+import unittest
+import aiounittest
+
+from app.budget import Budget, BudgetExceeded
+from app.usage import Usage
+from tests.helpers import Args
+
+class Context:
+    def __init__(self, limits):
+        self.path = '.'
+        self.usage = Usage()
+        self.budget = Budget('session', self.usage, limits)
+
+
+class TestBudget(aiounittest.AsyncTestCase):
+
+    def test_nested_budgets(self):
+        session_usage, agent_usage = Usage(), Usage()
+        session = Budget('session', session_usage, {'tokens': 1000, 'turns': None})
+        agent = Budget('worker', agent_usage, {'tokens': 500, 'turns': 3}, parent=session)
+        agent.check()
+        for usage in (session_usage, agent_usage):
+            usage.add('total_tokens', 400)
+            usage.add('turns', 1)
+        self.assertEqual(agent.remaining(), {'tokens': 100, 'turns': 2})
+        with self.assertRaises(BudgetExceeded):
+            agent.check(prompt_tokens=200)
+        session_usage.add('total_tokens', 600)
+        with self.assertRaisesRegex(BudgetExceeded, 'session'):
+            agent.check()
+
+    async def test_chat_checked_before_request(self):
+        from app.chat import ChatSession
+        usage = Usage()
+        usage.add('turns', 2)
+        chat = ChatSession('gpt-4o', accounts=[usage], budget=Budget('main', usage, {'turns': 2}))
+        chat.add_message('hello')
+        with self.assertRaises(BudgetExceeded):
+            await chat.chat()
+
+    async def test_agent_completes_with_failure(self):
+        from app.agent import Agent
+        context = Context({'dollars': 1.})
+        context.usage.add('total_dollars', 2.)
+        main = Agent(Args(model='gpt-4o'), context)
+        worker = Agent(Args(model='gpt-4o'), context, name='worker', role='worker', parent=main)
+        worker.chat_session.add_message('task')
+        await worker.run()
+        result = json.loads(worker.result())
+        self.assertEqual(result['status'], 'failure')
+        self.assertIn('budget of session', result['content'])
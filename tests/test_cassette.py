@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import aiounittest
+
+from app.agent_runner import AgentRunner, replay
+from app.cassette import Cassette, CassetteMiss, current_cassette, recorded
+from tests.helpers import Args, mock_api, temp_cwd
+
+
+class TestCassette(aiounittest.AsyncTestCase):
+
+    async def test_identical_requests_in_order(self):
+        calls = []
+        @recorded('page')
+        async def fetch(url):
+            calls.append(url)
+            return f'{url} #{len(calls)}'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'runner.jsonl')
+            cassette = Cassette(path)
+            token = current_cassette.set(cassette)
+            try:
+                self.assertEqual([await fetch('a'), await fetch('b'), await fetch('a')], ['a #1', 'b #2', 'a #3'])
+            finally:
+                current_cassette.reset(token)
+            await cassette.close()
+            cassette = Cassette(path, replay=True)
+            token = current_cassette.set(cassette)
+            try:
+                self.assertEqual([await fetch('a'), await fetch('a'), await fetch('b')], ['a #1', 'a #3', 'b #2'])
+                with self.assertRaises(CassetteMiss):
+                    await fetch('a')
+            finally:
+                current_cassette.reset(token)
+            self.assertEqual(len(calls), 3)
+            self.assertEqual(cassette.stats()['replayed'], 3)
+
+    async def test_failures_replayed(self):
+        import openai
+        errors = [ConnectionResetError('reset by peer'), openai.APITimeoutError(None)]
+        @recorded('page')
+        async def fetch(url):
+            if errors:
+                raise errors.pop(0)
+            return url
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'runner.jsonl')
+            cassette = Cassette(path)
+            token = current_cassette.set(cassette)
+            try:
+                for error in (ConnectionResetError, openai.APITimeoutError):
+                    with self.assertRaises(error):
+                        await fetch('a')
+                self.assertEqual(await fetch('a'), 'a')
+            finally:
+                current_cassette.reset(token)
+            await cassette.close()
+            cassette = Cassette(path, replay=True)
+            token = current_cassette.set(cassette)
+            try:
+                with self.assertRaisesRegex(ConnectionResetError, 'reset by peer'):
+                    await fetch('a')
+                with self.assertRaisesRegex(openai.APITimeoutError, 'timed out'):
+                    await fetch('a')
+                self.assertEqual(await fetch('a'), 'a')
+            finally:
+                current_cassette.reset(token)
+            self.assertEqual(cassette.stats()['replayed'], 3)
+
+    async def record_session(self, goal: str) -> AgentRunner:
+        async with mock_api():
+            context = AgentRunner(Args(model='gpt-4o-mini', record=True))
+            await context.run(goal)
+        return context
+
+    async def test_replay_session(self):
+        with temp_cwd(), mock.patch('app.chat.completion_cache', None):
+            recording = await self.record_session('fanout:2')
+            # no server to answer now
+            replayed = await replay(Args(model='gpt-4o', replay=recording.name))
+            self.assertEqual(replayed.main_agent.result(), recording.main_agent.result())
+            self.assertEqual(replayed.usage['total_tokens'], recording.usage['total_tokens'])
+            self.assertEqual(replayed.cassette.stats()['replayed'], 6)
+            self.assertEqual(replayed.cassette.stats()['unused'], 0)
+
+            # a prompt change replays the recorded completions of each agent in order
+            with mock.patch('app.agent.getSystemPrompt', return_value='Changed prompt'):
+                changed = await replay(Args(model='gpt-4o', replay=recording.name))
+            self.assertEqual(changed.main_agent.result(), recording.main_agent.result())
+            self.assertEqual(changed.cassette.stats()['mismatched'], 5)
+            with mock.patch('app.agent.getSystemPrompt', return_value='Changed prompt'):
+                cassette = Cassette(Cassette.path_for(recording.name), replay=True, strict=True)
+                with self.assertRaises(CassetteMiss):
+                    await AgentRunner(Args(model='gpt-4o'), cassette=cassette).run()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+import aiounittest
+import openai
+
+from app import chat
+from app.chat import ChatSession
+from app.rate_limit import RequestScheduler
+
+def chunk(content=None, name=None, arguments=None, role=None, usage=None):
+    if usage:
+        return SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=usage[0], completion_tokens=usage[1]))
+    function_call = SimpleNamespace(name=name, arguments=arguments) if name is not None or arguments is not None else None
+    delta = SimpleNamespace(role=role, content=content, function_call=function_call)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+class stream:
+    '''A streamed completion, as the client returns it.'''
+
+    def __init__(self, chunks: list, error: Exception = None):
+        self.chunks = chunks
+        self.error = error
+        self.closed = False
+
+    async def __aiter__(self):
+        for c in self.chunks:
+            yield c
+        if self.error:
+            raise self.error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        self.closed = True
+
+CHUNKS = [
+    chunk('Let me ', role='assistant'),
+    chunk('finish.'),
+    chunk(name='COMP'),
+    chunk(name='LETE', arguments='{"status": '),
+    # nothing in it: not forwarded
+    chunk(name='', arguments=''),
+    chunk(arguments='"success"}'),
+    chunk(usage=(10, 5)),
+]
+
+def fake_client(create) -> mock.Mock:
+    client = mock.Mock()
+    client.chat.completions.create = create
+    return client
+
+
+class TestChatSession(aiounittest.AsyncTestCase):
+
+    async def respond(self, session: ChatSession, client, scheduler: RequestScheduler) -> dict:
+        chat.set_client(client)
+        try:
+            with mock.patch('app.chat.completion_cache', None), mock.patch('app.chat.openai_scheduler', scheduler):
+                return await session.respond(100)
+        finally:
+            chat.set_client(None)
+
+    async def test_refund_on_failure(self):
+        scheduler = RequestScheduler(tpm=60000)
+        session = ChatSession('gpt-4o')
+        with self.assertRaises(ValueError):
+            await self.respond(session, fake_client(mock.AsyncMock(side_effect=ValueError('bad request'))), scheduler)
+        # nothing was used: the whole estimate is given back
+        self.assertAlmostEqual(scheduler.tokens.level, 60000, delta=10)
+
+    async def test_stream_deltas(self):
+        deltas = []
+        async def on_delta(delta):
+            deltas.append(delta)
+        session = ChatSession('gpt-4o', stream=True, on_delta=on_delta)
+        response = stream(CHUNKS)
+        create = mock.AsyncMock(return_value=response)
+        dmsg = await self.respond(session, fake_client(create), RequestScheduler())
+        self.assertTrue(response.closed)
+        self.assertEqual(dmsg, {'role': 'assistant', 'content': 'Let me finish.',
+                                'function_call': {'name': 'COMPLETE', 'arguments': '{"status": "success"}'}})
+        self.assertEqual(deltas, [
+            {'content': 'Let me '},
+            {'content': 'finish.'},
+            {'function_call': {'name': 'COMP'}},
+            {'function_call': {'name': 'LETE', 'arguments': '{"status": '}},
+            {'function_call': {'arguments': '"success"}'}},
+        ])
+        self.assertEqual(session.usage, {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15})
+        self.assertTrue(create.call_args.kwargs['stream'])
+
+    async def test_stream_retry_resets(self):
+        deltas = []
+        async def on_delta(delta):
+            deltas.append(delta)
+        session = ChatSession('gpt-4o', stream=True, on_delta=on_delta)
+        streams = [stream(CHUNKS[:2], openai.APITimeoutError(None)), stream(CHUNKS)]
+        create = mock.AsyncMock(side_effect=list(streams))
+        dmsg = await self.respond(session, fake_client(create), RequestScheduler(base_delay=.01))
+        # the failed stream too
+        self.assertTrue(all(s.closed for s in streams))
+        self.assertEqual(dmsg['content'], 'Let me finish.')
+        self.assertEqual(create.await_count, 2)
+        # the client drops what it showed of the failed attempt
+        self.assertEqual(deltas[:3], [{'content': 'Let me '}, {'content': 'finish.'}, {'reset': True}])
+        self.assertEqual(''.join(d.get('content', '') for d in deltas[3:]), 'Let me finish.')
+        self.assertEqual(session.usage['total_tokens'], 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
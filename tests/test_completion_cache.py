@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+import aiounittest
+
+from app.completion_cache import CompletionCache
+
+class TestCompletionCache(aiounittest.AsyncTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_hit_and_miss(self):
+        cache = CompletionCache(self.dir.name)
+        key = cache.key('gpt-4o', [{'role': 'user', 'content': 'hello'}], [])
+        self.assertNotEqual(key, cache.key('gpt-4o', [{'role': 'user', 'content': 'hello!'}], []))
+        self.assertIsNone(await cache.get(key))
+        await cache.put(key, {'role': 'assistant', 'content': 'hi'})
+        self.assertEqual(await cache.get(key), {'role': 'assistant', 'content': 'hi'})
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    async def test_persistence(self):
+        cache = CompletionCache(self.dir.name)
+        await cache.put('abcd', {'content': 'hi'})
+        cache = CompletionCache(self.dir.name)
+        self.assertEqual(await cache.get('abcd'), {'content': 'hi'})
+
+    async def test_lru_eviction(self):
+        cache = CompletionCache(self.dir.name, max_bytes=170)
+        for key in ['aa01', 'aa02', 'aa03']:
+            await cache.put(key, {'content': key * 10})
+        # refresh the oldest entry, the next one becomes the eviction candidate
+        await cache.get('aa01')
+        await cache.put('aa04', {'content': 'aa04' * 10})
+        self.assertLessEqual(cache.size, 170)
+        self.assertIsNotNone(await cache.get('aa01'))
+        self.assertIsNone(await cache.get('aa02'))
+        self.assertGreater(cache.stats()['evictions'], 0)
+
+    async def test_write_failure(self):
+        cache = CompletionCache(self.dir.name)
+        # where the entry's directory should be
+        open(os.path.join(self.dir.name, 'ab'), 'w').close()
+        await cache.put('abcd', {'content': 'hi'})
+        self.assertIsNone(await cache.get('abcd'))
+        await cache.put('cdef', {'content': 'hi'})
+        self.assertEqual(os.listdir(os.path.join(self.dir.name, 'cd')), ['cdef.json'])
+
+if __name__ == '__main__':
+    unittest.main()
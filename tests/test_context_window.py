@@ -0,0 +1,44 @@
+import unittest
+
+from app.context_window import ContextWindow
+
+def history(turns: int, output_size: int = 2000):
+    messages = [{'role': 'system', 'content': 'system prompt'}, {'role': 'user', 'content': 'main goal'}]
+    for i in range(turns):
+        messages.append({'role': 'assistant', 'content': None, 'function_call': {'name': 'RUN', 'arguments': f'{{"content": "cat file{i}"}}'}})
+        messages.append({'role': 'function', 'name': 'RUN', 'content': f'{i}' * output_size})
+    return messages
+
+
+class TestContextWindow(unittest.TestCase):
+
+    def test_under_budget(self):
+        window = ContextWindow('gpt-4o', budget=100000)
+        messages = history(3)
+        self.assertIsNone(window.fit(messages))
+        self.assertEqual(len(messages), 8)
+
+    def test_compaction_keeps_protected_messages(self):
+        window = ContextWindow('gpt-4o', budget=2000)
+        messages = history(20)
+        last_call, last_result = messages[-2], messages[-1]
+        stats = window.fit(messages)
+        self.assertIsNotNone(stats)
+        self.assertLessEqual(window.total(messages), 2000)
+        self.assertEqual(stats['saved'], stats['before'] - stats['after'])
+        self.assertEqual(window.tokens_saved, stats['saved'])
+        self.assertEqual(messages[0]['content'], 'system prompt')
+        self.assertEqual(messages[1]['content'], 'main goal')
+        self.assertIs(messages[-2], last_call)
+        self.assertIs(messages[-1], last_result)
+
+    def test_dropped_turns_keep_call_result_pairs(self):
+        window = ContextWindow('gpt-4o', budget=1500)
+        messages = history(20)
+        window.fit(messages)
+        for i, message in enumerate(messages):
+            if message['role'] == 'function':
+                self.assertIn('function_call', messages[i - 1])
+
+if __name__ == '__main__':
+    unittest.main()
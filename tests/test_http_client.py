@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+from unittest import mock
+import aiounittest
+from aiohttp import web
+
+from app.http_client import ClientManager
+
+async def serve() -> tuple[web.AppRunner, str]:
+    async def hello(request):
+        return web.Response(text='hello')
+    app = web.Application()
+    app.add_routes([web.get('/', hello)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/'
+
+
+class TestClientManager(aiounittest.AsyncTestCase):
+
+    async def test_connection_reused(self):
+        manager = ClientManager()
+        runner, url = await serve()
+        try:
+            session = await manager.session()
+            for _ in range(2):
+                async with session.get(url) as response:
+                    self.assertEqual(await response.text(), 'hello')
+            self.assertIs(await manager.session(), session)
+            stats = manager.stats()
+        finally:
+            await manager.close()
+            await runner.cleanup()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['connections_created'], 1)
+        self.assertEqual(stats['connections_reused'], 1)
+        self.assertEqual((stats['connections_in_use'], stats['connections_idle']), (0, 1))
+
+    def test_new_event_loop(self):
+        manager = ClientManager()
+        first = asyncio.run(manager.session())
+        second = asyncio.run(manager.session())
+        self.assertIsNot(first, second)
+        # the session of the previous loop isn't left open
+        self.assertTrue(first.closed)
+        asyncio.run(manager.close())
+        self.assertTrue(second.closed)
+
+    def test_stats_without_pool_internals(self):
+        manager = ClientManager()
+        self.assertEqual(manager.stats()['connections_idle'], 0)
+        manager._session = mock.Mock(connector=object())
+        stats = manager.stats()
+        self.assertIsNone(stats['connections_in_use'])
+        self.assertIsNone(stats['connections_idle'])
+
+
+if __name__ == '__main__':
+    unittest.main()
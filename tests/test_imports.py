@@ -0,0 +1,13 @@
+import subprocess
+import sys
+import unittest
+
+from benchmarks.bench_import import LAZY_MODULES, ROOT
+
+class TestImports(unittest.TestCase):
+
+    def test_lazy_dependencies(self):
+        '''Dependencies only needed by commands or completions aren't imported at startup.'''
+        code = f'import sys, app.agent_runner; print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+        process = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+        self.assertEqual(process.stdout.strip(), '')
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+import aiounittest
+
+from app.journal import Journal
+from app.agent_runner import AgentRunner
+from tests.helpers import Args, close_runner, temp_cwd
+
+
+class TestJournal(aiounittest.AsyncTestCase):
+
+    async def test_batched_records(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = Journal(os.path.join(tmp, 'j', 'runner.jsonl'), flush_interval=0.01)
+            for i in range(10):
+                journal.record('message', agent='main', i=i)
+            await journal.close()
+            records = Journal.read(journal.path)
+            self.assertEqual([r['i'] for r in records], list(range(10)))
+            self.assertLess(journal.batches, 10)
+
+    async def test_torn_line_skipped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'runner.jsonl')
+            with open(path, 'w') as f:
+                f.write(json.dumps({'type': 'state', 'agent': 'main', 'state': 'running'}) + '\n{"type": "mess')
+            self.assertEqual(len(Journal.read(path)), 1)
+
+    async def test_resume_rebuilds_tree(self):
+        with temp_cwd():
+            args = Args(model='gpt-4')
+            runner = AgentRunner(args)
+            main = runner.main_agent
+            main.chat_session.add_message('goal')
+            main.chat_session.append({'role': 'assistant', 'content': None,
+                                      'function_call': {'name': 'ASSIGN', 'arguments': '{}'}})
+            worker = main.__class__(args, runner, name='worker', role='worker', parent=main)
+            runner.add_agent(worker)
+            worker.chat_session.add_message('task')
+            main.chat_session.messages[:] = main.chat_session.messages[-1:]
+            main.chat_session.changed('compact', {'messages': main.chat_session.messages, 'stats': {}})
+            await close_runner(runner)
+
+            resumed = await AgentRunner.resume(args, 'last')
+            self.assertEqual(resumed.name, runner.name)
+            self.assertEqual(list(resumed.agents), ['main', 'worker'])
+            self.assertIs(resumed.agents['worker'].parent, resumed.main_agent)
+            self.assertEqual(resumed.main_agent.chat_session.messages, main.chat_session.messages)
+            self.assertEqual(resumed.agents['worker'].chat_session.messages[-1]['content'], 'task')
+            self.assertEqual(resumed.parent_turns['worker'], 2)
+            await close_runner(resumed)
+
+    async def test_cancelled_agent_resumed(self):
+        with temp_cwd():
+            args = Args(model='gpt-4')
+            runner = AgentRunner(args)
+            main = runner.main_agent
+            main.chat_session.add_message('goal')
+            async def hang():
+                await asyncio.Event().wait()
+            main.chat_session.chat = hang
+            task = asyncio.create_task(main.run_turns())
+            await asyncio.sleep(.05)
+            task.cancel()
+            await task
+            await close_runner(runner)
+
+            resumed = await AgentRunner.resume(args, 'last')
+            self.assertEqual(resumed.states['main'], 'stopped')
+            resumed_turns = []
+            async def run():
+                resumed_turns.append(len(resumed.main_agent.chat_session.messages))
+            resumed.main_agent.run = run
+            await resumed.resume_agent(resumed.main_agent)
+            self.assertEqual(resumed_turns, [1])
+            await close_runner(resumed)
+
+    async def test_resume_twice(self):
+        with temp_cwd():
+            args = Args(model='gpt-4')
+            runner = AgentRunner(args)
+            runner.main_agent.chat_session.add_message('goal')
+            await close_runner(runner)
+
+            resumed = await AgentRunner.resume(args, runner.name)
+            main = resumed.main_agent
+            worker = main.__class__(args, resumed, name='worker', role='worker', parent=main)
+            resumed.add_agent(worker)
+            worker.chat_session.add_message('task')
+            await close_runner(resumed)
+
+            again = await AgentRunner.resume(args, runner.name)
+            self.assertEqual(list(again.agents), ['main', 'worker'])
+            self.assertEqual(again.agents['worker'].chat_session.messages[-1]['content'], 'task')
+            records = Journal.read(AgentRunner.journal_path(runner.name))
+            self.assertEqual([r['agent'] for r in records if r['type'] == 'agent'], ['main', 'worker'])
+            await close_runner(again)
+
+    async def test_resume_pending_assign(self):
+        with temp_cwd():
+            args = Args(model='gpt-4')
+            runner = AgentRunner(args)
+            main = runner.main_agent
+            main.chat_session.add_message('goal')
+            main.chat_session.append({'role': 'assistant', 'content': None,
+                                      'function_call': {'name': 'ASSIGN', 'arguments': '{}'}})
+            worker = main.__class__(args, runner, name='worker', role='worker', parent=main)
+            runner.add_agent(worker)
+            worker.chat_session.add_message('task')
+            await close_runner(runner)
+
+            resumed = await AgentRunner.resume(args, runner.name)
+            slots = {}
+            async def run(agent, result=None):
+                slots[agent.name] = agent.name in resumed.tasks.holding
+                if result:
+                    agent.chat_session.append({'role': 'assistant', 'content': None,
+                                               'function_call': {'name': 'COMPLETE', 'arguments': result}})
+            resumed.main_agent.run = lambda: run(resumed.main_agent)
+            resumed.agents['worker'].run = lambda: run(resumed.agents['worker'], 'worker done')
+            await resumed.run()
+            # both run as tasks of the runner, holding a slot
+            self.assertEqual(slots, {'worker': True, 'main': True})
+            self.assertIn('worker', resumed.tasks.tasks)
+            self.assertEqual(resumed.main_agent.chat_session.messages[-1]['content'], 'worker done')
@@ -0,0 +1,54 @@
+import tempfile
+import unittest
+import aiounittest
+
+from app.kernel import KernelPool
+
+class TestKernelPool(aiounittest.AsyncTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_stateful(self):
+        pool = KernelPool(size=1)
+        owner = object()
+        try:
+            self.assertEqual(await pool.execute(owner, "x = 41", self.dir.name), (0, '', ''))
+            status, stdout, _ = await pool.execute(owner, "print(x + 1)", self.dir.name)
+            self.assertEqual((status, stdout), (0, '42\n'))
+            status, stdout, _ = await pool.execute(owner, "import os; print(os.getcwd())", self.dir.name)
+            self.assertEqual(stdout.strip(), self.dir.name)
+            status, stdout, stderr = await pool.execute(owner, "1/0", self.dir.name)
+            self.assertEqual(status, 1)
+            self.assertIn('ZeroDivisionError', stdout + stderr)
+        finally:
+            await pool.close()
+
+    async def test_stateless(self):
+        pool = KernelPool(size=1, stateful=False)
+        owner = object()
+        try:
+            await pool.execute(owner, "x = 41", self.dir.name)
+            status, stdout, stderr = await pool.execute(owner, "print(x)", self.dir.name)
+            self.assertEqual(status, 1)
+            self.assertIn('NameError', stdout + stderr)
+        finally:
+            await pool.close()
+
+    async def test_timeout_restarts_kernel(self):
+        pool = KernelPool(size=1, timeout=1)
+        owner = object()
+        try:
+            status, _, stderr = await pool.execute(owner, "import time; time.sleep(10)", self.dir.name)
+            self.assertEqual(status, 1)
+            self.assertIn('timed out', stderr)
+            self.assertEqual(await pool.execute(owner, "print('ok')", self.dir.name), (0, 'ok\n', ''))
+            self.assertEqual(pool.stats()['timeouts'], 1)
+        finally:
+            await pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import json
+import unittest
+import aiounittest
+
+from app.agent_runner import AgentRunner
+from benchmarks.mock_openai import MockOpenAI
+from tests.helpers import Args, mock_api, temp_cwd
+
+
+class TestMockOpenAI(aiounittest.AsyncTestCase):
+
+    async def run_agent(self, goal: str, stream: bool = False) -> tuple[AgentRunner, MockOpenAI]:
+        async with mock_api() as mock:
+            with temp_cwd():
+                context = AgentRunner(Args(model='gpt-4o-mini', stream=stream))
+                await context.run(goal)
+        return context, mock
+
+    async def test_hello_world(self):
+        context, mock = await self.run_agent('hello world')
+        self.assertEqual(json.loads(context.main_agent.result()), {'status': 'success', 'content': 'hello world'})
+        self.assertEqual(len(mock.requests), 1)
+        self.assertGreater(context.usage['total_tokens'], 0)
+
+    async def test_fanout_streamed(self):
+        context, mock = await self.run_agent('fanout:2', stream=True)
+        self.assertEqual(json.loads(context.main_agent.result())['content'], '2 workers')
+        self.assertEqual(len(context.agents), 3)
+        # the main agent's three turns and one for each worker
+        self.assertEqual(len(mock.requests), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
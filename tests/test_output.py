@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+import aiounittest
+
+from app.output import OutputCapture
+
+class TestOutputCapture(aiounittest.AsyncTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_small_output(self):
+        capture = OutputCapture(os.path.join(self.dir.name, 'out'), limit=100)
+        await capture.write(b'hello\n')
+        self.assertEqual(capture.text(), 'hello\n')
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, 'out')))
+
+    async def test_spill(self):
+        path = os.path.join(self.dir.name, 'out')
+        capture = OutputCapture(path, limit=100, head=20, tail=20)
+        data = ''.join(f'line {i}\n' for i in range(50))
+        for line in data.splitlines(keepends=True):
+            await capture.write(line.encode())
+        text = capture.text()
+        self.assertTrue(text.startswith(data[:20]))
+        self.assertTrue(text.endswith(data[-20:]))
+        self.assertIn(path, text)
+        with open(path) as f:
+            self.assertEqual(f.read(), data)
+
+    async def test_live_chunks(self):
+        chunks = []
+        async def on_chunk(text):
+            chunks.append(text)
+        capture = OutputCapture(on_chunk=on_chunk)
+        await capture.write('é'.encode()[:1])
+        await capture.write('é'.encode()[1:] + b'!')
+        await capture.flush()
+        self.assertEqual(''.join(chunks), 'é!')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import asyncio
+import time
+import unittest
+import aiounittest
+import openai
+
+from app.rate_limit import RequestScheduler, TokenBucket
+
+class FakeResponse:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+        self.request = None
+
+def rate_limit_error(retry_after: str):
+    return openai.RateLimitError('rate limited', response=FakeResponse(429, {'retry-after': retry_after}), body=None)
+
+
+class TestRequestScheduler(aiounittest.AsyncTestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(60)
+        self.assertEqual(bucket.wait_time(60), 0)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.wait_time(1), 1, places=1)
+
+    async def test_priority_order(self):
+        scheduler = RequestScheduler(rpm=600)
+        scheduler.requests.level = 0
+        order = []
+        async def call(name):
+            order.append(name)
+        await asyncio.gather(*[scheduler.submit(lambda p=p: call(p), priority=p) for p in (3, 0, 2)])
+        self.assertEqual(order, [0, 2, 3])
+
+    async def test_retry_after(self):
+        scheduler = RequestScheduler(base_delay=10)
+        calls = []
+        async def call():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise rate_limit_error('0.2')
+            return 'ok'
+        self.assertEqual(await scheduler.submit(call), 'ok')
+        self.assertGreaterEqual(calls[1] - calls[0], .2)
+        self.assertEqual(scheduler.counters['rate_limited'], 1)
+
+    async def test_tokens_taken_once(self):
+        scheduler = RequestScheduler(tpm=60000, base_delay=.01)
+        calls = []
+        async def call():
+            calls.append(1)
+            if len(calls) < 3:
+                raise openai.APITimeoutError(None)
+            return 'ok'
+        self.assertEqual(await scheduler.submit(call, tokens=1000), 'ok')
+        self.assertEqual(scheduler.counters['retries'], 2)
+        self.assertAlmostEqual(scheduler.tokens.level, 59000, delta=100)
+
+    async def test_gives_up(self):
+        scheduler = RequestScheduler(max_retries=2, base_delay=.01)
+        async def call():
+            raise rate_limit_error('0.01')
+        with self.assertRaises(openai.RateLimitError):
+            await scheduler.submit(call)
+        self.assertEqual(scheduler.counters['requests'], 3)
+
+    async def test_breaker(self):
+        scheduler = RequestScheduler(max_retries=0, breaker_threshold=2, breaker_cooldown=.3)
+        async def fail():
+            raise openai.APITimeoutError(None)
+        for _ in range(2):
+            with self.assertRaises(openai.APITimeoutError):
+                await scheduler.submit(fail)
+        self.assertEqual(scheduler.breaker, 'open')
+        start = time.monotonic()
+        async def ok():
+            return 'ok'
+        self.assertEqual(await scheduler.submit(ok), 'ok')
+        self.assertGreaterEqual(time.monotonic() - start, .2)
+        self.assertEqual(scheduler.breaker, 'closed')
+
+    async def test_cancelled_probe(self):
+        scheduler = RequestScheduler(max_retries=0, breaker_threshold=1, breaker_cooldown=.1)
+        async def fail():
+            raise openai.APITimeoutError(None)
+        with self.assertRaises(openai.APITimeoutError):
+            await scheduler.submit(fail)
+        await asyncio.sleep(.15)
+        probe = asyncio.create_task(scheduler.submit(lambda: asyncio.sleep(60)))
+        await asyncio.sleep(.05)
+        self.assertTrue(scheduler.probing)
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        self.assertFalse(scheduler.probing)
+        async def ok():
+            return 'ok'
+        # let through at once rather than waiting on a probe that will never end
+        self.assertEqual(await asyncio.wait_for(scheduler.submit(ok), .5), 'ok')
+        self.assertEqual(scheduler.breaker, 'closed')
+
+    async def test_probe_cancelled_once_admitted(self):
+        scheduler = RequestScheduler(max_retries=0, breaker_threshold=1, breaker_cooldown=.1)
+        async def fail():
+            raise openai.APITimeoutError(None)
+        with self.assertRaises(openai.APITimeoutError):
+            await scheduler.submit(fail)
+        await asyncio.sleep(.15)
+        calls = []
+        async def ok():
+            calls.append(1)
+            return 'ok'
+        probe = asyncio.create_task(scheduler.submit(ok))
+        # admitted by the dispatcher, but cancelled before it resumes
+        while not scheduler.probing:
+            await asyncio.sleep(0)
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        self.assertTrue(probe.cancelled())
+        self.assertEqual(calls, [])
+        self.assertFalse(scheduler.probing)
+        self.assertEqual(await asyncio.wait_for(scheduler.submit(ok), .5), 'ok')
@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+import aiounittest
+
+from app.commands import get_callback, recall_callback, search_callback
+from app.context_window import ContextWindow
+from app.recall import RecallIndex
+from app.usage import Usage
+
+FILLER = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore. '
+
+def page(paragraphs: int, answer_at: int, answer: str) -> str:
+    lines = [FILLER * 4 for _ in range(paragraphs)]
+    lines[answer_at] = answer
+    return '\n\n'.join(lines)
+
+class Agent:
+    def __init__(self, context):
+        self.context = context
+        self.chat_session = mock.Mock(context_window=ContextWindow('gpt-4o'), model='gpt-4o', accounts=[Usage()])
+        self.handle_agent_assign = mock.AsyncMock(return_value='done')
+
+
+class TestRecall(aiounittest.AsyncTestCase):
+
+    async def test_search(self):
+        index = RecallIndex(dimensions=2 ** 12, chunk_tokens=100)
+        self.assertEqual(await index.search('tower'), [])
+        self.assertGreater(await index.add('https://a', page(50, 30, 'The Eiffel Tower is 330 metres tall.')), 10)
+        await index.add('https://b', page(20, 5, 'The Great Pyramid of Giza was built around 2560 BC.'))
+        self.assertEqual(await index.add('https://a', 'fetched again'), 0)
+        results = await index.search('How tall is the Eiffel Tower?', 3)
+        self.assertEqual(results[0]['source'], 'https://a')
+        self.assertIn('330 metres', results[0]['text'])
+        self.assertEqual(len(results), 1)
+        self.assertEqual((await index.search('pyramid giza'))[0]['source'], 'https://b')
+        self.assertEqual(await index.search('quantum chromodynamics'), [])
+        self.assertIn('330 metres', index.document('https://a'))
+        stats = index.stats()
+        self.assertEqual(stats['documents'], 2)
+        self.assertEqual(stats['hit_rate'], .5)
+
+    async def test_max_chunks(self):
+        index = RecallIndex(chunk_tokens=100, max_chunks=5)
+        await index.add('https://a', page(50, 30, 'The Eiffel Tower is 330 metres tall.'))
+        self.assertEqual(len(index), 5)
+        self.assertGreater(index.stats()['dropped'], 0)
+        # searchable, but not served in place of the page
+        self.assertIsNone(index.document('https://a'))
+        self.assertEqual(await index.add('https://a', page(50, 30, 'The Eiffel Tower is 330 metres tall.')), 0)
+        self.assertEqual(len(index), 5)
+
+    async def test_agents_share_fetches(self):
+        context = mock.Mock(recall_index=RecallIndex())
+        first, second = Agent(context), Agent(context)
+        scrape = mock.AsyncMock(return_value=page(10, 5, 'The Eiffel Tower is 330 metres tall.'))
+        results = [{'title': 'Louvre', 'link': 'https://louvre.fr', 'snippet': 'The Louvre is the most visited museum.'}]
+        with mock.patch('app.commands.scrapeText', scrape), mock.patch('app.commands.search', mock.AsyncMock(return_value=results)):
+            await get_callback(first, {'source': 'web', 'id': 'https://example.com', 'request': 'Height of the tower'})
+            await search_callback(first, {'source': 'google', 'query': 'louvre'})
+            await get_callback(second, {'source': 'web', 'id': 'https://example.com', 'request': 'Height of the tower'})
+        self.assertEqual(scrape.await_count, 1)
+        self.assertIn('330 metres', second.handle_agent_assign.call_args.args[2][0])
+        self.assertIn('rebuilt from the recall index', second.handle_agent_assign.call_args.args[2][0])
+        recalled = await recall_callback(second, {'query': 'Eiffel Tower height'})
+        self.assertTrue(recalled.startswith('[1] https://example.com'))
+        self.assertIn('330 metres', recalled)
+        self.assertIn('result:https://louvre.fr', await recall_callback(second, {'query': 'museum', 'count': 1}))
+        self.assertIn('Nothing', await recall_callback(second, {'query': 'volcano'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import aiounittest
+
+from app.agent_runner import AgentRunner
+from app.kernel import KernelPool
+from app.resources import RUNNER_ENV, SERVER_ENV, ResourceRegistry, current_resources, reaper, tracked
+from app.shell import run_process
+from benchmarks.mock_openai import call, get_goal, scripted_reply
+from tests.helpers import Args, mock_api, temp_cwd
+
+def run_forever(messages: list[dict]) -> dict:
+    if get_goal(messages) == 'sleep':
+        return call('RUN', content='sleep 60')
+    return scripted_reply(messages)
+
+def spawn(server: int, runner: str) -> subprocess.Popen:
+    return subprocess.Popen(['sleep', '60'], env={**os.environ, SERVER_ENV: str(server), RUNNER_ENV: runner})
+
+async def exited(process: subprocess.Popen) -> bool:
+    for _ in range(50):
+        if process.poll() is not None:
+            return True
+        await asyncio.sleep(.02)
+    return False
+
+
+class TestResources(aiounittest.AsyncTestCase):
+
+    async def test_reclaim_processes(self):
+        resources = ResourceRegistry('test-reclaim')
+        token = current_resources.set(resources)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                # the second sleep leaves the process group of the command
+                command = asyncio.create_task(run_process('setsid sleep 60 & sleep 60', tmp))
+                await asyncio.sleep(.3)
+                self.assertEqual(len(reaper.leaked('test-reclaim')), 3)
+                report = await resources.reclaim()
+                return_code, _, _ = await command
+        finally:
+            current_resources.reset(token)
+            await resources.close()
+        self.assertEqual(report['run_killed'], 1)
+        self.assertGreaterEqual(report['leaked_killed'], 1)
+        self.assertNotEqual(return_code, 0)
+        self.assertEqual(reaper.leaked('test-reclaim'), [])
+
+    async def test_cancel_requests(self):
+        resources = ResourceRegistry('test-requests')
+        async def fetch():
+            with tracked('fetch', 'https://example.com'):
+                await asyncio.sleep(60)
+        token = current_resources.set(resources)
+        try:
+            task = asyncio.create_task(fetch())
+        finally:
+            current_resources.reset(token)
+        await asyncio.sleep(.05)
+        self.assertEqual(resources.stats()['requests'], {'fetch': 1})
+        self.assertEqual(await resources.close(), None)
+        self.assertTrue(task.cancelled() or (await asyncio.gather(task, return_exceptions=True)) and task.cancelled())
+        self.assertEqual(resources.reclaimed['fetch_cancelled'], 1)
+        self.assertNotIn('test-requests', reaper.live)
+
+    async def test_escaped_grace(self):
+        resources = ResourceRegistry('test-grace')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stopped')
+            script = ("import signal, sys, time\n"
+                      "def stop(*_):\n    time.sleep(.2)\n    open(sys.argv[1], 'w').close()\n    sys.exit()\n"
+                      "signal.signal(signal.SIGTERM, stop)\nprint(flush=True)\ntime.sleep(60)")
+            # started outside of any tracked process group
+            process = subprocess.Popen([sys.executable, '-c', script, path], env=resources.env(), stdout=subprocess.PIPE)
+            try:
+                process.stdout.readline()
+                report = await resources.reclaim()
+            finally:
+                await resources.close()
+                process.kill()
+                process.wait()
+                process.stdout.close()
+            self.assertEqual(report, {'leaked_killed': 1})
+            # it had time to exit on SIGTERM
+            self.assertTrue(os.path.exists(path))
+
+    async def test_kernel(self):
+        pool = KernelPool(size=0)
+        resources = ResourceRegistry('test-kernel')
+        token = current_resources.set(resources)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                code = f"import subprocess\nsubprocess.Popen(['sleep', '60'], start_new_session=True).pid"
+                status, _, _ = await pool.execute(self, code, tmp)
+                self.assertEqual(status, 0)
+                # the subprocess is marked with the runner, the kernel itself isn't
+                self.assertEqual(len(reaper.leaked('test-kernel')), 1)
+                report = await resources.reclaim()
+        finally:
+            current_resources.reset(token)
+            await resources.close()
+            await pool.close()
+        self.assertEqual(report, {'kernel_killed': 1, 'leaked_killed': 1})
+
+    async def test_reaper(self):
+        finished = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True)
+        dead_server = spawn(int(finished.stdout), 'any')
+        ended_runner = spawn(os.getpid(), 'test-ended')
+        live_runner = spawn(os.getpid(), 'test-live')
+        pooled = spawn(os.getpid(), '')
+        resources = ResourceRegistry('test-live')
+        try:
+            reaper.reap()
+            self.assertTrue(await exited(dead_server))
+            self.assertTrue(await exited(ended_runner))
+            self.assertIsNone(live_runner.poll())
+            self.assertIsNone(pooled.poll())
+        finally:
+            await resources.close()
+            pooled.kill()
+            pooled.wait()
+        self.assertTrue(await exited(live_runner))
+
+    async def test_stop_runner(self):
+        async with mock_api(script=run_forever):
+            with temp_cwd():
+                context = AgentRunner(Args(model='gpt-4o-mini'))
+                # as a web session runs it
+                task = asyncio.create_task(context.run('sleep'))
+                while not context.resources.processes:
+                    await asyncio.sleep(.05)
+                report = await asyncio.wait_for(context.stop(), 5)
+                task.cancel()
+                await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), 5)
+        self.assertEqual(report['run_killed'], 1)
+        self.assertEqual(reaper.leaked(context.name), [])
+        self.assertNotIn(context.name, reaper.live)
+
+
+if __name__ == '__main__':
+    unittest.main()
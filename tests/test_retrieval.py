@@ -0,0 +1,126 @@
+import json
+import time
+import unittest
+from unittest import mock
+import aiounittest
+
+from app.agent_runner import AgentRunner
+from app.commands import get_callback, map_reduce
+from app.context_window import ContextWindow
+from app.retrieval import ChunkRanker, bm25, split_chunks, tokenize
+from app.usage import Usage
+from benchmarks.mock_openai import call
+from tests.helpers import Args, close_runner, mock_api, temp_cwd
+
+FILLER = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore. '
+
+def count(text: str) -> int:
+    return (len(text) + 3) // 4
+
+def page(paragraphs: int = 100, answer_at: int = 70) -> str:
+    lines = [FILLER * 4 for _ in range(paragraphs)]
+    lines[answer_at] = 'The Eiffel Tower is 330 metres tall and was completed in 1889 for the World Fair.'
+    return '\n\n'.join(lines)
+
+
+class TestRetrieval(aiounittest.AsyncTestCase):
+
+    def test_split_chunks(self):
+        text = page() + '\n' + 'x' * 5000
+        chunks = split_chunks(text, 100)
+        self.assertTrue(all(len(c) <= 400 for c in chunks))
+        self.assertEqual(''.join(c.replace('\n', '').replace(' ', '') for c in chunks), text.replace('\n', '').replace(' ', ''))
+
+    def test_bm25(self):
+        documents = [tokenize(FILLER), tokenize('The tower is 330 metres tall'), tokenize('A tall tree')]
+        scores = bm25(documents, tokenize('How tall is the tower?'))
+        self.assertEqual(max(range(3), key=scores.__getitem__), 1)
+        self.assertEqual(scores[0], 0)
+
+    async def test_select(self):
+        ranker = ChunkRanker(budget=500, chunk_tokens=100)
+        short = 'A short page.'
+        self.assertEqual((await ranker.select(short, 'page', count))[0], short)
+        text, stats = await ranker.select(page(), 'How tall is the Eiffel Tower?', count)
+        self.assertIn('330 metres', text)
+        self.assertLessEqual(stats['tokens_out'], 500 + 10)
+        self.assertGreater(stats['tokens_in'], 5 * stats['tokens_out'])
+        self.assertIn('[...]', text)
+        self.assertEqual(ranker.stats()['tokens_saved'], stats['tokens_in'] - stats['tokens_out'])
+
+    async def test_select_items(self):
+        ranker = ChunkRanker(budget=60)
+        items = [{'title': f'Result {i}', 'snippet': FILLER} for i in range(10)]
+        items[6]['snippet'] = 'Python asyncio event loop tutorial'
+        kept, stats = await ranker.select_items(items, 'asyncio tutorial', count)
+        self.assertIn(items[6], kept)
+        self.assertLess(len(kept), len(items))
+        self.assertEqual(stats['selected'], len(kept))
+
+    async def test_get_sends_top_chunks(self):
+        class Agent:
+            chat_session = mock.Mock(context_window=ContextWindow('gpt-4o'), model='gpt-4o', accounts=[Usage()])
+            handle_agent_assign = mock.AsyncMock(return_value='330 metres')
+        agent = Agent()
+        with mock.patch('app.commands.scrapeText', mock.AsyncMock(return_value=page(1000, 700))), \
+                mock.patch('app.commands.chunk_ranker', ChunkRanker(budget=1000)):
+            result = await get_callback(agent, {'source': 'web', 'id': 'https://example.com', 'request': 'Height of the Eiffel Tower'})
+        self.assertEqual(result, '330 metres')
+        content = agent.handle_agent_assign.call_args.args[2][0]
+        self.assertIn('330 metres', content)
+        self.assertLessEqual(agent.chat_session.context_window.count_text(content), 1010)
+        self.assertGreater(agent.chat_session.accounts[0]['retrieval_tokens_saved'], 10000)
+
+    async def test_map_reduce_over_budget(self):
+        async def assign(name, task, messages, role):
+            if name == 'map_agent':
+                finding = 'The Eiffel Tower is 330 metres tall.' if 'Eiffel' in messages[0] else FILLER * 8
+                return json.dumps({'status': 'success', 'content': finding})
+            if 'Merge' in task:
+                # merging doesn't shrink these findings
+                return json.dumps({'status': 'success', 'content': messages[0]})
+            return 'answer'
+        class Agent:
+            chat_session = mock.Mock(context_window=ContextWindow('gpt-4o'), model='gpt-4o', accounts=[Usage()])
+            handle_agent_assign = mock.AsyncMock(side_effect=assign)
+        agent = Agent()
+        with mock.patch('app.commands.chunk_ranker', ChunkRanker(budget=300)):
+            result = await map_reduce(agent, 'Height of the Eiffel Tower', page(40, 25))
+        self.assertEqual(result, 'answer')
+        # the findings still don't fit once merged: the most relevant are kept
+        final = agent.handle_agent_assign.call_args
+        self.assertEqual(final.args[0], 'reduce_agent')
+        content = final.args[2][0]
+        self.assertIn('330 metres', content)
+        self.assertLessEqual(agent.chat_session.context_window.count_text(content), 300)
+        self.assertTrue(all(finding.startswith('Part ') for finding in content.split('\n\n')))
+
+    async def test_map_reduce(self):
+        def extract(messages):
+            # the part (or findings) to read follows the task
+            content = [m['content'] for m in messages if m['role'] == 'user'][-1]
+            found = [line for line in content.split('\n') if 'Eiffel' in line]
+            return call('COMPLETE', status='success', content='\n'.join(found) or 'Nothing relevant.')
+        async with mock_api(latency=.2, script=extract) as server:
+            with temp_cwd():
+                context = AgentRunner(Args(model='gpt-4o-mini'))
+                try:
+                    await context.main_agent.init()
+                    with mock.patch('app.commands.scrapeText', mock.AsyncMock(return_value=page(64, 40))), \
+                            mock.patch('app.commands.chunk_ranker', ChunkRanker(budget=2000)), \
+                            mock.patch('app.commands.GET_MODE', 'map-reduce'):
+                        start = time.perf_counter()
+                        result = await get_callback(context.main_agent, {'source': 'web', 'id': 'https://example.com', 'request': 'Height of the Eiffel Tower'})
+                        elapsed = time.perf_counter() - start
+                finally:
+                    await close_runner(context)
+        self.assertIn('330 metres', json.loads(result)['content'])
+        mappers = [name for name in context.agents if name.startswith('map_agent')]
+        self.assertEqual(len(mappers), 4)
+        self.assertEqual(len(server.requests), 5)
+        # the parts are read at the same time: one map latency and one reduce latency
+        self.assertLess(elapsed, .7)
+
+
+if __name__ == '__main__':
+    unittest.main()
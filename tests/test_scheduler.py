@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+import aiounittest
+
+from app.scheduler import SessionScheduler
+
+class FakeSession:
+    def __init__(self):
+        self.messages = []
+
+    async def send_to_client(self, message):
+        self.messages.append(message)
+
+
+class TestSessionScheduler(aiounittest.AsyncTestCase):
+
+    async def test_concurrency_cap(self):
+        scheduler = SessionScheduler(2)
+        running = 0
+        max_running = 0
+        async def job():
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+        await asyncio.gather(*[scheduler.run(FakeSession(), job) for _ in range(6)])
+        self.assertEqual(max_running, 2)
+        self.assertEqual(scheduler.stats()['completed'], 6)
+
+    async def test_fifo_admission(self):
+        scheduler = SessionScheduler(1)
+        order = []
+        async def job(i):
+            order.append(i)
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*[scheduler.run(FakeSession(), lambda i=i: job(i)) for i in range(4)])
+        self.assertEqual(order, [0, 1, 2, 3])
+
+    async def test_cancel_waiting(self):
+        scheduler = SessionScheduler(1)
+        session = FakeSession()
+        first = asyncio.create_task(scheduler.run(FakeSession(), lambda: asyncio.sleep(0.05)))
+        second = asyncio.create_task(scheduler.run(session, lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0.01)
+        self.assertEqual(session.messages[0]['queue']['queue_depth'], 1)
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        self.assertEqual(scheduler.stats()['waiting'], 0)
+        self.assertEqual(scheduler.stats()['running'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import threading
+import unittest
+from unittest import mock
+import aiounittest
+from aiohttp import web
+
+from app import scrape
+from app.http_client import http_client
+
+ARTICLE = '<html><head>{head}</head><body><nav>Menu</nav><article><p>{text}</p></article></body></html>'
+
+
+class TestScrape(aiounittest.AsyncTestCase):
+
+    async def serve(self, routes: dict) -> str:
+        async def handle(request):
+            content_type, body = routes[request.path]
+            return web.Response(body=body.encode() if isinstance(body, str) else body, content_type=content_type)
+        app = web.Application()
+        app.add_routes([web.get(path, handle) for path in routes])
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    async def close(self):
+        await http_client.close()
+        await self.runner.cleanup()
+
+    async def test_content_types(self):
+        url = await self.serve({
+            '/page': ('text/html', ARTICLE.format(head='', text='The tower is 330 metres tall.')),
+            '/notes': ('text/plain', 'Plain notes.'),
+            '/image': ('image/png', b'\x89PNG'),
+        })
+        try:
+            self.assertEqual(await scrape.scrapeText(f'{url}/page'), 'The tower is 330 metres tall.')
+            self.assertEqual(await scrape.scrapeText(f'{url}/notes'), 'Plain notes.')
+            self.assertIsNone(await scrape.fetch(f'{url}/image'))
+            self.assertIsNone(await scrape.fetch(f'{url}/missing'))
+        finally:
+            await self.close()
+
+    async def test_truncated(self):
+        url = await self.serve({'/large': ('text/plain', 'x' * 300000)})
+        try:
+            with mock.patch('app.scrape.MAX_DOWNLOAD_BYTES', 100000):
+                content_type, text = await scrape.fetch(f'{url}/large')
+        finally:
+            await self.close()
+        self.assertEqual(content_type, 'text/plain')
+        self.assertEqual(len(text), 100000)
+
+    async def test_parsed_in_executor(self):
+        threads = []
+        parse = scrape.BACKENDS[scrape.BACKEND]
+        def record(html):
+            threads.append(threading.current_thread())
+            return parse(html)
+        url = await self.serve({
+            '/page': ('text/html', ARTICLE.format(head='<link rel="amphtml" href="/amp">', text='Full page.')),
+            '/amp': ('text/html', ARTICLE.format(head='', text='AMP page.')),
+        })
+        try:
+            with mock.patch.dict(scrape.BACKENDS, {scrape.BACKEND: record}), mock.patch('app.scrape._executor', None), \
+                    mock.patch.dict('os.environ', {'SCRAPE_EXECUTOR': 'thread'}):
+                # the AMP version of the page is followed
+                self.assertEqual(await scrape.scrapeText(f'{url}/page'), 'AMP page.')
+                scrape.get_executor().shutdown()
+        finally:
+            await self.close()
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(thread is not threading.main_thread() for thread in threads))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import tempfile
+import unittest
+import aiounittest
+
+from app.search_cache import SearchCache, parse_ttl
+
+class TestSearchCache(aiounittest.AsyncTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'search.sqlite')
+        self.calls = 0
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def fetch(self, value='result'):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return [value]
+
+    async def test_memory_and_disk_tiers(self):
+        cache = SearchCache(self.path)
+        self.assertEqual(await cache.get_or_fetch('google', 'Paris', self.fetch), ['result'])
+        self.assertEqual(await cache.get_or_fetch('google', '  paris ', self.fetch), ['result'])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats()['memory_hits'], 1)
+        cache = SearchCache(self.path)
+        self.assertEqual(await cache.get_or_fetch('google', 'paris', self.fetch), ['result'])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+
+    async def test_opened_on_first_use(self):
+        cache = SearchCache(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        await cache.get_or_fetch('google', 'paris', self.fetch)
+        self.assertTrue(os.path.exists(self.path))
+
+    async def test_keys_per_source(self):
+        cache = SearchCache()
+        # search queries are free text, but URLs and article titles are case-sensitive
+        await cache.get_or_fetch('wikipedia-search', 'Paris', self.fetch)
+        await cache.get_or_fetch('wikipedia-search', 'paris ', self.fetch)
+        await cache.get_or_fetch('wikipedia', 'Paris', self.fetch)
+        await cache.get_or_fetch('wikipedia', 'PARIS', self.fetch)
+        await cache.get_or_fetch('web', 'http://example.com/Page', self.fetch)
+        await cache.get_or_fetch('web', 'http://example.com/page', self.fetch)
+        self.assertEqual(self.calls, 5)
+
+    async def test_ttl_per_source(self):
+        cache = SearchCache(ttl=parse_ttl('google=0'))
+        await cache.get_or_fetch('google', 'paris', self.fetch)
+        await asyncio.sleep(0.01)
+        await cache.get_or_fetch('google', 'paris', self.fetch)
+        await cache.get_or_fetch('wikipedia', 'paris', self.fetch)
+        await cache.get_or_fetch('wikipedia', 'paris', self.fetch)
+        self.assertEqual(self.calls, 3)
+
+    async def test_single_flight(self):
+        cache = SearchCache()
+        results = await asyncio.gather(*[cache.get_or_fetch('wikipedia', 'Paris', self.fetch) for _ in range(5)])
+        self.assertEqual(results, [['result']] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats()['shared'], 4)
+
+    async def test_cancelled_caller(self):
+        cache = SearchCache()
+        async def slow():
+            self.calls += 1
+            await asyncio.sleep(.1)
+            return ['result']
+        first = asyncio.create_task(cache.get_or_fetch('web', 'http://example.com', slow))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_or_fetch('web', 'http://example.com', slow))
+        await asyncio.sleep(.02)
+        first.cancel()
+        self.assertEqual(await second, ['result'])
+        self.assertTrue(first.cancelled())
+        self.assertEqual(self.calls, 1)
+        # once nobody waits for it, the fetch is cancelled
+        task = asyncio.create_task(cache.get_or_fetch('web', 'http://example.org', slow))
+        await asyncio.sleep(.02)
+        fetch = cache.inflight[('web', 'http://example.org')]
+        task.cancel()
+        await asyncio.gather(task, fetch, return_exceptions=True)
+        self.assertTrue(fetch.cancelled())
+        self.assertEqual(cache.stats()['inflight'], 0)
+
+    async def test_cancelled_fetch_retried(self):
+        cache = SearchCache()
+        waiter = asyncio.create_task(cache.get_or_fetch('web', 'http://example.com', self.fetch))
+        await asyncio.sleep(.005)
+        # as the runner that started it stopping would
+        cache.inflight[('web', 'http://example.com')].cancel()
+        self.assertEqual(await waiter, ['result'])
+        self.assertEqual(self.calls, 2)
+
+    async def test_none_not_cached(self):
+        cache = SearchCache()
+        async def fetch_none():
+            self.calls += 1
+        await cache.get_or_fetch('web', 'http://example.com', fetch_none)
+        await cache.get_or_fetch('web', 'http://example.com', fetch_none)
+        self.assertEqual(self.calls, 2)
+
+if __name__ == '__main__':
+    unittest.main()
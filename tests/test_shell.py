@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+import aiounittest
+
+from app.shell import ShellSession, ShellTimeout, run_process
+
+class TestShell(aiounittest.AsyncTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_state_persists(self):
+        shell = ShellSession(self.dir.name)
+        try:
+            self.assertEqual(await shell.run("mkdir sub && cd sub && export FOO=bar"), (0, '', ''))
+            self.assertEqual(await shell.run("pwd; echo $FOO"), (0, f"{os.path.join(self.dir.name, 'sub')}\nbar\n", ''))
+        finally:
+            await shell.close()
+
+    async def test_exit_code(self):
+        shell = ShellSession(self.dir.name)
+        try:
+            self.assertEqual(await shell.run("echo out; echo err >&2; exit_code() { return 3; }; exit_code"), (3, 'out\n', 'err\n'))
+            return_code, _, stderr = await shell.run('echo "unterminated')
+            self.assertNotEqual(return_code, 0)
+            self.assertTrue(stderr)
+        finally:
+            await shell.close()
+
+    async def test_timeout(self):
+        shell = ShellSession(self.dir.name, timeout=.5)
+        try:
+            await shell.run("export FOO=bar")
+            with self.assertRaises(ShellTimeout):
+                await shell.run("sleep 10")
+            return_code, stdout, _ = await shell.run("echo ${FOO:-unset}")
+            self.assertEqual((return_code, stdout), (0, 'unset\n'))
+        finally:
+            await shell.close()
+
+    async def test_run_process(self):
+        self.assertEqual(await run_process("echo hi; exit 2", self.dir.name), (2, 'hi\n', ''))
+        with self.assertRaises(ShellTimeout):
+            await run_process("sleep 10", self.dir.name, timeout=.5)
+
+if __name__ == '__main__':
+    unittest.main()
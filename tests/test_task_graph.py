@@ -0,0 +1,59 @@
+import json
+import time
+import unittest
+import aiounittest
+
+from app.agent_runner import AgentRunner
+from app.task_graph import TaskGraph
+from benchmarks.mock_openai import call, get_goal, scripted_reply
+from tests.helpers import Args, mock_api, temp_cwd
+
+def stop_early(messages: list[dict]) -> dict:
+    '''The main agent gives up on a worker, which is waiting for a long running agent of its own.'''
+    done = sum(1 for m in messages if m.get('role') == 'function')
+    if get_goal(messages) == 'boss':
+        if done == 0:
+            return call('ASSIGN', agent_id='worker', content='parallel:1', background=True)
+        if done == 1:
+            return call('WAIT', timeout=.3)
+        return call('COMPLETE', status='failure', content='too slow')
+    if get_goal(messages) == 'parallel:1' and done == 0:
+        return call('ASSIGN', agent_id='helper', content='turns:1000', background=True)
+    return scripted_reply(messages)
+
+
+class TestTaskGraph(aiounittest.AsyncTestCase):
+
+    async def run_session(self, goal: str, latency: float, max_agents: int = 8, script=scripted_reply) -> tuple[AgentRunner, float]:
+        async with mock_api(latency, script):
+            with temp_cwd():
+                context = AgentRunner(Args(model='gpt-4o-mini'))
+                context.tasks = TaskGraph(max_agents)
+                start = time.perf_counter()
+                await context.run(goal)
+                return context, time.perf_counter() - start
+
+    async def test_background_assign(self):
+        context, elapsed = await self.run_session('parallel:3', .2)
+        self.assertEqual(json.loads(context.main_agent.result())['content'], '3 workers')
+        self.assertEqual(context.tasks.counters['completed'], 3)
+        self.assertGreaterEqual(context.tasks.counters['peak'], 3)
+        # one after the other, each worker would add two completions to the main agent's
+        self.assertLess(elapsed, 1.6)
+
+    async def test_max_agents(self):
+        context, _ = await self.run_session('parallel:4', .05, max_agents=2)
+        self.assertEqual(json.loads(context.main_agent.result())['content'], '4 workers')
+        self.assertLessEqual(context.tasks.counters['peak'], 2)
+
+    async def test_cancel_tree(self):
+        context, elapsed = await self.run_session('boss', .05, script=stop_early)
+        self.assertEqual(json.loads(context.main_agent.result())['status'], 'failure')
+        self.assertEqual(context.tasks.results(['worker', 'helper']), {'worker': 'cancelled', 'helper': 'cancelled'})
+        self.assertEqual(context.tasks.counters['cancelled'], 2)
+        self.assertTrue(all(task.done() for task in context.tasks.tasks.values()))
+        self.assertLess(elapsed, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+import unittest
+import aiounittest
+
+from app.agent_runner import AgentRunner
+from app.tracing import Tracer, span
+from tests.helpers import Args, mock_api, temp_cwd
+
+
+class TestTracing(aiounittest.AsyncTestCase):
+
+    async def test_nested_spans(self):
+        tracer = Tracer('runner')
+        with span('ignored', 'shell'):
+            pass
+        with tracer.span('main', 'agent', agent='main'):
+            with span('RUN', 'command'):
+                await asyncio.sleep(0.01)
+                with span('subprocess', 'shell', command='ls'):
+                    pass
+            with tracer.span('worker', 'agent', agent='worker'):
+                with span('completion', 'openai'):
+                    pass
+        events = {e['name']: e for e in tracer.chrome_trace()['traceEvents'] if e['ph'] == 'X'}
+        self.assertEqual(set(events), {'main', 'RUN', 'subprocess', 'worker', 'completion'})
+        self.assertEqual(events['subprocess']['args']['parent'], events['RUN']['args']['id'])
+        self.assertEqual(events['subprocess']['args']['agent'], 'main')
+        self.assertEqual(events['subprocess']['args']['command'], 'ls')
+        self.assertEqual(events['completion']['args']['agent'], 'worker')
+        self.assertEqual(events['worker']['args']['parent_agent'], 'main')
+        self.assertNotEqual(events['worker']['tid'], events['main']['tid'])
+        self.assertGreaterEqual(events['RUN']['dur'], 10000)
+        self.assertEqual(tracer.summary('main')['command']['count'], 1)
+
+    async def test_max_events(self):
+        tracer = Tracer('runner', max_events=2)
+        for i in range(5):
+            with tracer.span('turn', 'openai'):
+                pass
+        trace = tracer.chrome_trace()
+        self.assertEqual(len([e for e in trace['traceEvents'] if e['ph'] == 'X']), 2)
+        self.assertEqual(trace['otherData']['dropped'], 3)
+        self.assertEqual(tracer.summary('runner')['openai']['count'], 5)
+
+    async def test_runner_trace(self):
+        async with mock_api():
+            with temp_cwd() as tmp:
+                context = AgentRunner(Args(model='gpt-4o-mini'))
+                await context.run('fanout:1')
+                path = os.path.join(tmp, 'trace.json')
+                context.tracer.export(path)
+                with open(path) as f:
+                    events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+        by_agent = {}
+        for e in events:
+            by_agent.setdefault(e['args']['agent'], []).append(e['name'])
+        self.assertEqual(by_agent['main'].count('completion'), 2)
+        self.assertIn('ASSIGN', by_agent['main'])
+        worker = next(e for e in events if e['cat'] == 'agent' and e['args']['agent'] != 'main')
+        self.assertEqual(worker['args']['parent_agent'], 'main')
+        self.assertIn('COMPLETE', by_agent[worker['args']['agent']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from app.usage import PriceTable, Usage, UsageLedger, load_prices
+
+class TestUsageLedger(unittest.TestCase):
+
+    def test_prices_longest_prefix(self):
+        prices = PriceTable(load_prices('{"gpt-4o-2024": [1, 2]}'))
+        self.assertEqual(prices.get('gpt-4o-mini-2024-07-18'), (.15, .6))
+        self.assertEqual(prices.get('gpt-4o-2024-08-06'), (1, 2))
+        self.assertEqual(prices.get('gpt-4o'), (2.5, 10.))
+        self.assertAlmostEqual(prices.dollars('gpt-4', 1000000, 500000), 60.)
+
+    def test_accounts(self):
+        ledger = UsageLedger(PriceTable({'': (1., 2.)}))
+        session, agent1, agent2 = Usage(), Usage(), Usage()
+        ledger.record('gpt-4o', 100, 10, [agent1, session], latency=.3)
+        ledger.record('gpt-4o-mini', 200, 20, [agent2, session], latency=3)
+        ledger.record_error('gpt-4o', TimeoutError(), [agent1, session])
+        self.assertEqual(agent1['total_tokens'], 110)
+        self.assertEqual(agent1['errors'], 1)
+        self.assertEqual(session['total_tokens'], 330)
+        self.assertEqual(ledger.total['requests'], 2)
+        self.assertAlmostEqual(session['total_dollars'], (300 + 60) / 1000000.)
+        self.assertEqual(ledger.models['gpt-4o-mini']['prompt_tokens'], 200)
+
+    def test_prometheus(self):
+        ledger = UsageLedger(PriceTable({'': (1., 2.)}))
+        ledger.record('gpt-4o', 100, 10, latency=.3)
+        ledger.record('gpt-4o', 100, 10, latency=3)
+        ledger.record_error('gpt-4o', TimeoutError())
+        text = ledger.prometheus()
+        self.assertIn('argent_tokens_total{model="gpt-4o",type="prompt"} 200', text)
+        self.assertIn('argent_errors_total{model="gpt-4o",error="TimeoutError"} 1', text)
+        self.assertIn('argent_request_duration_seconds_bucket{model="gpt-4o",le="0.5"} 1', text)
+        self.assertIn('argent_request_duration_seconds_bucket{model="gpt-4o",le="+Inf"} 2', text)
+        self.assertIn('argent_request_duration_seconds_count{model="gpt-4o"} 2', text)
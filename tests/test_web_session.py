@@ -0,0 +1,126 @@
+import asyncio
+import unittest
+import unittest.mock
+import aiounittest
+
+from app.web_server import WebSession
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_json(self, message):
+        self.frames.append(message)
+
+    @property
+    def sent(self):
+        return [m for frame in self.frames for m in (frame if isinstance(frame, list) else [frame])]
+
+    def clear(self):
+        self.frames.clear()
+
+
+class TestWebSessionSync(aiounittest.AsyncTestCase):
+
+    async def make_session(self):
+        ws = FakeWebSocket()
+        session = WebSession(None, ws, None)
+        await session.reset('gpt-4')
+        for i in range(5):
+            await session.add_message('main', {'role': 'user', 'content': str(i)}, usage={})
+        await session.flush()
+        return session, ws
+
+    async def test_patches_are_numbered(self):
+        session, ws = await self.make_session()
+        self.assertEqual([m['seq'] for m in ws.sent], [1, 2, 3, 4, 5])
+        await session.add_message_delta('main', {'content': 'x'})
+        await session.close()
+        self.assertNotIn('seq', ws.sent[-1])
+
+    async def test_replay_missed_patches(self):
+        session, ws = await self.make_session()
+        ws.clear()
+        await session.sync(session.epoch, 3)
+        await session.close()
+        self.assertEqual([m['seq'] for m in ws.sent], [4, 5])
+
+    async def test_up_to_date(self):
+        session, ws = await self.make_session()
+        ws.clear()
+        await session.sync(session.epoch, 5)
+        await session.close()
+        self.assertEqual(ws.sent, [])
+
+    async def test_snapshot_when_too_far_behind(self):
+        session, ws = await self.make_session()
+        session.log = type(session.log)(list(session.log)[-2:], maxlen=2)
+        ws.clear()
+        await session.sync(session.epoch, 1)
+        await session.close()
+        self.assertEqual(len(ws.sent), 1)
+        self.assertTrue(ws.sent[0]['snapshot'])
+        self.assertEqual(len(ws.sent[0]['agents']['main']['messages']), 5)
+
+    async def test_snapshot_on_other_epoch(self):
+        session, ws = await self.make_session()
+        ws.clear()
+        await session.sync('other', 5)
+        await session.close()
+        self.assertTrue(ws.sent[0]['snapshot'])
+        self.assertEqual(ws.sent[0]['seq'], 5)
+
+
+class TestWebSessionQueue(aiounittest.AsyncTestCase):
+
+    async def test_batched_in_one_frame(self):
+        ws = FakeWebSocket()
+        session = WebSession(None, ws, None)
+        await session.reset('gpt-4')
+        for i in range(3):
+            await session.add_message('main', {'role': 'user', 'content': str(i)}, usage={})
+        self.assertEqual(ws.frames, [])
+        await asyncio.sleep(0.2)
+        await session.close()
+        self.assertEqual(len(ws.frames), 1)
+        self.assertEqual(len(ws.frames[0]), 3)
+
+    async def test_coalesce_state_updates(self):
+        ws = FakeWebSocket()
+        session = WebSession(None, ws, None)
+        await session.reset('gpt-4')
+        await session.set_state('main', 'running')
+        await session.set_state('worker', 'running')
+        await session.set_state('worker', 'completed')
+        await session.close()
+        self.assertEqual([(m['id'], m['state'], m['seq']) for m in ws.sent], [('worker', 'completed', 3)])
+
+    async def test_overflow_sends_snapshot(self):
+        ws = FakeWebSocket()
+        session = WebSession(None, ws, None)
+        await session.reset('gpt-4')
+        with unittest.mock.patch('app.web_server.WS_QUEUE_SIZE', 3):
+            for i in range(5):
+                await session.add_message('main', {'role': 'user', 'content': str(i)}, usage={})
+        await session.close()
+        snapshot = ws.sent[0]
+        self.assertTrue(snapshot['snapshot'])
+        self.assertEqual(snapshot['seq'], 5)
+        self.assertEqual(len(snapshot['agents']['main']['messages']), 5)
+
+    async def test_disconnected_client_skipped(self):
+        session = WebSession(None, None, None)
+        await session.reset('gpt-4')
+        await session.add_message('main', {'role': 'user', 'content': 'x'}, usage={})
+        self.assertEqual(len(session.outbox), 0)
+        self.assertEqual(session.seq, 1)
+
+    async def test_stop_sends_reclaimed(self):
+        ws = FakeWebSocket()
+        session = WebSession(None, ws, None)
+        await session.reset('gpt-4')
+        session.agent = unittest.mock.Mock(stop=unittest.mock.AsyncMock(return_value={'run_killed': 1}))
+        await session.stop()
+        await session.close()
+        self.assertIsNone(session.agent)
+        self.assertEqual(ws.sent[-1]['reclaimed'], {'run_killed': 1})